@@ -1 +1 @@
-from .mapping_updater.update_usagi import update_usagi_file
+from .mapping_updater.update_usagi import update_usagi_file, update_usagi_files
@@ -0,0 +1,294 @@
+import csv
+import logging
+from collections.abc import Callable, Collection, Iterable, Sequence
+from datetime import date
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from .db import RelationshipRow, resolve_new_mappings, vocabulary_release_id
+from .relationship import ConceptRecord, NewMap, Relationship
+
+logger = logging.getLogger(__name__)
+
+# Number of rows parsed at once while streaming the vocabulary files
+DEFAULT_CHUNK_ROWS = 1_000_000
+
+# Low cardinality columns, stored as integer codes
+CATEGORY_COLUMNS = [
+    "domain_id",
+    "vocabulary_id",
+    "concept_class_id",
+    "standard_concept",
+    "invalid_reason",
+]
+_STRING_COLUMNS = ["concept_name", "concept_code"]
+_DATE_COLUMNS = ["valid_start_date", "valid_end_date"]
+CONCEPT_COLUMNS = ["concept_id", *_STRING_COLUMNS, *CATEGORY_COLUMNS, *_DATE_COLUMNS]
+
+# Relationships followed to find standard concepts
+RELATIONSHIP_IDS = sorted(Relationship.db_relationships())
+
+# Athena files are tab-separated without any quoting
+_READ_OPTIONS = {
+    "sep": "\t",
+    "quoting": csv.QUOTE_NONE,
+    "keep_default_na": False,
+    "na_values": [],
+}
+
+
+def read_chunks(path: Path, columns: list[str], dtype: dict, chunk_rows: int):
+    return pd.read_csv(path, usecols=columns, dtype=dtype, chunksize=chunk_rows, **_READ_OPTIONS)
+
+
+def _to_date_ints(values: pd.Series) -> np.ndarray:
+    """Convert YYYYMMDD (Athena) or YYYY-MM-DD dates to YYYYMMDD integers."""
+    return values.str.replace("-", "", regex=False).astype(np.int32).to_numpy()
+
+
+def from_date_int(value: int) -> date:
+    return date(value // 10000, value // 100 % 100, value % 100)
+
+
+def contains(sorted_ids: np.ndarray, concept_ids: np.ndarray) -> np.ndarray:
+    """Return which of concept_ids occur in the sorted array sorted_ids."""
+    if not len(sorted_ids):
+        return np.zeros(len(concept_ids), dtype=bool)
+    positions = np.searchsorted(sorted_ids, concept_ids)
+    positions[positions == len(sorted_ids)] = 0
+    return sorted_ids[positions] == concept_ids
+
+
+def _empty_concepts() -> pd.DataFrame:
+    """Compact DataFrame without concepts, with the columns of concepts_from_chunks."""
+    empty = pd.DataFrame({col: pd.Series(dtype=str) for col in CONCEPT_COLUMNS})
+    empty["concept_id"] = empty["concept_id"].astype(np.int64)
+    for col in CATEGORY_COLUMNS:
+        empty[col] = empty[col].astype("category")
+    for col in _DATE_COLUMNS:
+        empty[col] = empty[col].astype(np.int32)
+    return empty
+
+
+def concepts_from_chunks(chunks: Iterable[pd.DataFrame]) -> pd.DataFrame:
+    """
+    Combine chunks of concept rows in a compact DataFrame sorted by concept_id.
+
+    Low cardinality columns become categoricals (with empty strings for
+    missing values) and dates become YYYYMMDD integers.
+    """
+    compact_chunks = []
+    for chunk in chunks:
+        for col in CATEGORY_COLUMNS:
+            chunk[col] = chunk[col].fillna("").astype("category")
+        for col in _DATE_COLUMNS:
+            chunk[col] = _to_date_ints(chunk[col].astype(str))
+        compact_chunks.append(chunk)
+    if not compact_chunks:
+        # An empty concept table yields no chunks at all
+        compact_chunks.append(_empty_concepts())
+    concepts = pd.concat(compact_chunks, ignore_index=True)
+    # Categories differ per chunk, so unify them after concatenating
+    for col in CATEGORY_COLUMNS:
+        concepts[col] = concepts[col].astype(str).astype("category")
+    concepts.sort_values("concept_id", inplace=True, ignore_index=True)
+    logger.info(f"{len(concepts)} concepts loaded")
+    return concepts
+
+
+def relationships_from_chunks(
+    chunks: Iterable[pd.DataFrame], concept_ids: np.ndarray
+) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Combine chunks of relationships that are followed to find standard concepts.
+
+    :param chunks: DataFrames with columns concept_id_1, concept_id_2
+        and relationship_id.
+    :param concept_ids: Sorted array of existing concept_ids. Like the
+        join with the concept table, relationships to other concepts are
+        left out.
+    :return: Arrays of concept_id_1, concept_id_2 and the position of
+        the relationship_id in RELATIONSHIP_IDS, sorted by concept_id_1,
+        concept_id_2 and relationship_id.
+    """
+    id_1, id_2, codes = [], [], []
+    for chunk in chunks:
+        chunk = chunk[chunk["relationship_id"].isin(RELATIONSHIP_IDS)]
+        chunk = chunk[contains(concept_ids, chunk["concept_id_2"].to_numpy())]
+        id_1.append(chunk["concept_id_1"].to_numpy(dtype=np.int64))
+        id_2.append(chunk["concept_id_2"].to_numpy(dtype=np.int64))
+        relationship_ids = pd.Categorical(chunk["relationship_id"], categories=RELATIONSHIP_IDS)
+        codes.append(relationship_ids.codes.astype(np.int8))
+    id_1, id_2, codes = (
+        np.concatenate(a) if a else np.empty(0, dtype=np.int64) for a in (id_1, id_2, codes)
+    )
+    # RELATIONSHIP_IDS is sorted, so this is the order of the database queries
+    order = np.lexsort((codes, id_2, id_1))
+    logger.info(f"{len(order)} relevant concept relationships loaded")
+    return id_1[order], id_2[order], codes[order]
+
+
+def read_concepts(path: Path, chunk_rows: int = DEFAULT_CHUNK_ROWS) -> pd.DataFrame:
+    """Stream an Athena CONCEPT.csv file, see concepts_from_chunks."""
+    logger.info(f"Reading {path.name}")
+    dtype = dict.fromkeys(CONCEPT_COLUMNS, str) | {"concept_id": np.int64}
+    return concepts_from_chunks(read_chunks(path, CONCEPT_COLUMNS, dtype, chunk_rows))
+
+
+def read_relationships(
+    path: Path, concept_ids: np.ndarray, chunk_rows: int = DEFAULT_CHUNK_ROWS
+) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Stream an Athena CONCEPT_RELATIONSHIP.csv file, see relationships_from_chunks."""
+    logger.info(f"Reading {path.name}")
+    columns = ["concept_id_1", "concept_id_2", "relationship_id"]
+    dtype = {"concept_id_1": np.int64, "concept_id_2": np.int64, "relationship_id": str}
+    return relationships_from_chunks(read_chunks(path, columns, dtype, chunk_rows), concept_ids)
+
+
+def read_release(directory: Path) -> str | None:
+    """Identify the vocabulary release from VOCABULARY.csv, if present."""
+    path = directory / "VOCABULARY.csv"
+    if not path.exists():
+        return None
+    vocabularies = pd.read_csv(
+        path, usecols=["vocabulary_id", "vocabulary_version"], dtype=str, **_READ_OPTIONS
+    ).sort_values("vocabulary_id")
+    return vocabulary_release_id(vocabularies.itertuples(index=False))
+
+
+class AthenaVocabulary:
+    """
+    Vocabulary lookups from an Athena download, without a database.
+
+    CONCEPT.csv and CONCEPT_RELATIONSHIP.csv are streamed in chunks and
+    kept in sorted numpy arrays. Only relationships that are used to find
+    standard concepts are retained, so the full relationship table takes
+    a few bytes per relevant relationship. Concept records are only
+    created for concepts that are actually looked up.
+
+    The lookup methods mirror query_concepts, get_mappings(_batch) and
+    find_all_homonyms(_batch) from the db module, and results are
+    ordered the same way.
+
+    :param directory: Directory containing the (unzipped) Athena files.
+    :param chunk_rows: Number of rows parsed at once.
+    """
+
+    def __init__(self, directory: Path, chunk_rows: int = DEFAULT_CHUNK_ROWS):
+        self.directory = directory
+        self._concepts = read_concepts(directory / "CONCEPT.csv", chunk_rows)
+        self._concept_ids = self._concepts["concept_id"].to_numpy()
+        self._id_1, self._id_2, self._relationship_codes = read_relationships(
+            directory / "CONCEPT_RELATIONSHIP.csv", self._concept_ids, chunk_rows
+        )
+        self.release = read_release(directory)
+        self._concept_cache: dict[int, ConceptRecord] = {}
+        self._name_index: dict[bool, tuple[np.ndarray, np.ndarray]] = {}
+
+    def _concept(self, position: int) -> ConceptRecord:
+        concept_id = int(self._concept_ids[position])
+        concept = self._concept_cache.get(concept_id)
+        if concept is None:
+            row = self._concepts.iloc[position]
+            concept = ConceptRecord(
+                concept_id=concept_id,
+                **{c: row[c] for c in _STRING_COLUMNS},
+                **{c: row[c] or None for c in CATEGORY_COLUMNS},
+                **{c: from_date_int(int(row[c])) for c in _DATE_COLUMNS},
+            )
+            self._concept_cache[concept_id] = concept
+        return concept
+
+    def query_concepts(self, concept_ids: Collection[int]) -> list[ConceptRecord]:
+        """Get the records of all concept_ids that exist, ordered by concept_id."""
+        concept_ids = np.unique(np.fromiter(concept_ids, dtype=np.int64))
+        positions = np.searchsorted(self._concept_ids, concept_ids)
+        return [
+            self._concept(p)
+            for c_id, p in zip(concept_ids, positions, strict=True)
+            if p < len(self._concept_ids) and self._concept_ids[p] == c_id
+        ]
+
+    def _mappings(self, start: int, end: int) -> list[RelationshipRow]:
+        return [
+            RelationshipRow(
+                concept_id_1=int(self._id_1[i]),
+                concept_id_2=int(self._id_2[i]),
+                relationship_id=RELATIONSHIP_IDS[self._relationship_codes[i]],
+                concept_2=self._concept(int(np.searchsorted(self._concept_ids, self._id_2[i]))),
+            )
+            for i in range(start, end)
+        ]
+
+    def relationship_edges(self) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Return all relationships, see relationships_from_chunks."""
+        return self._id_1, self._id_2, self._relationship_codes
+
+    def get_mappings(self, concept_id: int) -> list[RelationshipRow]:
+        """Get relationship mappings for a given concept_id."""
+        start, end = np.searchsorted(self._id_1, [concept_id, concept_id + 1])
+        return self._mappings(start, end)
+
+    def get_mappings_batch(self, concept_ids: Collection[int]) -> dict[int, list[RelationshipRow]]:
+        """Get relationship mappings for all given concept_ids at once."""
+        concept_ids = np.fromiter(concept_ids, dtype=np.int64)
+        starts = np.searchsorted(self._id_1, concept_ids)
+        ends = np.searchsorted(self._id_1, concept_ids + 1)
+        return {
+            int(c_id): self._mappings(start, end)
+            for c_id, start, end in zip(concept_ids, starts, ends, strict=True)
+            if start < end
+        }
+
+    def _get_name_index(self, case_insensitive: bool) -> tuple[np.ndarray, np.ndarray]:
+        """Concept positions sorted by name (then concept_id), and the sorted names."""
+        if case_insensitive not in self._name_index:
+            names = self._concepts["concept_name"]
+            if case_insensitive:
+                names = names.str.lower()
+            names = names.to_numpy(dtype=object)
+            # A stable sort keeps homonyms ordered by concept_id
+            order = np.argsort(names, kind="stable")
+            self._name_index[case_insensitive] = (order, names[order])
+        return self._name_index[case_insensitive]
+
+    def _find_by_name(self, name: str, case_insensitive: bool) -> list[ConceptRecord]:
+        order, sorted_names = self._get_name_index(case_insensitive)
+        key = name.lower() if case_insensitive else name
+        start = np.searchsorted(sorted_names, key, side="left")
+        end = np.searchsorted(sorted_names, key, side="right")
+        return [self._concept(int(p)) for p in order[start:end]]
+
+    def find_all_homonyms(
+        self, concept: ConceptRecord, case_insensitive: bool
+    ) -> list[ConceptRecord]:
+        """Get the records of all concepts that match the concept_name."""
+        return [
+            h
+            for h in self._find_by_name(concept.concept_name, case_insensitive)
+            if h.concept_id != concept.concept_id
+        ]
+
+    def find_all_homonyms_batch(
+        self, concepts: Iterable[ConceptRecord], case_insensitive: bool
+    ) -> dict[int, list[ConceptRecord]]:
+        """Get the homonyms of all given concepts."""
+        return {c.concept_id: self.find_all_homonyms(c, case_insensitive) for c in concepts}
+
+    def find_new_mappings(
+        self,
+        concepts: Sequence[ConceptRecord],
+        search_homonyms: bool,
+        ignore_case: bool,
+        find_standard: Callable[[Iterable[ConceptRecord]], dict[int, NewMap | None]] | None = None,
+    ) -> dict[int, NewMap | None]:
+        """Equivalent of db.find_new_mappings, see resolve_new_mappings."""
+        return resolve_new_mappings(
+            concepts,
+            search_homonyms,
+            self.get_mappings_batch,
+            lambda unresolved: self.find_all_homonyms_batch(unresolved, ignore_case),
+            find_standard,
+        )
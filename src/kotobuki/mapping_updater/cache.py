@@ -0,0 +1,169 @@
+import json
+import logging
+import sqlite3
+from collections.abc import Collection
+from datetime import date
+from pathlib import Path
+from time import time
+from typing import Any
+
+from .relationship import CONCEPT_FIELDS, VAL_TO_RELATIONSHIP, ConceptRecord, MapLink, NewMap
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MAX_ENTRIES = 1_000_000
+
+# SQLite limits the number of bound parameters per statement
+_SQLITE_BATCH_SIZE = 500
+
+_DATE_FIELDS = {"valid_start_date", "valid_end_date"}
+
+
+def _concept_to_dict(c: ConceptRecord) -> dict[str, Any]:
+    d = {f: getattr(c, f) for f in CONCEPT_FIELDS}
+    for k in _DATE_FIELDS:
+        if d[k] is not None:
+            d[k] = d[k].isoformat()
+    return d
+
+
+def _concept_from_dict(d: dict[str, Any]) -> ConceptRecord:
+    d = d.copy()
+    for k in _DATE_FIELDS:
+        if d[k] is not None:
+            d[k] = date.fromisoformat(d[k])
+    return ConceptRecord(**d)
+
+
+def serialize_new_map(new_map: NewMap | None) -> str:
+    """Serialize a NewMap (or the absence thereof) to a JSON string."""
+    if new_map is None:
+        return json.dumps(None)
+    return json.dumps(
+        {
+            "concepts": [_concept_to_dict(c) for c in new_map.concepts],
+            "value_as_concept": [_concept_to_dict(c) for c in new_map.value_as_concept],
+            "map_path": [
+                {
+                    "concept": _concept_to_dict(link.concept),
+                    "via": None if link.via is None else link.via.value,
+                }
+                for link in new_map.map_path
+            ],
+        }
+    )
+
+
+def deserialize_new_map(data: str) -> NewMap | None:
+    """Inverse of serialize_new_map."""
+    d = json.loads(data)
+    if d is None:
+        return None
+    return NewMap(
+        concepts=[_concept_from_dict(c) for c in d["concepts"]],
+        value_as_concept=[_concept_from_dict(c) for c in d["value_as_concept"]],
+        map_path=[
+            MapLink(
+                _concept_from_dict(link["concept"]),
+                None if link["via"] is None else VAL_TO_RELATIONSHIP[link["via"]],
+            )
+            for link in d["map_path"]
+        ],
+    )
+
+
+class ResolutionCache:
+    """
+    On-disk cache of new mappings, stored in a local SQLite file.
+
+    Entries are only valid for the vocabulary release (and search
+    options) they were resolved with. When the cache is opened for a
+    different release, all entries of other releases are dropped. If the
+    number of entries exceeds max_entries, the least recently used
+    entries are evicted.
+
+    :param path: SQLite file to store the cache in.
+    :param release: Identifier of the vocabulary release.
+    :param options: Identifier of the search options that affect the
+        results (e.g. whether homonyms are allowed).
+    :param max_entries: Maximum number of cached concepts.
+    """
+
+    def __init__(
+        self,
+        path: Path,
+        release: str,
+        options: str = "",
+        max_entries: int = DEFAULT_MAX_ENTRIES,
+    ):
+        self.path = path
+        self.release = release
+        self.options = options
+        self.max_entries = max_entries
+        self._con = sqlite3.connect(path)
+        with self._con:
+            self._con.execute(
+                "CREATE TABLE IF NOT EXISTS resolution ("
+                "release TEXT NOT NULL, "
+                "options TEXT NOT NULL, "
+                "concept_id INTEGER NOT NULL, "
+                "new_map TEXT NOT NULL, "
+                "last_used REAL NOT NULL, "
+                "PRIMARY KEY (release, options, concept_id))"
+            )
+            self._con.execute("CREATE INDEX IF NOT EXISTS idx_last_used ON resolution (last_used)")
+            deleted = self._con.execute(
+                "DELETE FROM resolution WHERE release != ?", (release,)
+            ).rowcount
+        if deleted:
+            logger.info(f"Removed {deleted} cached mappings of other vocabulary releases")
+
+    def __enter__(self) -> "ResolutionCache":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+    def close(self) -> None:
+        self._con.close()
+
+    def get_many(self, concept_ids: Collection[int]) -> dict[int, NewMap | None]:
+        """Return the cached results of those concept_ids that are present."""
+        concept_ids = list(concept_ids)
+        results: dict[int, NewMap | None] = {}
+        for i in range(0, len(concept_ids), _SQLITE_BATCH_SIZE):
+            batch = concept_ids[i : i + _SQLITE_BATCH_SIZE]
+            rows = self._con.execute(
+                "SELECT concept_id, new_map FROM resolution "
+                "WHERE release = ? AND options = ? "
+                f"AND concept_id IN ({','.join('?' * len(batch))})",
+                (self.release, self.options, *batch),
+            )
+            for concept_id, data in rows:
+                results[concept_id] = deserialize_new_map(data)
+        with self._con:
+            self._con.executemany(
+                "UPDATE resolution SET last_used = ? "
+                "WHERE release = ? AND options = ? AND concept_id = ?",
+                [(time(), self.release, self.options, c_id) for c_id in results],
+            )
+        return results
+
+    def put_many(self, new_mappings: dict[int, NewMap | None]) -> None:
+        """Store results, then evict the least recently used entries if needed."""
+        now = time()
+        with self._con:
+            self._con.executemany(
+                "INSERT OR REPLACE INTO resolution VALUES (?, ?, ?, ?, ?)",
+                [
+                    (self.release, self.options, c_id, serialize_new_map(nm), now)
+                    for c_id, nm in new_mappings.items()
+                ],
+            )
+            (n_entries,) = self._con.execute("SELECT COUNT(*) FROM resolution").fetchone()
+            if n_entries > self.max_entries:
+                self._con.execute(
+                    "DELETE FROM resolution WHERE rowid IN "
+                    "(SELECT rowid FROM resolution ORDER BY last_used LIMIT ?)",
+                    (n_entries - self.max_entries,),
+                )
@@ -1,11 +1,24 @@
 #!/usr/bin/env python3
+import glob
 import logging
+import sys
 from pathlib import Path
 
 import click
 from sqlalchemy import create_engine
 
-from .update_usagi import update_usagi_file
+from .athena import AthenaVocabulary
+from .db import ResolutionMode
+from .importer import import_athena
+from .indexes import check_indexes
+from .io import is_updated_usagi_file
+from .materialize import DEFAULT_BATCH_SIZE, build_resolution_table
+from .snapshot import (
+    VocabularySnapshot,
+    build_snapshot_from_athena,
+    build_snapshot_from_database,
+)
+from .update_usagi import update_usagi_files
 
 logger = logging.getLogger(__name__)
 
@@ -13,23 +26,40 @@ logger = logging.getLogger(__name__)
 @click.command()
 @click.option(
     "--url",
-    required=True,
     help="SQLAlchemy database URL",
     type=click.STRING,
 )
 @click.option(
     "--schema",
-    required=True,
     help="Schema containing the OHDSI vocabulary tables",
     type=click.STRING,
 )
+@click.option(
+    "--athena-dir",
+    help="Instead of a database, read the vocabulary from an (unzipped) Athena "
+    "download containing CONCEPT.csv and CONCEPT_RELATIONSHIP.csv.",
+    type=click.Path(file_okay=False, exists=True, readable=True, path_type=Path),
+)
+@click.option(
+    "--snapshot",
+    help="Instead of a database, read the vocabulary from a snapshot created with "
+    "'kotobuki snapshot build'.",
+    type=click.Path(file_okay=False, exists=True, readable=True, path_type=Path),
+)
 @click.option(
     "-f",
     "--usagi-file",
-    required=True,
     help="A file saved or exported from Usagi",
     type=click.Path(dir_okay=False, exists=True, readable=True, path_type=Path),
 )
+@click.option(
+    "-b",
+    "--batch",
+    help="Update multiple Usagi files at once, given a directory (all CSV files "
+    "in it) or a glob pattern (e.g. 'mappings/*_stcm.csv'). The target concepts of "
+    "all files are resolved together.",
+    type=click.STRING,
+)
 @click.option(
     "-h",
     "--allow-homonyms",
@@ -77,37 +107,319 @@ logger = logging.getLogger(__name__)
     help="Also update fields of concepts that don't get a new mapping, but "
     "do have outdated properties (e.g. changed domain_id)",
 )
+@click.option(
+    "-r",
+    "--resolver",
+    type=click.Choice([m.value for m in ResolutionMode]),
+    default=ResolutionMode.BATCH.value,
+    show_default=True,
+    help="How to traverse concept relationships: 'batch' queries all concepts "
+    "together once per traversal depth, 'recursive-cte' lets the database "
+    "traverse all relationships in a single recursive query, 'materialized' "
+    "looks them up in the table created by 'kotobuki build-resolution-table', "
+    "'vectorized' resolves the whole vocabulary at once (with --athena-dir or "
+    "--snapshot only).",
+)
+@click.option(
+    "--cache-file",
+    help="SQLite file in which found mappings are cached between runs. The cache "
+    "is automatically invalidated when the vocabulary release changes.",
+    type=click.Path(dir_okay=False, writable=True, path_type=Path),
+)
+@click.option(
+    "--chunk-size",
+    help="Maximum number of concept_ids per IN-list in database queries. "
+    "Defaults to a safe value for the database in use.",
+    type=click.IntRange(min=1),
+)
+@click.option(
+    "--temp-table-threshold",
+    help="Number of concept_ids above which they are loaded into a temporary "
+    "table for database queries, instead of being sent as a list of values.",
+    type=click.IntRange(min=1),
+)
+@click.option(
+    "--homonym-index",
+    is_flag=True,
+    default=False,
+    help="Search homonyms in an in-memory index of all concept names, built once "
+    "per run, instead of querying the database by name. Useful if the concept_name "
+    "column is not indexed.",
+)
+@click.option(
+    "--homonym-index-file",
+    help="File to load the homonym index from, or to save it to if it does not "
+    "exist or was built for a different vocabulary release. Implies --homonym-index.",
+    type=click.Path(dir_okay=False, writable=True, path_type=Path),
+)
+@click.option(
+    "--workers",
+    default=1,
+    show_default=True,
+    help="Number of threads that resolve concepts concurrently, each with its own "
+    "database connection. Useful for databases with a high latency.",
+    type=click.IntRange(min=1),
+)
 def _update_usagi_cli(
-    url: str,
-    schema: str,
-    usagi_file: Path,
+    url: str | None,
+    schema: str | None,
+    athena_dir: Path | None,
+    snapshot: Path | None,
+    usagi_file: Path | None,
+    batch: str | None,
     allow_homonyms: bool,
     ignore_case: bool,
     write_map_paths: bool,
     inspect_only: bool,
     overwrite: bool,
     update_all: bool,
+    resolver: str,
+    cache_file: Path | None,
+    chunk_size: int | None,
+    temp_table_threshold: int | None,
+    homonym_index: bool,
+    homonym_index_file: Path | None,
+    workers: int,
 ) -> None:
     """
-    Parse an Usagi saved/exported file to update non-standard concepts.
+    Parse Usagi saved/exported file(s) to update non-standard concepts.
     """
-    engine = create_engine(url)
-    update_usagi_file(
+    if (usagi_file is None) == (batch is None):
+        raise click.UsageError("Provide either --usagi-file or --batch.")
+    usagi_files = [usagi_file] if batch is None else _expand_batch(batch)
+    if not usagi_files:
+        raise click.UsageError(f"No Usagi files found for {batch}")
+    if athena_dir is not None and snapshot is not None:
+        raise click.UsageError("Provide either --athena-dir or --snapshot.")
+    if athena_dir is None and snapshot is None:
+        if url is None or schema is None:
+            raise click.UsageError(
+                "Provide either --url and --schema, --athena-dir or --snapshot."
+            )
+        if resolver == ResolutionMode.VECTORIZED.value:
+            raise click.UsageError("--resolver vectorized requires --athena-dir or --snapshot.")
+    else:
+        database_options = _database_only_options(
+            resolver, workers, chunk_size, temp_table_threshold, homonym_index, homonym_index_file
+        )
+        if database_options:
+            raise click.UsageError(
+                f"{', '.join(database_options)} can only be used with --url and --schema."
+            )
+    vocabulary = None
+    if athena_dir is not None:
+        vocabulary = AthenaVocabulary(athena_dir)
+    elif snapshot is not None:
+        vocabulary = VocabularySnapshot(snapshot)
+    engine = None
+    if vocabulary is None:
+        # Each worker, and the main session, needs its own connection
+        pool_options = {"pool_size": workers + 1, "max_overflow": 0} if workers > 1 else {}
+        engine = create_engine(url, **pool_options)
+    update_usagi_files(
         engine,
         schema,
-        usagi_file,
+        usagi_files,
         allow_homonyms,
         ignore_case,
         write_map_paths,
         inspect_only,
         overwrite,
         update_all,
+        ResolutionMode(resolver),
+        cache_file,
+        chunk_size=chunk_size,
+        temp_table_threshold=temp_table_threshold,
+        vocabulary=vocabulary,
+        homonym_index=homonym_index,
+        homonym_index_file=homonym_index_file,
+        workers=workers,
     )
 
 
+def _database_only_options(
+    resolver: str,
+    workers: int,
+    chunk_size: int | None,
+    temp_table_threshold: int | None,
+    homonym_index: bool,
+    homonym_index_file: Path | None,
+) -> list[str]:
+    """Return the given options that only apply to a database, not to --athena-dir/--snapshot."""
+    options = {
+        f"--resolver {resolver}": resolver
+        in (ResolutionMode.RECURSIVE_CTE.value, ResolutionMode.MATERIALIZED.value),
+        "--workers": workers > 1,
+        "--chunk-size": chunk_size is not None,
+        "--temp-table-threshold": temp_table_threshold is not None,
+        "--homonym-index": homonym_index,
+        "--homonym-index-file": homonym_index_file is not None,
+    }
+    return [option for option, is_set in options.items() if is_set]
+
+
+def _expand_batch(batch: str) -> list[Path]:
+    """
+    Get all Usagi files in a directory, or matching a glob pattern.
+
+    Updated files written by earlier runs (see is_updated_usagi_file) are
+    left out, so rerunning on the same files does not update those too.
+    """
+    batch_path = Path(batch)
+    if batch_path.is_dir():
+        paths = batch_path.glob("*.csv")
+    else:
+        paths = (Path(p) for p in glob.glob(batch) if Path(p).is_file())  # noqa: PTH207
+    return sorted(p for p in paths if not is_updated_usagi_file(p))
+
+
+@click.group()
+def _kotobuki_cli() -> None:
+    """
+    Tools to keep OMOP concept mappings up to date.
+    """
+
+
+_kotobuki_cli.add_command(_update_usagi_cli, "update-usagi-file")
+
+
+@_kotobuki_cli.command("build-resolution-table")
+@click.option(
+    "--url",
+    required=True,
+    help="SQLAlchemy database URL",
+    type=click.STRING,
+)
+@click.option(
+    "--schema",
+    required=True,
+    help="Schema containing the OHDSI vocabulary tables",
+    type=click.STRING,
+)
+@click.option(
+    "--batch-size",
+    default=DEFAULT_BATCH_SIZE,
+    show_default=True,
+    help="Number of concepts resolved together.",
+    type=click.IntRange(min=1),
+)
+def _build_resolution_table_cli(url: str, schema: str, batch_size: int) -> None:
+    """
+    Precompute the standard concepts of all non-standard concepts.
+
+    Needs to be rerun after every vocabulary update.
+    """
+    engine = create_engine(url)
+    build_resolution_table(engine, schema, batch_size)
+
+
+@_kotobuki_cli.group("snapshot")
+def _snapshot_cli() -> None:
+    """
+    Manage binary vocabulary snapshots.
+    """
+
+
+@_snapshot_cli.command("build")
+@click.option(
+    "--url",
+    help="SQLAlchemy database URL",
+    type=click.STRING,
+)
+@click.option(
+    "--schema",
+    help="Schema containing the OHDSI vocabulary tables",
+    type=click.STRING,
+)
+@click.option(
+    "--athena-dir",
+    help="Directory of an (unzipped) Athena download, instead of a database.",
+    type=click.Path(file_okay=False, exists=True, readable=True, path_type=Path),
+)
+@click.option(
+    "-o",
+    "--output",
+    required=True,
+    help="Directory to write the snapshot to.",
+    type=click.Path(file_okay=False, writable=True, path_type=Path),
+)
+def _build_snapshot_cli(
+    url: str | None, schema: str | None, athena_dir: Path | None, output: Path
+) -> None:
+    """
+    Convert vocabulary tables or an Athena download to a snapshot.
+
+    The snapshot can be used with 'update-usagi-file --snapshot'.
+    """
+    if athena_dir is not None:
+        build_snapshot_from_athena(athena_dir, output)
+    elif url is None or schema is None:
+        raise click.UsageError("Provide either --url and --schema, or --athena-dir.")
+    else:
+        build_snapshot_from_database(create_engine(url), schema, output)
+
+
+@_kotobuki_cli.command("import-athena")
+@click.option(
+    "--athena-dir",
+    required=True,
+    help="Directory of an (unzipped) Athena download.",
+    type=click.Path(file_okay=False, exists=True, readable=True, path_type=Path),
+)
+@click.option(
+    "-o",
+    "--output",
+    required=True,
+    help="Database file to create. Files ending with .duckdb become DuckDB databases "
+    "(requires duckdb-engine), others SQLite databases.",
+    type=click.Path(dir_okay=False, writable=True, path_type=Path),
+)
+def _import_athena_cli(athena_dir: Path, output: Path) -> None:
+    """
+    Import an Athena download into a local, indexed database file.
+
+    Prints the --url and --schema to update Usagi files with.
+    """
+    import_athena(athena_dir, output)
+
+
+@_kotobuki_cli.command("check-indexes")
+@click.option(
+    "--url",
+    required=True,
+    help="SQLAlchemy database URL",
+    type=click.STRING,
+)
+@click.option(
+    "--schema",
+    required=True,
+    help="Schema containing the OHDSI vocabulary tables",
+    type=click.STRING,
+)
+@click.option(
+    "--create",
+    is_flag=True,
+    default=False,
+    help="Create the indexes that are missing (requires write access).",
+)
+def _check_indexes_cli(url: str, schema: str, create: bool) -> None:
+    """
+    Check whether the vocabulary tables are indexed for kotobuki.
+
+    Runs EXPLAIN on the queries kotobuki issues and reports those that
+    read a whole table. Exits with status 1 if any remain.
+    """
+    if not check_indexes(create_engine(url), schema, create_missing=create):
+        sys.exit(1)
+
+
 def main():
     _update_usagi_cli()
 
 
+def kotobuki_main():
+    _kotobuki_cli()
+
+
 if __name__ == "__main__":
     main()
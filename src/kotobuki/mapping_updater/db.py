@@ -1,94 +1,619 @@
-from collections.abc import Sequence
+import hashlib
+from collections import defaultdict
+from collections.abc import Callable, Collection, Iterable, Iterator, Mapping, Sequence
+from dataclasses import dataclass, field
+from enum import Enum
+from typing import NamedTuple
 
-from omop_cdm.regular.cdm54 import Concept, ConceptRelationship
-from sqlalchemy import and_, func, select
-from sqlalchemy.orm import Session
+from omop_cdm.constants import VOCAB_SCHEMA
+from omop_cdm.regular.cdm54 import Concept, ConceptRelationship, Vocabulary
+from sqlalchemy import (
+    Column,
+    ColumnElement,
+    Index,
+    Integer,
+    MetaData,
+    PrimaryKeyConstraint,
+    Row,
+    Select,
+    String,
+    Table,
+    and_,
+    exists,
+    func,
+    select,
+)
+from sqlalchemy.orm import Session, aliased
 
+from .homonyms import HOMONYM_INDEX_KEY, HomonymIndex
 from .relationship import (
+    CONCEPT_FIELDS,
     VAL_TO_RELATIONSHIP,
+    ConceptRecord,
     MapLink,
     NewMap,
     Relationship,
 )
+from .values import filter_values, in_values
 
+# Number of rows fetched per round trip when streaming concepts
+DEFAULT_YIELD_PER = 10_000
 
-def query_concepts(concept_ids: set[int], session: Session) -> Sequence[Concept]:
-    """Get Concept ORM objects for all given concept_ids."""
-    return session.scalars(select(Concept).filter(Concept.concept_id.in_(concept_ids))).all()
+# Concept columns in the order of the ConceptRecord fields
+_CONCEPT_COLUMNS = [getattr(Concept, f) for f in CONCEPT_FIELDS]
 
 
-def get_mappings(concept_id: int, session: Session) -> Sequence[ConceptRelationship]:
-    """Get relationship mappings for a given concept_id."""
-    return session.scalars(
-        select(ConceptRelationship).filter(
-            and_(
-                ConceptRelationship.concept_id_1 == concept_id,
-                ConceptRelationship.relationship_id.in_(Relationship.db_relationships()),
-            )
+class ResolutionMode(Enum):
+    """How relationship chains are traversed in the database."""
+
+    # One concept_relationship query per traversal depth
+    BATCH = "batch"
+    # A single WITH RECURSIVE query for all concepts together
+    RECURSIVE_CTE = "recursive-cte"
+    # A lookup in the precomputed kotobuki_resolution table
+    MATERIALIZED = "materialized"
+    # Pointer jumping over the whole vocabulary (Athena files/snapshots only)
+    VECTORIZED = "vectorized"
+
+
+RESOLUTION_METADATA = MetaData()
+
+# Precomputed outcome of the relationship search for every non-standard
+# concept (see materialize.build_resolution_table). Each concept has a
+# row per step of its mapping path, and per 'Maps to' and 'Maps to value'
+# target concept.
+RESOLUTION_TABLE = Table(
+    "kotobuki_resolution",
+    RESOLUTION_METADATA,
+    Column("concept_id", Integer, nullable=False),
+    Column("kind", String(20), nullable=False),
+    Column("position", Integer, nullable=False),
+    Column("target_concept_id", Integer, nullable=False),
+    # Relationship that led to the target concept (path steps only)
+    Column("via", String(20)),
+    PrimaryKeyConstraint("concept_id", "kind", "position"),
+    Index("idx_kotobuki_resolution_target", "target_concept_id"),
+    schema=VOCAB_SCHEMA,
+)
+RESOLUTION_RELEASE_TABLE = Table(
+    "kotobuki_resolution_release",
+    RESOLUTION_METADATA,
+    Column("release", String(64), nullable=False),
+    schema=VOCAB_SCHEMA,
+)
+
+
+class ResolutionKind(Enum):
+    """Types of rows in the kotobuki_resolution table."""
+
+    PATH = "path"
+    MAPS_TO = "maps_to"
+    MAPS_TO_VALUE = "maps_to_value"
+
+
+class RelationshipRow(NamedTuple):
+    """A concept relationship together with its target concept."""
+
+    concept_id_1: int
+    concept_id_2: int
+    relationship_id: str
+    concept_2: ConceptRecord
+
+
+def query_concepts(concept_ids: Collection[int], session: Session) -> list[ConceptRecord]:
+    """Get the records of all given concept_ids."""
+    return list(stream_concepts(concept_ids, session))
+
+
+def stream_concepts(
+    concept_ids: Collection[int], session: Session, yield_per: int = DEFAULT_YIELD_PER
+) -> Iterator[ConceptRecord]:
+    """
+    Stream the records of all given concepts, without creating ORM objects.
+
+    Rows are fetched in batches of yield_per (via a server-side cursor
+    where the database supports it), and are not tracked by the session,
+    so only the records that the caller keeps stay in memory.
+    """
+    with filter_values(Concept.concept_id, concept_ids, session) as clauses:
+        for clause in clauses:
+            stmt = select(*_CONCEPT_COLUMNS).filter(clause)
+            for row in session.execute(stmt.execution_options(yield_per=yield_per)):
+                yield ConceptRecord(*row)
+
+
+def lookup_statements(dialect: str) -> dict[str, Select]:
+    """
+    Representative statements of each kind of lookup done during an update.
+
+    Values are filtered on a single value, in the form filter_values
+    uses for small numbers of values in the given dialect.
+    """
+    name_col = _homonym_name_column(case_insensitive=False)
+    lower_name_col = _homonym_name_column(case_insensitive=True)
+    return {
+        "concepts": select(*_CONCEPT_COLUMNS).filter(in_values(Concept.concept_id, [0], dialect)),
+        "relationships": _select_mappings().filter(
+            in_values(ConceptRelationship.concept_id_1, [0], dialect)
+        ),
+        "homonyms": _select_homonyms(name_col).where(in_values(name_col, [""], dialect)),
+        "homonyms (ignore case)": _select_homonyms(lower_name_col).where(
+            in_values(lower_name_col, [""], dialect)
+        ),
+    }
+
+
+def get_vocabulary_release(session: Session) -> str:
+    """Return an identifier of the vocabulary release, based on all vocabulary versions."""
+    versions = session.execute(
+        select(Vocabulary.vocabulary_id, Vocabulary.vocabulary_version).order_by(
+            Vocabulary.vocabulary_id
         )
-    ).all()
+    )
+    return vocabulary_release_id(versions)
+
+
+def vocabulary_release_id(versions: Iterable[tuple[str, str]]) -> str:
+    """Hash (vocabulary_id, vocabulary_version) pairs, ordered by vocabulary_id."""
+    text = "\n".join(f"{vocabulary_id}\t{version}" for vocabulary_id, version in versions)
+    return hashlib.sha256(text.encode("utf8")).hexdigest()
+
+
+def _select_mappings() -> Select:
+    """
+    Select relationship mappings joined with their target concept.
+
+    Fetching the target concept in the same query avoids a lazy load of
+    ConceptRelationship.concept_2 for every relationship. Rows are
+    converted with _relationship_row. The order is fully defined, so all
+    backends follow relationships in the same order.
+    """
+    return (
+        select(
+            ConceptRelationship.concept_id_1,
+            ConceptRelationship.concept_id_2,
+            ConceptRelationship.relationship_id,
+            *_CONCEPT_COLUMNS,
+        )
+        .join(Concept, Concept.concept_id == ConceptRelationship.concept_id_2)
+        .filter(ConceptRelationship.relationship_id.in_(Relationship.db_relationships()))
+        .order_by(
+            ConceptRelationship.concept_id_1,
+            ConceptRelationship.concept_id_2,
+            ConceptRelationship.relationship_id,
+        )
+    )
+
+
+def _relationship_row(row: Row) -> RelationshipRow:
+    concept_id_1, concept_id_2, relationship_id, *concept_2 = row
+    return RelationshipRow(concept_id_1, concept_id_2, relationship_id, ConceptRecord(*concept_2))
+
+
+def _group_mappings(stmts: Iterable[Select], session: Session) -> dict[int, list[RelationshipRow]]:
+    mappings: dict[int, list[RelationshipRow]] = defaultdict(list)
+    for stmt in stmts:
+        for row in session.execute(stmt):
+            mappings[row.concept_id_1].append(_relationship_row(row))
+    return mappings
+
+
+def get_mappings(concept_id: int, session: Session) -> list[RelationshipRow]:
+    """Get relationship mappings for a given concept_id."""
+    stmt = _select_mappings().filter(ConceptRelationship.concept_id_1 == concept_id)
+    return [_relationship_row(row) for row in session.execute(stmt)]
+
+
+def get_mappings_batch(
+    concept_ids: Collection[int], session: Session
+) -> dict[int, list[RelationshipRow]]:
+    """Get relationship mappings for all given concept_ids at once."""
+    with filter_values(ConceptRelationship.concept_id_1, concept_ids, session) as clauses:
+        return _group_mappings((_select_mappings().filter(c) for c in clauses), session)
 
 
 def find_maps_to_value_relationship(
-    mappings: Sequence[ConceptRelationship],
-) -> list[Concept]:
+    mappings: Sequence[RelationshipRow],
+) -> list[ConceptRecord]:
     return [m.concept_2 for m in mappings if m.relationship_id == Relationship.MAPS_TO_VALUE.value]
 
 
+@dataclass
+class _Resolved:
+    """Outcome of following the relationships of a single concept."""
+
+    concepts: list[ConceptRecord]
+    value_as_concept: list[ConceptRecord]
+    # Mapping path after the concept itself
+    links: list[MapLink]
+
+
+@dataclass
+class ResolutionMemo:
+    """
+    Per-run memo of relationship chains, keyed by concept_id.
+
+    As the next relationship to follow only depends on the concept
+    itself, the resolved remainder of a chain can be shared by every
+    path that passes through a concept. Concepts that share the tail of
+    a chain therefore only need their relationships fetched once.
+    """
+
+    mappings: dict[int, list[RelationshipRow]] = field(default_factory=dict)
+    resolved: dict[int, _Resolved | None] = field(default_factory=dict)
+
+
+@dataclass
+class _Walk:
+    source_id: int
+    path: list[MapLink]
+    # Concepts visited so far, the last one being the current concept
+    concept_ids: list[int]
+
+    def finish(self, resolved: _Resolved | None, memo: ResolutionMemo) -> NewMap | None:
+        """Store the outcome for every concept on the path and return it."""
+        for i, concept_id in enumerate(self.concept_ids):
+            if resolved is None:
+                memo.resolved[concept_id] = None
+            else:
+                links = self.path[len(self.path) - len(self.concept_ids) + i + 1 :]
+                memo.resolved[concept_id] = _Resolved(
+                    resolved.concepts, resolved.value_as_concept, [*links, *resolved.links]
+                )
+        if resolved is None:
+            return None
+        return NewMap(
+            concepts=resolved.concepts.copy(),
+            value_as_concept=resolved.value_as_concept.copy(),
+            map_path=[*self.path, *resolved.links],
+        )
+
+
+def _traverse(
+    walks: list[_Walk],
+    fetch_mappings: Callable[[Collection[int]], Mapping[int, list[RelationshipRow]]],
+    memo: ResolutionMemo | None = None,
+) -> dict[int, NewMap | None]:
+    """
+    Follow the relationships of all walks together, without recursion.
+
+    Each walk advances in memory for as long as the relationships of its
+    current concept are known (or the concept was already resolved). The
+    concepts the remaining walks are stuck on are then fetched together,
+    so there is one fetch per traversal depth at most. A walk that
+    returns to a concept it already visited ends without result.
+
+    :param walks: Walks to follow, one per source concept.
+    :param fetch_mappings: Called with concept_ids whose relationship
+        mappings are not known yet; returns them grouped by
+        concept_id_1.
+    :param memo: Memo shared with other traversals in the same run.
+    """
+    memo = ResolutionMemo() if memo is None else memo
+    follow_relationships = Relationship.follow_relationships()
+    results: dict[int, NewMap | None] = {}
+    while walks:
+        blocked: list[_Walk] = []
+        for walk in walks:
+            while True:
+                concept_id = walk.concept_ids[-1]
+                if concept_id in memo.resolved:
+                    results[walk.source_id] = walk.finish(memo.resolved[concept_id], memo)
+                    break
+                if concept_id not in memo.mappings:
+                    blocked.append(walk)
+                    break
+                mappings = memo.mappings[concept_id]
+                maps_to_mappings = [
+                    m for m in mappings if m.relationship_id == Relationship.MAPS_TO.value
+                ]
+                # If there is one (or more) Maps to relationship, we are done
+                if maps_to_mappings:
+                    resolved = _Resolved(
+                        concepts=[m.concept_2 for m in maps_to_mappings],
+                        value_as_concept=find_maps_to_value_relationship(mappings),
+                        links=[],
+                    )
+                    results[walk.source_id] = walk.finish(resolved, memo)
+                    break
+                mapping = next(
+                    (m for m in mappings if m.relationship_id in follow_relationships), None
+                )
+                # Dead end, or a cycle of relationships
+                if mapping is None or mapping.concept_id_2 in walk.concept_ids:
+                    results[walk.source_id] = walk.finish(None, memo)
+                    break
+                via = VAL_TO_RELATIONSHIP[mapping.relationship_id]
+                walk.path.append(MapLink(mapping.concept_2, via))
+                walk.concept_ids.append(mapping.concept_id_2)
+
+        missing = {walk.concept_ids[-1] for walk in blocked}
+        if missing:
+            fetched = fetch_mappings(missing)
+            for concept_id in missing:
+                memo.mappings[concept_id] = fetched.get(concept_id, [])
+        walks = blocked
+    return results
+
+
+def _start_walks(concepts: Iterable[ConceptRecord]) -> list[_Walk]:
+    return [
+        _Walk(source_id=c.concept_id, path=[MapLink(c)], concept_ids=[c.concept_id])
+        for c in concepts
+    ]
+
+
 def find_standard_concepts(
-    concept_id: int, session: Session, path: list[MapLink]
+    concept_id: int,
+    session: Session,
+    path: list[MapLink],
+    memo: ResolutionMemo | None = None,
 ) -> NewMap | None:
-    """Search recursively for a standard concept."""
-    mappings = get_mappings(concept_id, session)
-    maps_to_mappings = [m for m in mappings if m.relationship_id == Relationship.MAPS_TO.value]
-
-    # If there is one (or more) Maps to relationship, we are done
-    if maps_to_mappings:
-        target_concepts = [c.concept_2 for c in maps_to_mappings]
-        result = NewMap(concepts=target_concepts, map_path=path)
-        result.value_as_concept = find_maps_to_value_relationship(mappings)
-        return result
-
-    for mapping in mappings:
-        if mapping.relationship_id in {
-            Relationship.REPLACED.value,
-            Relationship.POSS_EQUIVALENT.value,
-            Relationship.SAME_AS.value,
-        }:
-            new_path = path.copy()
-            via = VAL_TO_RELATIONSHIP[mapping.relationship_id]
-            new_path.append(MapLink(mapping.concept_2, via))
-            return find_standard_concepts(mapping.concept_id_2, session, new_path)
-    return None
+    """Search for a standard concept, following one relationship at a time."""
+    start = _Walk(source_id=concept_id, path=path, concept_ids=[concept_id])
+    results = _traverse(
+        [start], lambda ids: {c_id: get_mappings(c_id, session) for c_id in ids}, memo
+    )
+    return results[concept_id]
+
+
+def get_reachable_mappings(
+    concept_ids: Collection[int], session: Session
+) -> dict[int, list[RelationshipRow]]:
+    """
+    Get relationship mappings of all concepts reachable from concept_ids.
+
+    A single recursive query follows 'Concept replaced by', 'Concept
+    poss_eq to' and 'Concept same_as to' relationships from the given
+    concepts, stopping at concepts that have a 'Maps to' relationship.
+    The relationship mappings of every concept that was visited are
+    returned, so the mapping paths can be reconstructed without further
+    queries.
+
+    If the concept_ids do not fit in a single IN-list (see filter_values),
+    there is one recursive query per chunk of concept_ids.
+    """
+    mappings: dict[int, list[RelationshipRow]] = {}
+    with filter_values(Concept.concept_id, concept_ids, session) as clauses:
+        for clause in clauses:
+            chunk_mappings = _group_mappings([_select_reachable_mappings(clause)], session)
+            # Chunks can reach the same concepts
+            for concept_id, concept_mappings in chunk_mappings.items():
+                mappings.setdefault(concept_id, concept_mappings)
+    return mappings
+
+
+def _select_reachable_mappings(start_clause: ColumnElement[bool]) -> Select:
+    maps_to = aliased(ConceptRelationship)
+    follow = aliased(ConceptRelationship)
+    reachable = (
+        select(Concept.concept_id.label("concept_id"))
+        .where(start_clause)
+        .cte("reachable", recursive=True)
+    )
+    reachable = reachable.union(
+        select(follow.concept_id_2)
+        .join(reachable, follow.concept_id_1 == reachable.c.concept_id)
+        .where(
+            and_(
+                follow.relationship_id.in_(Relationship.follow_relationships()),
+                ~exists().where(
+                    and_(
+                        maps_to.concept_id_1 == reachable.c.concept_id,
+                        maps_to.relationship_id == Relationship.MAPS_TO.value,
+                    )
+                ),
+            )
+        )
+    )
+    return _select_mappings().join(
+        reachable, ConceptRelationship.concept_id_1 == reachable.c.concept_id
+    )
+
+
+def find_standard_concepts_batch(
+    concepts: Iterable[ConceptRecord], session: Session, memo: ResolutionMemo | None = None
+) -> dict[int, NewMap | None]:
+    """
+    Search for standard concepts for all given concepts at once.
+
+    The relationship graph is traversed level by level: at each depth,
+    the relationships of all concepts on the current frontier are
+    fetched with a single query. The number of queries therefore
+    depends on the length of the longest relationship chain, not on the
+    number of concepts. Results are identical to those of
+    find_standard_concepts.
+    """
+    return _traverse(_start_walks(concepts), lambda ids: get_mappings_batch(ids, session), memo)
+
+
+def find_standard_concepts_cte(
+    concepts: Iterable[ConceptRecord], session: Session, memo: ResolutionMemo | None = None
+) -> dict[int, NewMap | None]:
+    """
+    Search for standard concepts for all given concepts in one query.
+
+    The graph walk is done by the database with a recursive CTE (see
+    get_reachable_mappings); the mapping paths are then rebuilt from the
+    returned relationships without any further round trips.
+    """
+    walks = _start_walks(concepts)
+    memo = ResolutionMemo() if memo is None else memo
+    unresolved = {w.source_id for w in walks if w.source_id not in memo.resolved}
+    mappings = get_reachable_mappings(unresolved, session) if unresolved else {}
+    return _traverse(walks, lambda _: mappings, memo)
+
+
+def get_resolution_release(session: Session) -> str | None:
+    """Return the vocabulary release the kotobuki_resolution table was built for."""
+    return session.scalars(select(RESOLUTION_RELEASE_TABLE.c.release)).first()
+
+
+def find_standard_concepts_materialized(
+    concepts: Iterable[ConceptRecord], session: Session, memo: ResolutionMemo | None = None
+) -> dict[int, NewMap | None]:
+    """
+    Look up standard concepts in the precomputed kotobuki_resolution table.
+
+    The table only contains non-standard concepts. Standard concepts
+    (e.g. homonyms) are searched for via their relationships instead,
+    which normally takes a single 'Maps to' lookup.
+    """
+    concepts = list(concepts)
+    rows: dict[int, list[tuple[str, str | None, ConceptRecord]]] = defaultdict(list)
+    table = RESOLUTION_TABLE
+    with filter_values(table.c.concept_id, {c.concept_id for c in concepts}, session) as clauses:
+        for clause in clauses:
+            stmt = (
+                select(table.c.concept_id, table.c.kind, table.c.via, *_CONCEPT_COLUMNS)
+                .join(Concept, Concept.concept_id == table.c.target_concept_id)
+                .where(clause)
+                .order_by(table.c.concept_id, table.c.kind, table.c.position)
+            )
+            for concept_id, kind, via, *target in session.execute(stmt):
+                rows[concept_id].append((kind, via, ConceptRecord(*target)))
+
+    results: dict[int, NewMap | None] = {}
+    standard = []
+    for concept in concepts:
+        if concept.concept_id not in rows:
+            results[concept.concept_id] = None
+            if concept.standard_concept == "S":
+                standard.append(concept)
+            continue
+        new_map = NewMap(concepts=[], map_path=[MapLink(concept)])
+        for kind, via, target in rows[concept.concept_id]:
+            if kind == ResolutionKind.PATH.value:
+                new_map.map_path.append(MapLink(target, VAL_TO_RELATIONSHIP[via]))
+            elif kind == ResolutionKind.MAPS_TO.value:
+                new_map.concepts.append(target)
+            else:
+                new_map.value_as_concept.append(target)
+        results[concept.concept_id] = new_map
+    if standard:
+        results.update(find_standard_concepts_batch(standard, session, memo))
+    return results
 
 
 def find_all_homonyms(
-    concept: Concept, case_insensitive: bool, session: Session
-) -> Sequence[Concept]:
-    """Get Concept ORM objects that match the concept_name."""
+    concept: ConceptRecord, case_insensitive: bool, session: Session
+) -> list[ConceptRecord]:
+    """Get the records of all concepts that match the concept_name."""
     if case_insensitive:
-        homonyms = session.scalars(
-            select(Concept).where(
-                and_(
-                    func.lower(Concept.concept_name) == concept.concept_name.lower(),
-                    Concept.concept_id != concept.concept_id,
-                )
-            )
-        ).all()
+        name_clause = func.lower(Concept.concept_name) == concept.concept_name.lower()
     else:
-        homonyms = session.scalars(
-            select(Concept).where(
-                and_(
-                    Concept.concept_name == concept.concept_name,
-                    Concept.concept_id != concept.concept_id,
-                )
-            )
-        ).all()
+        name_clause = Concept.concept_name == concept.concept_name
+    stmt = (
+        select(*_CONCEPT_COLUMNS)
+        .where(and_(name_clause, Concept.concept_id != concept.concept_id))
+        .order_by(Concept.concept_id)
+    )
+    return [ConceptRecord(*row) for row in session.execute(stmt)]
+
+
+def _homonym_name_column(case_insensitive: bool) -> ColumnElement[str]:
+    if case_insensitive:
+        return func.lower(Concept.concept_name, type_=Concept.concept_name.type)
+    return Concept.concept_name
+
+
+def _select_homonyms(name_col: ColumnElement[str]) -> Select:
+    return select(*_CONCEPT_COLUMNS, name_col.label("name_key")).order_by(Concept.concept_id)
+
+
+def find_all_homonyms_batch(
+    concepts: Collection[ConceptRecord], case_insensitive: bool, session: Session
+) -> dict[int, list[ConceptRecord]]:
+    """
+    Get the homonyms of all given concepts with a single query (per IN-list chunk).
+
+    If the session holds a HomonymIndex (see HOMONYM_INDEX_KEY), the
+    candidates are found in memory instead, and only fetched by concept_id.
+    """
+    if not concepts:
+        return {}
+    index = session.info.get(HOMONYM_INDEX_KEY)
+    if index is not None:
+        return _find_indexed_homonyms(concepts, case_insensitive, index, session)
+    name_col = _homonym_name_column(case_insensitive)
+    if case_insensitive:
+        names = {c.concept_name.lower() for c in concepts}
+    else:
+        names = {c.concept_name for c in concepts}
+    by_name: dict[str, list[ConceptRecord]] = defaultdict(list)
+    with filter_values(name_col, names, session) as clauses:
+        for clause in clauses:
+            stmt = _select_homonyms(name_col).where(clause)
+            for *homonym, name_key in session.execute(stmt):
+                by_name[name_key].append(ConceptRecord(*homonym))
+
+    homonyms: dict[int, list[ConceptRecord]] = {}
+    for concept in concepts:
+        key = concept.concept_name.lower() if case_insensitive else concept.concept_name
+        homonyms[concept.concept_id] = [
+            h for h in by_name.get(key, []) if h.concept_id != concept.concept_id
+        ]
+    return homonyms
+
+
+def _find_indexed_homonyms(
+    concepts: Collection[ConceptRecord],
+    case_insensitive: bool,
+    index: HomonymIndex,
+    session: Session,
+) -> dict[int, list[ConceptRecord]]:
+    candidate_ids = index.find_homonym_ids(concepts)
+    lookup = {
+        c.concept_id: c for c in query_concepts(set().union(*candidate_ids.values()), session)
+    }
+    homonyms: dict[int, list[ConceptRecord]] = {}
+    for concept in concepts:
+        candidates = [lookup[c_id] for c_id in candidate_ids[concept.concept_id]]
+        # The index matches more names than the database would (e.g. "ß" and
+        # "ss"), so only keep the candidates found by the equivalent query
+        if case_insensitive:
+            name = concept.concept_name.lower()
+            candidates = [h for h in candidates if h.concept_name.lower() == name]
+        else:
+            candidates = [h for h in candidates if h.concept_name == concept.concept_name]
+        homonyms[concept.concept_id] = candidates
     return homonyms
 
 
+def _maps_to_same_domain(concept: ConceptRecord, new_map: NewMap | None) -> bool:
+    return new_map is not None and any(c.domain_id == concept.domain_id for c in new_map.concepts)
+
+
+def _select_homonym_mapping(concept: ConceptRecord, mappings: Sequence[NewMap]) -> NewMap | None:
+    """Prefer the first mapping to a concept from the same domain, else the first."""
+    same_domain_mappings = [nm for nm in mappings if _maps_to_same_domain(concept, nm)]
+    if same_domain_mappings:
+        return same_domain_mappings[0]
+    if mappings:
+        return mappings[0]
+    return None
+
+
+def _homonym_tiers(
+    concept: ConceptRecord, homonyms: Sequence[ConceptRecord]
+) -> tuple[list[int], list[int]]:
+    """
+    Split homonym positions in those from the same domain and the rest.
+
+    :return: Positions in homonyms of the homonyms with the same
+        domain_id as the concept, and those of the other homonyms, both
+        in their original order.
+    """
+    same_domain = [i for i, h in enumerate(homonyms) if h.domain_id == concept.domain_id]
+    other_domain = [i for i, h in enumerate(homonyms) if h.domain_id != concept.domain_id]
+    return same_domain, other_domain
+
+
 def find_suitable_homonym(
-    homonyms: Sequence[Concept], session: Session, concept: Concept
+    homonyms: Sequence[ConceptRecord],
+    session: Session,
+    concept: ConceptRecord,
+    memo: ResolutionMemo | None = None,
 ) -> NewMap | None:
     """
     Return a new mapping for a homonym that maps to a standard concept.
@@ -96,35 +621,185 @@ def find_suitable_homonym(
     If multiple homonyms map to a standard concept, those that are from
     the same domain as the original concept are prioritized. If there
     are no homonyms, or none map to a standard concept, return None.
+
+    Homonyms from the same domain are evaluated first, and evaluation
+    stops as soon as the selected mapping is known.
     """
     start_path = [MapLink(concept)]
-    mappings: list[NewMap] = []
-    for h in homonyms:
-        path = start_path.copy()
-        path.append(MapLink(h, Relationship.HOMONYM))
-        new_map = find_standard_concepts(h.concept_id, session, path)
-        if new_map is not None:
-            mappings.append(new_map)
-    same_domain_mappings = [
-        nm for nm in mappings if any(c.domain_id == concept.domain_id for c in nm.concepts)
-    ]
-    if same_domain_mappings:
-        return same_domain_mappings[0]
-    if mappings:
-        return mappings[0]
-    return None
+    mappings: dict[int, NewMap | None] = {}
+
+    def resolve(i: int) -> bool:
+        path = [*start_path, MapLink(homonyms[i], Relationship.HOMONYM)]
+        mappings[i] = find_standard_concepts(homonyms[i].concept_id, session, path, memo)
+        return _maps_to_same_domain(concept, mappings[i])
+
+    same_domain, other_domain = _homonym_tiers(concept, homonyms)
+    cutoff = next((i for i in same_domain if resolve(i)), len(homonyms))
+    for i in other_domain:
+        if i >= cutoff or resolve(i):
+            break
+    ordered = [mappings[i] for i in sorted(mappings) if mappings[i] is not None]
+    return _select_homonym_mapping(concept, ordered)
+
+
+def _via_homonym(concept: ConceptRecord, homonym_map: NewMap) -> NewMap:
+    """Prefix the mapping path of a homonym with the original concept."""
+    homonym_link, *rest = homonym_map.map_path
+    return NewMap(
+        concepts=homonym_map.concepts.copy(),
+        value_as_concept=homonym_map.value_as_concept.copy(),
+        map_path=[MapLink(concept), MapLink(homonym_link.concept, Relationship.HOMONYM), *rest],
+    )
+
+
+def find_suitable_homonyms_batch(
+    concepts: Collection[ConceptRecord],
+    case_insensitive: bool,
+    session: Session,
+    mode: ResolutionMode = ResolutionMode.BATCH,
+    memo: ResolutionMemo | None = None,
+) -> dict[int, NewMap | None]:
+    """
+    Batched equivalent of find_all_homonyms and find_suitable_homonym.
+
+    The homonyms of all concepts are fetched with a single query, after
+    which the homonyms are resolved together in two frontiers: first all
+    homonyms from the same domain as their original concept, then only
+    those other homonyms that can still change the selected mapping.
+    """
+    homonyms = find_all_homonyms_batch(concepts, case_insensitive, session)
+    return _select_suitable_homonyms(
+        concepts,
+        homonyms,
+        lambda pending: _find_standard_concepts(pending, session, mode, memo),
+    )
+
+
+def _select_suitable_homonyms(
+    concepts: Collection[ConceptRecord],
+    homonyms: Mapping[int, Sequence[ConceptRecord]],
+    find_standard: Callable[[Iterable[ConceptRecord]], dict[int, NewMap | None]],
+) -> dict[int, NewMap | None]:
+    homonym_maps: dict[int, NewMap | None] = {}
+
+    def resolve(positions: dict[int, list[int]]) -> None:
+        pending = {
+            h.concept_id: h
+            for concept_id, idx in positions.items()
+            for h in (homonyms[concept_id][i] for i in idx)
+            if h.concept_id not in homonym_maps
+        }
+        homonym_maps.update(find_standard(pending.values()))
+
+    tiers = {c.concept_id: _homonym_tiers(c, homonyms[c.concept_id]) for c in concepts}
+    resolve({c_id: same_domain for c_id, (same_domain, _) in tiers.items()})
+
+    evaluated: dict[int, list[int]] = {}
+    remaining: dict[int, list[int]] = {}
+    for concept in concepts:
+        same_domain, other_domain = tiers[concept.concept_id]
+        concept_homonyms = homonyms[concept.concept_id]
+        cutoff = next(
+            (
+                i
+                for i in same_domain
+                if _maps_to_same_domain(concept, homonym_maps[concept_homonyms[i].concept_id])
+            ),
+            len(concept_homonyms),
+        )
+        remaining[concept.concept_id] = [i for i in other_domain if i < cutoff]
+        evaluated[concept.concept_id] = sorted(same_domain + remaining[concept.concept_id])
+    resolve(remaining)
+
+    results: dict[int, NewMap | None] = {}
+    for concept in concepts:
+        concept_homonyms = homonyms[concept.concept_id]
+        mappings = [
+            _via_homonym(concept, homonym_maps[concept_homonyms[i].concept_id])
+            for i in evaluated[concept.concept_id]
+            if homonym_maps[concept_homonyms[i].concept_id] is not None
+        ]
+        results[concept.concept_id] = _select_homonym_mapping(concept, mappings)
+    return results
+
+
+def _find_standard_concepts(
+    concepts: Iterable[ConceptRecord],
+    session: Session,
+    mode: ResolutionMode,
+    memo: ResolutionMemo | None = None,
+) -> dict[int, NewMap | None]:
+    if mode == ResolutionMode.RECURSIVE_CTE:
+        return find_standard_concepts_cte(concepts, session, memo)
+    if mode == ResolutionMode.MATERIALIZED:
+        return find_standard_concepts_materialized(concepts, session, memo)
+    return find_standard_concepts_batch(concepts, session, memo)
+
+
+def find_new_mappings(
+    concepts: Iterable[ConceptRecord],
+    search_homonyms: bool,
+    ignore_case: bool,
+    session: Session,
+    mode: ResolutionMode = ResolutionMode.BATCH,
+) -> dict[int, NewMap | None]:
+    """Batched equivalent of find_new_mapping for many concepts."""
+    concepts = list(concepts)
+    memo = ResolutionMemo()
+    # Try to find standard concepts via concept relationships
+    new_mappings = _find_standard_concepts(concepts, session, mode, memo)
+    # Alternatively via concepts with an identical name
+    if search_homonyms:
+        unresolved = [c for c in concepts if new_mappings[c.concept_id] is None]
+        new_mappings.update(
+            find_suitable_homonyms_batch(unresolved, ignore_case, session, mode, memo)
+        )
+    return new_mappings
+
+
+def resolve_new_mappings(
+    concepts: Iterable[ConceptRecord],
+    search_homonyms: bool,
+    fetch_mappings: Callable[[Collection[int]], Mapping[int, list[RelationshipRow]]],
+    fetch_homonyms: Callable[[Collection[ConceptRecord]], Mapping[int, Sequence[ConceptRecord]]],
+    find_standard: Callable[[Iterable[ConceptRecord]], dict[int, NewMap | None]] | None = None,
+) -> dict[int, NewMap | None]:
+    """
+    Equivalent of find_new_mappings for lookups without a database session.
+
+    :param fetch_mappings: Returns the relationship mappings of the given
+        concept_ids, grouped by concept_id_1 (see get_mappings_batch).
+    :param fetch_homonyms: Returns the homonyms of the given concepts,
+        grouped by concept_id (see find_all_homonyms_batch).
+    :param find_standard: Alternative for traversing the relationships
+        via fetch_mappings (see find_standard_concepts_batch).
+    """
+    concepts = list(concepts)
+    if find_standard is None:
+        memo = ResolutionMemo()
+
+        def find_standard(concepts: Iterable[ConceptRecord]) -> dict[int, NewMap | None]:
+            return _traverse(_start_walks(concepts), fetch_mappings, memo)
+
+    new_mappings = find_standard(concepts)
+    if search_homonyms:
+        unresolved = [c for c in concepts if new_mappings[c.concept_id] is None]
+        homonyms = fetch_homonyms(unresolved)
+        new_mappings.update(_select_suitable_homonyms(unresolved, homonyms, find_standard))
+    return new_mappings
 
 
 def find_new_mapping(
-    concept: Concept,
+    concept: ConceptRecord,
     search_homonyms: bool,
     ignore_case: bool,
     session: Session,
 ) -> NewMap | None:
+    memo = ResolutionMemo()
     # Try to find standard concepts via concept relationships
-    new_map = find_standard_concepts(concept.concept_id, session, [MapLink(concept)])
+    new_map = find_standard_concepts(concept.concept_id, session, [MapLink(concept)], memo)
     # Alternatively via concepts with an identical name
     if search_homonyms and new_map is None:
         homonyms = find_all_homonyms(concept, ignore_case, session)
-        new_map = find_suitable_homonym(homonyms, session, concept)
+        new_map = find_suitable_homonym(homonyms, session, concept, memo)
     return new_map
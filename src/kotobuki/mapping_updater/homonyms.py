@@ -0,0 +1,108 @@
+import json
+import logging
+import unicodedata
+from collections import defaultdict
+from collections.abc import Collection, Iterable
+from pathlib import Path
+
+from omop_cdm.regular.cdm54 import Concept
+from sqlalchemy import select
+from sqlalchemy.orm import Session
+
+from .relationship import ConceptRecord
+
+logger = logging.getLogger(__name__)
+
+# Session.info key of a HomonymIndex to search homonyms with, instead of
+# querying the concept table by name
+HOMONYM_INDEX_KEY = "kotobuki_homonym_index"
+
+HOMONYM_INDEX_FORMAT_VERSION = 1
+
+# Number of concepts fetched per round trip while streaming the concept table
+DEFAULT_YIELD_PER = 100_000
+
+
+def normalize_name(name: str) -> str:
+    """Key of a concept name in the homonym index (NFKC normalized and case folded)."""
+    return unicodedata.normalize("NFKC", name).casefold()
+
+
+class HomonymIndex:
+    """
+    In-memory lookup of concept_ids by normalized concept name.
+
+    Names are normalized with normalize_name, so a lookup finds all
+    concepts whose names only differ in case or Unicode representation.
+    This is a superset of the concepts found by comparing (the lowercase
+    variant of) concept_name in the database, so the candidates are
+    filtered afterwards, to get the same results as the database.
+
+    :param concept_ids_by_name: Sorted concept_ids per normalized name.
+    :param release: Vocabulary release the index was built for.
+    """
+
+    def __init__(self, concept_ids_by_name: dict[str, tuple[int, ...]], release: str | None):
+        self._concept_ids_by_name = concept_ids_by_name
+        self.release = release
+
+    def __len__(self) -> int:
+        return len(self._concept_ids_by_name)
+
+    @classmethod
+    def from_names(cls, names: Iterable[tuple[int, str]], release: str | None) -> "HomonymIndex":
+        """Build the index from (concept_id, concept_name) pairs."""
+        grouped: dict[str, list[int]] = defaultdict(list)
+        for concept_id, name in names:
+            grouped[normalize_name(name)].append(concept_id)
+        return cls({k: tuple(sorted(v)) for k, v in grouped.items()}, release)
+
+    @classmethod
+    def from_database(
+        cls, session: Session, release: str | None, yield_per: int = DEFAULT_YIELD_PER
+    ) -> "HomonymIndex":
+        """
+        Build the index by streaming the concept table.
+
+        Only concept_id and concept_name are fetched, via a server-side
+        cursor where the database supports it, so the full table is
+        never held in memory as ORM objects.
+        """
+        logger.info("Building homonym index...")
+        stmt = select(Concept.concept_id, Concept.concept_name).execution_options(
+            yield_per=yield_per
+        )
+        index = cls.from_names(session.execute(stmt), release)
+        logger.info(f"Homonym index built with {len(index)} distinct names")
+        return index
+
+    @classmethod
+    def load(cls, path: Path) -> "HomonymIndex":
+        """Read an index written by save."""
+        with path.open(encoding="utf8") as f:
+            data = json.load(f)
+        if data["format_version"] != HOMONYM_INDEX_FORMAT_VERSION:
+            raise ValueError(f"Unsupported homonym index format: {data['format_version']}")
+        names = {name: tuple(concept_ids) for name, concept_ids in data["names"].items()}
+        return cls(names, data["release"])
+
+    def save(self, path: Path) -> None:
+        """Write the index to a JSON file."""
+        data = {
+            "format_version": HOMONYM_INDEX_FORMAT_VERSION,
+            "release": self.release,
+            "names": self._concept_ids_by_name,
+        }
+        with path.open("w", encoding="utf8") as f:
+            json.dump(data, f, ensure_ascii=False)
+
+    def lookup(self, name: str) -> tuple[int, ...]:
+        """Return the concept_ids of all concepts with a matching name."""
+        return self._concept_ids_by_name.get(normalize_name(name), ())
+
+    def find_homonym_ids(self, concepts: Collection[ConceptRecord]) -> dict[int, list[int]]:
+        """Return the candidate homonym concept_ids of each concept (excluding itself)."""
+        return {
+            c.concept_id: [c_id for c_id in self.lookup(c.concept_name) if c_id != c.concept_id]
+            for c in concepts
+        }
@@ -0,0 +1,166 @@
+import logging
+import sys
+from collections.abc import Iterable
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+from omop_cdm.constants import VOCAB_SCHEMA
+from omop_cdm.regular.cdm54 import Concept, ConceptRelationship, Vocabulary
+from sqlalchemy import Column, Connection, Engine, MetaData, Table, create_engine
+from sqlalchemy.exc import NoSuchModuleError
+
+from .athena import DEFAULT_CHUNK_ROWS, read_chunks
+from .indexes import recommended_indexes
+
+logger = logging.getLogger(__name__)
+
+# SQLite has no schemas, its default database is called main
+SQLITE_SCHEMA = "main"
+# Any other schema could clash with the catalog DuckDB names after the file (vocab.duckdb)
+DUCKDB_SCHEMA = "main"
+
+_ORM_TABLES = {
+    "CONCEPT.csv": Concept.__table__,
+    "CONCEPT_RELATIONSHIP.csv": ConceptRelationship.__table__,
+    "VOCABULARY.csv": Vocabulary.__table__,
+}
+# VOCABULARY.csv is optional, it only identifies the vocabulary release
+_REQUIRED_FILES = ["CONCEPT.csv", "CONCEPT_RELATIONSHIP.csv"]
+
+
+def _vocabulary_tables() -> dict[str, Table]:
+    """Copies of the vocabulary tables, without foreign keys to other CDM tables.
+
+    The ids come from the files, so the primary keys are not autoincremented (DuckDB has no
+    SERIAL type).
+    """
+    metadata = MetaData()
+    return {
+        file_name: Table(
+            table.name,
+            metadata,
+            *(
+                Column(
+                    c.name,
+                    c.type,
+                    primary_key=c.primary_key,
+                    nullable=c.nullable,
+                    autoincrement=False,
+                )
+                for c in table.columns
+            ),
+            schema=VOCAB_SCHEMA,
+        )
+        for file_name, table in _ORM_TABLES.items()
+    }
+
+
+def _prepare_chunk(chunk: pd.DataFrame, table: Table) -> pd.DataFrame:
+    """Convert dates to ISO format, and empty strings of nullable columns to NULL."""
+    for column in table.columns:
+        if column.name.endswith("_date"):
+            dates = chunk[column.name].str.replace("-", "", regex=False)
+            chunk[column.name] = dates.str[:4] + "-" + dates.str[4:6] + "-" + dates.str[6:]
+        elif column.nullable:
+            chunk[column.name] = chunk[column.name].mask(chunk[column.name] == "", None)
+    # Python objects, which every driver can bind (unlike numpy integers)
+    return chunk.astype(object)
+
+
+def _load_chunks(connection: Connection, table: Table, chunks: Iterable[pd.DataFrame]) -> int:
+    """Bulk load chunks of rows via the driver, bypassing SQLAlchemy per-row overhead."""
+    schema = connection.get_execution_options()["schema_translate_map"][VOCAB_SCHEMA]
+    columns = ", ".join(c.name for c in table.columns)
+    driver_connection = connection.connection.driver_connection
+    n_rows = 0
+    for chunk in chunks:
+        chunk = _prepare_chunk(chunk, table)
+        if connection.dialect.name == "duckdb":
+            # DuckDB scans registered DataFrames directly
+            driver_connection.register("kotobuki_chunk", chunk)
+            driver_connection.execute(
+                f"INSERT INTO {schema}.{table.name} SELECT {columns} FROM kotobuki_chunk"
+            )
+            driver_connection.unregister("kotobuki_chunk")
+        else:
+            placeholders = ", ".join("?" * len(table.columns))
+            driver_connection.executemany(
+                f"INSERT INTO {schema}.{table.name} ({columns}) VALUES ({placeholders})",
+                chunk.itertuples(index=False, name=None),
+            )
+        n_rows += len(chunk)
+    return n_rows
+
+
+def _import_tables(engine: Engine, directory: Path, schema: str, chunk_rows: int) -> None:
+    """Create the vocabulary tables (and indexes) and load the files of the Athena download."""
+    tables = _vocabulary_tables()
+    with engine.begin() as connection:
+        if connection.dialect.name == "sqlite":
+            # The file is removed if the import fails
+            connection.exec_driver_sql("PRAGMA journal_mode = OFF")
+            connection.exec_driver_sql("PRAGMA synchronous = OFF")
+        for file_name, table in tables.items():
+            path = directory / file_name
+            if not path.exists():
+                continue
+            logger.info(f"Loading {file_name}")
+            table.create(connection)
+            columns = [c.name for c in table.columns]
+            dtype = dict.fromkeys(columns, str) | {
+                c.name: np.int64 for c in table.columns if "concept_id" in c.name
+            }
+            n_rows = _load_chunks(connection, table, read_chunks(path, columns, dtype, chunk_rows))
+            logger.info(f"{n_rows} rows loaded")
+
+        logger.info("Creating indexes")
+        concept = tables["CONCEPT.csv"]
+        concept_relationship = tables["CONCEPT_RELATIONSHIP.csv"]
+        for index in recommended_indexes(concept, concept_relationship).values():
+            index.create(connection)
+
+
+def import_athena(
+    directory: Path, output: Path, chunk_rows: int = DEFAULT_CHUNK_ROWS
+) -> tuple[str, str]:
+    """
+    Import an Athena download into a local SQLite or DuckDB database file.
+
+    The CONCEPT, CONCEPT_RELATIONSHIP and (if present) VOCABULARY files
+    are bulk loaded, after which the indexes kotobuki's queries need are
+    created (see recommended_indexes). Files with a .duckdb extension
+    become DuckDB databases (requires the duckdb-engine package), others
+    SQLite databases.
+
+    :param directory: Directory containing the (unzipped) Athena files.
+    :param output: Database file to create.
+    :param chunk_rows: Number of rows loaded at once.
+    :return: Database URL and vocabulary schema to update Usagi files with.
+    """
+    logging.basicConfig(stream=sys.stdout, format="%(message)s", level=logging.INFO)
+    if output.exists():
+        raise FileExistsError(f"{output} already exists")
+    for file_name in _REQUIRED_FILES:
+        if not (directory / file_name).exists():
+            raise FileNotFoundError(f"{directory / file_name} not found")
+    if output.suffix == ".duckdb":
+        url, schema = f"duckdb:///{output.resolve()}", DUCKDB_SCHEMA
+    else:
+        url, schema = f"sqlite:///{output.resolve()}", SQLITE_SCHEMA
+    try:
+        engine = create_engine(url)
+    except NoSuchModuleError as e:
+        raise ValueError("Creating DuckDB databases requires the duckdb-engine package") from e
+    engine = engine.execution_options(schema_translate_map={VOCAB_SCHEMA: schema})
+
+    try:
+        _import_tables(engine, directory, schema, chunk_rows)
+    except BaseException:
+        engine.dispose()
+        output.unlink(missing_ok=True)
+        raise
+    engine.dispose()
+
+    logger.info(f"Use --url {url} --schema {schema} to update Usagi files")
+    return url, schema
@@ -0,0 +1,190 @@
+import logging
+import re
+import sys
+import warnings
+
+from omop_cdm.constants import VOCAB_SCHEMA
+from sqlalchemy import (
+    ClauseElement,
+    Connection,
+    Engine,
+    Executable,
+    Index,
+    MetaData,
+    Table,
+    func,
+    inspect,
+)
+from sqlalchemy.exc import SAWarning
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.compiler import SQLCompiler
+
+from .db import lookup_statements
+
+logger = logging.getLogger(__name__)
+
+_EXPLAIN_PREFIXES = {
+    "sqlite": "EXPLAIN QUERY PLAN",
+}
+
+# Plan lines that read a whole vocabulary table, per dialect
+_SEQUENTIAL_SCAN_PATTERNS = {
+    "sqlite": r"\bSCAN (\w+\.)?(concept|concept_relationship)\b",
+    "duckdb": r"SEQ_SCAN",
+}
+# PostgreSQL plan nodes that read rows of a vocabulary table
+_POSTGRESQL_SCAN_NODE = re.compile(
+    r"\b(Seq Scan|Index Scan|Index Only Scan)\b.* on (\w+\.)?(concept|concept_relationship)\b"
+)
+
+
+class Explain(Executable, ClauseElement):
+    """EXPLAIN a statement, executed like any other (with schema translation)."""
+
+    inherit_cache = False
+
+    def __init__(self, statement: Executable):
+        self.statement = statement
+
+
+def _postgresql_requires_full_scan(plan: str) -> bool:
+    """
+    Whether a PostgreSQL plan reads a vocabulary table without an index condition.
+
+    With sequential scans disabled, the planner reads a whole table via
+    any index (e.g. the primary key) instead, and only filters the rows.
+    Such nodes have a Filter but no Index Cond.
+    """
+    nodes: list[list[str]] = []
+    for line in plan.splitlines():
+        if not nodes or line.lstrip().startswith("->"):
+            nodes.append([])
+        nodes[-1].append(line)
+    return any(
+        _POSTGRESQL_SCAN_NODE.search(node[0])
+        and not any("Index Cond:" in line for line in node[1:])
+        for node in nodes
+    )
+
+
+def requires_full_scan(plan: str, dialect: str) -> bool:
+    """Whether the query plan (see explain_lookups) reads a whole vocabulary table."""
+    if dialect == "postgresql":
+        return _postgresql_requires_full_scan(plan)
+    pattern = _SEQUENTIAL_SCAN_PATTERNS.get(dialect, r"(?i)seq\w* scan")
+    return re.search(pattern, plan) is not None
+
+
+@compiles(Explain)
+def _compile_explain(element: Explain, compiler: SQLCompiler, **kw) -> str:
+    prefix = _EXPLAIN_PREFIXES.get(compiler.dialect.name, "EXPLAIN")
+    return f"{prefix} {compiler.process(element.statement, **kw)}"
+
+
+def recommended_indexes(concept: Table, concept_relationship: Table) -> dict[str, Index]:
+    """
+    Indexes that kotobuki's queries rely on, keyed by the lookup they serve.
+
+    Relationships are always looked up by concept_id_1 and
+    relationship_id. Homonyms are looked up by concept_name, or by its
+    lowercase variant when ignoring case (a functional index). Concepts
+    are looked up by their primary key.
+    """
+    return {
+        "relationships": Index(
+            "idx_concept_relationship_id_1_relationship",
+            concept_relationship.c.concept_id_1,
+            concept_relationship.c.relationship_id,
+        ),
+        "homonyms": Index("idx_concept_concept_name", concept.c.concept_name),
+        "homonyms (ignore case)": Index(
+            "idx_concept_concept_name_lower", func.lower(concept.c.concept_name)
+        ),
+    }
+
+
+def explain_lookups(connection: Connection) -> dict[str, str]:
+    """
+    Return the query plan of each kind of lookup (see db.lookup_statements).
+
+    On PostgreSQL, sequential scans are disabled while explaining, so the
+    plan does not depend on table statistics. A lookup that cannot use
+    an index then reads the whole table via another index, see
+    requires_full_scan.
+    """
+    plans = {}
+    if connection.dialect.name == "postgresql":
+        connection.exec_driver_sql("SET LOCAL enable_seqscan = off")
+    for lookup, statement in lookup_statements(connection.dialect.name).items():
+        rows = connection.execute(Explain(statement)).all()
+        # The plan text is in the last column
+        plans[lookup] = "\n".join(str(row[-1]) for row in rows)
+    # Also reverts the setting
+    connection.rollback()
+    return plans
+
+
+def check_indexes(engine: Engine, vocab_schema: str, create_missing: bool = False) -> bool:
+    """
+    Check whether the vocabulary tables are indexed for kotobuki's lookups.
+
+    Lists the existing indexes of the concept and concept_relationship
+    tables, and runs EXPLAIN on the statements kotobuki issues to find
+    lookups that read a whole table. Optionally, the recommended index of each lookup
+    that reads a whole table is created.
+
+    :param engine: SQLAlchemy engine to connect with.
+    :param vocab_schema: Schema containing the vocabulary tables.
+    :param create_missing: Create the missing indexes.
+    :return: Whether all lookups can use an index (after creating them).
+    """
+    logging.basicConfig(stream=sys.stdout, format="%(message)s", level=logging.INFO)
+    engine = engine.execution_options(schema_translate_map={VOCAB_SCHEMA: vocab_schema})
+    dialect = engine.dialect.name
+
+    with engine.connect() as connection:
+        inspector = inspect(connection)
+        metadata = MetaData()
+        tables = {}
+        with warnings.catch_warnings():
+            # Not all dialects reflect functional indexes, the plans show them anyway
+            warnings.filterwarnings("ignore", "Skipped unsupported reflection", SAWarning)
+            for table_name in ("concept", "concept_relationship"):
+                tables[table_name] = Table(
+                    table_name, metadata, schema=vocab_schema, autoload_with=connection
+                )
+                indexes = [
+                    f"{i['name']} ({', '.join(i.get('expressions') or i['column_names'])})"
+                    for i in inspector.get_indexes(table_name, vocab_schema)
+                ]
+                logger.info(f"Indexes on {table_name}: {', '.join(indexes) or 'none'}")
+
+        missing = [
+            lookup
+            for lookup, plan in explain_lookups(connection).items()
+            if requires_full_scan(plan, dialect)
+        ]
+        if not missing:
+            logger.info("All lookups can use an index 👍")
+            return True
+        for lookup in missing:
+            logger.warning(f"Lookup of {lookup} reads a whole table")
+        if not create_missing:
+            return False
+
+        indexes = recommended_indexes(tables["concept"], tables["concept_relationship"])
+        with connection.begin():
+            for lookup in missing:
+                if lookup not in indexes:
+                    continue
+                logger.info(f"Creating index {indexes[lookup].name}")
+                indexes[lookup].create(connection)
+
+        still_missing = [
+            lookup
+            for lookup, plan in explain_lookups(connection).items()
+            if requires_full_scan(plan, dialect)
+        ]
+        for lookup in still_missing:
+            logger.warning(f"Lookup of {lookup} still reads a whole table")
+        return not still_missing
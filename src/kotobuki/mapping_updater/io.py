@@ -1,15 +1,18 @@
 import csv
 import logging
-from collections.abc import Collection
+import re
+import shutil
+from collections.abc import Callable, Collection, Iterator, Sequence
+from contextlib import ExitStack, contextmanager
 from pathlib import Path
+from tempfile import SpooledTemporaryFile, TemporaryFile
 from time import strftime, time
-from typing import Any
+from typing import Any, TextIO
 
 import pandas as pd
 import yaml
-from omop_cdm.regular.cdm54 import Concept
 
-from .relationship import NewMap
+from .relationship import ConceptRecord, NewMap
 
 logger = logging.getLogger(__name__)
 
@@ -22,8 +25,16 @@ CONCEPT_ID_COLUMNS = {
 
 USAGI_DATE_FORMAT = "%Y%m%d"
 
+# Updated Usagi files are written next to the original as <stem>_<time>.csv
+_OUTPUT_TIME_FORMAT = "%Y-%m-%dT%H%M%S"
+_OUTPUT_FILE_PATTERN = re.compile(r".+_\d{4}-\d{2}-\d{2}T\d{6}\.csv")
 
-def _get_concept_col(header: pd.Index) -> str:
+# Number of characters up to which the contents of an ingested Usagi file
+# are kept in memory, larger files are spooled to a temporary file on disk
+DEFAULT_SPOOL_MAX_SIZE = 4 * 1024 * 1024
+
+
+def _get_concept_col(header: Collection[str]) -> str:
     for col in CONCEPT_ID_COLUMNS:
         if col in header:
             return col
@@ -33,11 +44,16 @@ def _get_concept_col(header: pd.Index) -> str:
     )
 
 
-def get_target_concepts(usagi_file: Path) -> set[int]:
-    """Get set of target concept_ids from an Usagi file."""
-    concept_col = _get_concept_col(pd.read_csv(usagi_file, nrows=0).columns)
-    df = pd.read_csv(usagi_file, usecols=[concept_col], dtype="Int32", index_col=False)
-    df.dropna(inplace=True)
+def get_target_concepts(usagi_file: Path | TextIO) -> set[int]:
+    """Get set of target concept_ids from an Usagi file (or its opened contents)."""
+    df = pd.read_csv(
+        usagi_file,
+        usecols=lambda c: c in CONCEPT_ID_COLUMNS,
+        dtype=dict.fromkeys(CONCEPT_ID_COLUMNS, "Int32"),
+        index_col=False,
+    )
+    concept_col = _get_concept_col(df.columns)
+    df = df[[concept_col]].dropna()
     concept_ids = set(df[concept_col].unique())
     # convert numpy int32 to regular python int
     concept_ids = {n.item() for n in concept_ids}
@@ -46,6 +62,80 @@ def get_target_concepts(usagi_file: Path) -> set[int]:
     return concept_ids
 
 
+class IngestedUsagiFile:
+    """
+    An Usagi file that has been read for its target concept_ids.
+
+    The file is read only once: its contents are copied to a local spool
+    (in memory for small files), from which both the target concept_ids
+    are parsed and the updated file is written. This avoids reading large
+    files multiple times from e.g. a network filesystem. Without a spool,
+    the file itself is read again when writing.
+
+    :param path: Path of the Usagi file.
+    :param concept_ids: Target concept_ids in the file.
+    :param spool: Copy of the contents of the file, or None.
+    """
+
+    def __init__(self, path: Path, concept_ids: set[int], spool: TextIO | None = None):
+        self.path = path
+        self.concept_ids = concept_ids
+        self._spool = spool
+
+    def __enter__(self) -> "IngestedUsagiFile":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def close(self) -> None:
+        """Discard the spooled contents."""
+        if self._spool is not None:
+            self._spool.close()
+            self._spool = None
+
+    @contextmanager
+    def open(self) -> Iterator[TextIO]:
+        """Open the contents of the file for reading, from the spool if available."""
+        if self._spool is None:
+            with self.path.open("r") as f:
+                yield f
+        else:
+            self._spool.seek(0)
+            yield self._spool
+
+
+def ingest_usagi_file(
+    usagi_file: Path, spool: bool = True, spool_max_size: int = DEFAULT_SPOOL_MAX_SIZE
+) -> IngestedUsagiFile:
+    """
+    Read the target concept_ids of an Usagi file, see IngestedUsagiFile.
+
+    :param usagi_file: Usagi exported file (save/review/STCM).
+    :param spool: Keep a copy of the contents to write the updated file from.
+    :param spool_max_size: Number of characters above which the copy is
+        moved from memory to a temporary file. If 0, the copy is written
+        to a temporary file directly.
+    :return: The ingested file, which should be closed after use.
+    """
+    if not spool:
+        return IngestedUsagiFile(usagi_file, get_target_concepts(usagi_file))
+    options = {"mode": "w+", "encoding": "utf8", "newline": ""}
+    with ExitStack() as stack:
+        if spool_max_size > 0:
+            spool_file = stack.enter_context(SpooledTemporaryFile(spool_max_size, **options))
+        else:
+            spool_file = stack.enter_context(TemporaryFile(**options))
+        # Newlines are translated as when reading the file itself
+        with usagi_file.open("r") as f:
+            shutil.copyfileobj(f, spool_file)
+        spool_file.seek(0)
+        concept_ids = get_target_concepts(spool_file)
+        # Only close the spool on errors
+        stack.pop_all()
+    return IngestedUsagiFile(usagi_file, concept_ids, spool_file)
+
+
 def to_int(value: Any) -> int | None:
     """Convert value to int if possible, else return None."""
     try:
@@ -54,117 +144,168 @@ def to_int(value: Any) -> int | None:
         return None
 
 
-def _set_field_values(
-    row: dict[str, str], fields: Collection[str], new_value: str
-) -> dict[str, str]:
-    for field in fields:
-        if field in row:
-            row[field] = new_value
-    return row
-
-
-def update_row(
-    row: dict[str, str],
-    target_concept: Concept,
-    is_new: bool,
-) -> dict[str, str]:
-    """Update all Usagi file fields where applicable."""
-    # The list below is a superset of the fields in Usagi
-    # save/review/STCM files. As these are sometimes manually
-    # added/modified, the code below simply checks for all possible
-    # fields whether they are present in the original Usagi file and
-    # updates values where needed.
-
-    # These fields should only be set when the old mapping is replaced
-    if is_new:
-        row = _set_field_values(row, CONCEPT_ID_COLUMNS, f"{target_concept.concept_id}")
-        row = _set_field_values(row, ["mappingStatus"], "UNCHECKED")
-        row = _set_field_values(row, ["equivalence"], "UNREVIEWED")
-        row = _set_field_values(row, ["statusSetBy", "createdBy"], "UpdateBot")
-        row = _set_field_values(row, ["statusSetOn", "createdOn"], f"{int(time())}")
-
-    fields = ["conceptName", "targetConceptName"]
-    row = _set_field_values(row, fields, f"{target_concept.concept_name}")
-    row = _set_field_values(row, ["domainId", "targetDomainId"], f"{target_concept.domain_id}")
-    fields = ["targetVocabularyId", "target_vocabulary_id"]
-    row = _set_field_values(row, fields, f"{target_concept.vocabulary_id}")
-    sc = target_concept.standard_concept
-    row = _set_field_values(row, ["targetStandardConcept"], f"{'' if sc is None else sc}")
-    row = _set_field_values(row, ["targetChildCount", "targetParentCount"], "")
-    row = _set_field_values(row, ["targetConceptClassId"], f"{target_concept.concept_class_id}")
-    row = _set_field_values(row, ["targetConceptCode"], f"{target_concept.concept_code}")
-    start_date = f"{target_concept.valid_start_date.strftime(USAGI_DATE_FORMAT)}"
-    row = _set_field_values(row, ["targetValidStartDate"], start_date)
-    end_date = f"{target_concept.valid_end_date.strftime(USAGI_DATE_FORMAT)}"
-    row = _set_field_values(row, ["targetValidEndDate"], end_date)
-    ir = target_concept.invalid_reason
-    return _set_field_values(row, ["targetInvalidReason"], f"{'' if ir is None else ir}")
-
-
-def get_new_lines(
-    line: dict[str, str],
-    new_mappings: dict[int, NewMap | None],
-    concept_lookup: dict[int, Concept] | None = None,
-) -> list[dict[str, str]]:
-    """Return updated Usagi file line(s)."""
-    target_concept_id_col = next(col for col in CONCEPT_ID_COLUMNS if col in line)
-    target_concept_id = to_int(line[target_concept_id_col])
-    new_map = new_mappings.get(target_concept_id)
-    new_line = line.copy()
-    new_lines = []
-
-    # Target concept was non-standard; new mappings available
-    if new_map is not None:
-        for concept in new_map.concepts:
-            new_lines.append(update_row(new_line.copy(), concept, is_new=True))
-
-        # If there are also MAPS_TO_VALUE relationships, add more lines
-        if new_map.value_as_concept:
-            for value_concept in new_map.value_as_concept:
-                value_map_line = line.copy()
-                value_map_line["mappingType"] = "MAPS_TO_VALUE"
-                new_lines.append(update_row(value_map_line, value_concept, is_new=True))
-        return new_lines
-
-    # No new mappings; update concept properties if concept_lookup is provided.
-    # It can also be that the target_concept_id doesn't exist in the user's
-    # database, therefore check if concept exists in concept_lookup
-    if concept_lookup is None or target_concept_id not in concept_lookup:
-        return [new_line]
-    up_to_date_concept = concept_lookup[target_concept_id]
-    return [update_row(new_line.copy(), up_to_date_concept, is_new=False)]
+def _format_optional(value: str | None) -> str:
+    return "" if value is None else value
+
+
+# Usagi fields that are only set when the old mapping is replaced, and
+# their new value given the target concept
+_NEW_MAPPING_FIELDS: list[tuple[Collection[str], Callable[[ConceptRecord], str]]] = [
+    (CONCEPT_ID_COLUMNS, lambda c: f"{c.concept_id}"),
+    (["mappingStatus"], lambda c: "UNCHECKED"),
+    (["equivalence"], lambda c: "UNREVIEWED"),
+    (["statusSetBy", "createdBy"], lambda c: "UpdateBot"),
+]
+# Usagi fields set to the time of the update, for replaced mappings
+_TIMESTAMP_FIELDS = ["statusSetOn", "createdOn"]
+# Usagi fields that reflect the properties of the target concept. The
+# fields are a superset of those in Usagi save/review/STCM files, as
+# these are sometimes manually added/modified.
+_CONCEPT_PROPERTY_FIELDS: list[tuple[Collection[str], Callable[[ConceptRecord], str]]] = [
+    (["conceptName", "targetConceptName"], lambda c: f"{c.concept_name}"),
+    (["domainId", "targetDomainId"], lambda c: f"{c.domain_id}"),
+    (["targetVocabularyId", "target_vocabulary_id"], lambda c: f"{c.vocabulary_id}"),
+    (["targetStandardConcept"], lambda c: _format_optional(c.standard_concept)),
+    (["targetChildCount", "targetParentCount"], lambda c: ""),
+    (["targetConceptClassId"], lambda c: f"{c.concept_class_id}"),
+    (["targetConceptCode"], lambda c: f"{c.concept_code}"),
+    (["targetValidStartDate"], lambda c: c.valid_start_date.strftime(USAGI_DATE_FORMAT)),
+    (["targetValidEndDate"], lambda c: c.valid_end_date.strftime(USAGI_DATE_FORMAT)),
+    (["targetInvalidReason"], lambda c: _format_optional(c.invalid_reason)),
+]
+
+
+class ColumnPlan:
+    """
+    Positions of the fields to update in rows of a Usagi file.
+
+    The plan is compiled once from the header, after which rows are
+    updated as lists of values, by position. The updated values only
+    depend on the target concept, so they are formatted once per target
+    concept as a fragment of (position, value) pairs, which is merged
+    into every row that maps to it. Usagi review and STCM files don't
+    contain the mapping type, but it is essential for any MAPS_TO_VALUE
+    relationships, so it is added to the output header if missing.
+
+    :param header: Field names of the Usagi file.
+    :param timestamp: Time of the update (seconds since the epoch) set on
+        replaced mappings. Defaults to the current time.
+    """
+
+    def __init__(self, header: Sequence[str], timestamp: int | None = None):
+        self.header = list(header)
+        self.concept_id_position = self.header.index(_get_concept_col(self.header))
+        if "mappingType" not in self.header:
+            self.header.append("mappingType")
+        self.mapping_type_position = self.header.index("mappingType")
+        timestamp = f"{int(time()) if timestamp is None else timestamp}"
+        self._new_mapping_updates = self._compile(
+            [*_NEW_MAPPING_FIELDS, (_TIMESTAMP_FIELDS, lambda c: timestamp)]
+        )
+        self._property_updates = self._compile(_CONCEPT_PROPERTY_FIELDS)
+        self._fragments: dict[tuple[int, bool], list[tuple[int, str]]] = {}
+
+    def _compile(
+        self, fields: list[tuple[Collection[str], Callable[[ConceptRecord], str]]]
+    ) -> list[tuple[list[int], Callable[[ConceptRecord], str]]]:
+        """Keep the updates of fields that occur in the header, with their positions."""
+        updates = []
+        for names, get_value in fields:
+            positions = [i for i, name in enumerate(self.header) if name in names]
+            if positions:
+                updates.append((positions, get_value))
+        return updates
+
+    def _fragment(self, target_concept: ConceptRecord, is_new: bool) -> list[tuple[int, str]]:
+        key = (target_concept.concept_id, is_new)
+        fragment = self._fragments.get(key)
+        if fragment is None:
+            updates = self._property_updates
+            # These fields should only be set when the old mapping is replaced
+            if is_new:
+                updates = self._new_mapping_updates + updates
+            fragment = [
+                (position, get_value(target_concept))
+                for positions, get_value in updates
+                for position in positions
+            ]
+            self._fragments[key] = fragment
+        return fragment
+
+    def update_row(self, row: list[str], target_concept: ConceptRecord, is_new: bool) -> list[str]:
+        """Return a copy of the row with all applicable fields updated."""
+        new_row = row.copy()
+        for position, value in self._fragment(target_concept, is_new):
+            new_row[position] = value
+        return new_row
+
+    def get_new_rows(
+        self,
+        row: list[str],
+        new_mappings: dict[int, NewMap | None],
+        concept_lookup: dict[int, ConceptRecord] | None = None,
+    ) -> list[list[str]]:
+        """Return the updated row(s) for a row of the Usagi file."""
+        # Short rows (and the added mappingType field) are filled with empty values
+        if len(row) < len(self.header):
+            row = row + [""] * (len(self.header) - len(row))
+        target_concept_id = to_int(row[self.concept_id_position])
+        new_map = new_mappings.get(target_concept_id)
+
+        # Target concept was non-standard; new mappings available
+        if new_map is not None:
+            new_rows = [self.update_row(row, c, is_new=True) for c in new_map.concepts]
+            # If there are also MAPS_TO_VALUE relationships, add more rows
+            if new_map.value_as_concept:
+                value_map_row = row.copy()
+                value_map_row[self.mapping_type_position] = "MAPS_TO_VALUE"
+                for value_concept in new_map.value_as_concept:
+                    new_rows.append(self.update_row(value_map_row, value_concept, is_new=True))
+            return new_rows
+
+        # No new mappings; update concept properties if concept_lookup is provided.
+        # It can also be that the target_concept_id doesn't exist in the user's
+        # database, therefore check if concept exists in concept_lookup
+        if concept_lookup is None or target_concept_id not in concept_lookup:
+            return [row]
+        return [self.update_row(row, concept_lookup[target_concept_id], is_new=False)]
 
 
 def write_usagi_file(
     usagi_file: Path,
     new_mappings: dict[int, NewMap | None],
     overwrite: bool,
-    concept_lookup: dict[int, Concept] | None = None,
+    concept_lookup: dict[int, ConceptRecord] | None = None,
+    timestamp: int | None = None,
+    ingested: IngestedUsagiFile | None = None,
 ):
     out_dir = usagi_file.parent
-    out_file = out_dir / f"{usagi_file.stem}_{strftime('%Y-%m-%dT%H%M%S')}.csv"
-
-    with usagi_file.open("r") as f_in, out_file.open("w") as f_out:
-        reader = csv.DictReader(f_in, delimiter=",")
-        out_header = list(reader.fieldnames)
-        # Usagi review and STCM files don't contain the mapping type,
-        # but it is essential for any MAPS_TO_VALUE relationships.
-        if "mappingType" not in out_header:
-            out_header.append("mappingType")
-        writer = csv.DictWriter(f_out, delimiter=",", fieldnames=out_header)
-        writer.writeheader()
-        for line in reader:
-            new_lines = get_new_lines(line, new_mappings, concept_lookup)
-            for new_line in new_lines:
-                writer.writerow(new_line)
+    out_file = out_dir / f"{usagi_file.stem}_{strftime(_OUTPUT_TIME_FORMAT)}.csv"
+
+    if ingested is None:
+        ingested = IngestedUsagiFile(usagi_file, set())
+    with ingested.open() as f_in, out_file.open("w") as f_out:
+        reader = csv.reader(f_in, delimiter=",")
+        plan = ColumnPlan(next(reader), timestamp)
+        writer = csv.writer(f_out, delimiter=",")
+        writer.writerow(plan.header)
+        for row in reader:
+            # Like csv.DictReader, skip empty lines
+            if row:
+                writer.writerows(plan.get_new_rows(row, new_mappings, concept_lookup))
     if overwrite:
         out_file = out_file.replace(usagi_file)
     logger.info(f"Updated Usagi file available at: {out_file}")
 
 
+def is_updated_usagi_file(path: Path) -> bool:
+    """Whether the file name is that of an updated file written by write_usagi_file."""
+    return _OUTPUT_FILE_PATTERN.fullmatch(path.name) is not None
+
+
 def write_mapping_paths(usagi_file: Path, new_maps: list[NewMap]) -> None:
     out_dir = usagi_file.parent
-    out_file = out_dir / f"{usagi_file.stem}_map_path_{strftime('%Y-%m-%dT%H%M%S')}.yml"
+    out_file = out_dir / f"{usagi_file.stem}_map_path_{strftime(_OUTPUT_TIME_FORMAT)}.yml"
     map_paths_as_dict = {}
     for nm in new_maps:
         map_paths_as_dict.update(nm.to_map_path_data())
@@ -1,16 +1,13 @@
 import logging
-from collections.abc import Sequence
-
-from omop_cdm.regular.cdm54.tables import Concept
+from collections.abc import Collection
 
 from .relationship import NewMap
 
 logger = logging.getLogger(__name__)
 
 
-def log_missing_in_db(found_concepts: Sequence[Concept], all_concept_ids: set[int]) -> None:
-    concept_ids_in_db = {c.concept_id for c in found_concepts}
-    missing_in_db = {c_id for c_id in all_concept_ids if c_id not in concept_ids_in_db}
+def log_missing_in_db(found_concept_ids: Collection[int], all_concept_ids: set[int]) -> None:
+    missing_in_db = {c_id for c_id in all_concept_ids if c_id not in found_concept_ids}
     if missing_in_db:
         logger.warning(
             f"😕 {len(missing_in_db)} concepts could not be found in the "
@@ -0,0 +1,140 @@
+import logging
+import sys
+
+from omop_cdm.constants import VOCAB_SCHEMA
+from omop_cdm.regular.cdm54 import Concept
+from sqlalchemy import Engine, select
+from sqlalchemy.orm import Session
+
+from .db import (
+    RESOLUTION_RELEASE_TABLE,
+    RESOLUTION_TABLE,
+    ResolutionKind,
+    ResolutionMemo,
+    find_standard_concepts_batch,
+    get_vocabulary_release,
+    query_concepts,
+)
+from .relationship import NewMap
+from .values import CHUNK_SIZE_KEY, TEMP_TABLE_THRESHOLD_KEY
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BATCH_SIZE = 10_000
+
+
+def _to_rows(concept_id: int, new_map: NewMap) -> list[dict]:
+    rows = [
+        {
+            "concept_id": concept_id,
+            "kind": ResolutionKind.PATH.value,
+            "position": i,
+            "target_concept_id": link.concept.concept_id,
+            "via": link.via.value,
+        }
+        # The first link is the concept itself
+        for i, link in enumerate(new_map.map_path[1:])
+    ]
+    for kind, concepts in (
+        (ResolutionKind.MAPS_TO, new_map.concepts),
+        (ResolutionKind.MAPS_TO_VALUE, new_map.value_as_concept),
+    ):
+        rows.extend(
+            {
+                "concept_id": concept_id,
+                "kind": kind.value,
+                "position": i,
+                "target_concept_id": c.concept_id,
+                "via": None,
+            }
+            for i, c in enumerate(concepts)
+        )
+    return rows
+
+
+def _prune_memo(
+    memo: ResolutionMemo, new_mappings: dict[int, NewMap | None], shared_ids: set[int]
+) -> None:
+    """
+    Only keep the resolved chains of concepts that other concepts map through.
+
+    Every concept is resolved once, so the other chains are not needed
+    anymore. shared_ids accumulates the concepts found on mapping paths.
+    """
+    for new_map in new_mappings.values():
+        if new_map is not None:
+            # The first link is the concept itself
+            shared_ids.update(link.concept.concept_id for link in new_map.map_path[1:])
+    memo.resolved = {c_id: r for c_id, r in memo.resolved.items() if c_id in shared_ids}
+    # Resolved chains are enough to skip shared tails later on
+    memo.mappings.clear()
+
+
+def build_resolution_table(
+    engine: Engine,
+    vocab_schema: str,
+    batch_size: int = DEFAULT_BATCH_SIZE,
+    chunk_size: int | None = None,
+    temp_table_threshold: int | None = None,
+) -> None:
+    """
+    Precompute the standard concepts of all non-standard concepts.
+
+    The results are written to the kotobuki_resolution table in the
+    vocabulary schema, which is (re)created for the current vocabulary
+    release. Afterwards, Usagi files can be updated with
+    ResolutionMode.MATERIALIZED, which resolves all target concepts with
+    a single indexed join. Homonyms are not precomputed; they are still
+    searched for at update time. Every batch is committed separately;
+    the table is only used once the release is stored at the end.
+
+    :param engine: SQLAlchemy engine to connect with.
+    :param vocab_schema: Schema containing the vocabulary tables.
+    :param batch_size: Number of concepts resolved together.
+    :param chunk_size: Maximum number of values per IN-list in queries.
+    :param temp_table_threshold: Number of values above which they are
+        loaded into a temporary table and joined.
+    :return: None
+    """
+    logging.basicConfig(stream=sys.stdout, format="%(message)s", level=logging.INFO)
+    engine = engine.execution_options(schema_translate_map={VOCAB_SCHEMA: vocab_schema})
+    tables = [RESOLUTION_TABLE, RESOLUTION_RELEASE_TABLE]
+
+    with engine.begin() as connection:
+        RESOLUTION_TABLE.metadata.drop_all(connection, tables=tables)
+        RESOLUTION_TABLE.metadata.create_all(connection, tables=tables)
+
+    session_info = {CHUNK_SIZE_KEY: chunk_size, TEMP_TABLE_THRESHOLD_KEY: temp_table_threshold}
+    with Session(engine, info=session_info) as session:
+        release = get_vocabulary_release(session)
+        concept_ids = session.scalars(
+            select(Concept.concept_id)
+            .where(Concept.standard_concept.is_distinct_from("S"))
+            .order_by(Concept.concept_id)
+        ).all()
+        logger.info(f"Resolving {len(concept_ids)} non-standard concepts")
+
+        # Chains of replaced concepts are shared between batches
+        memo = ResolutionMemo()
+        shared_ids: set[int] = set()
+        n_resolved = 0
+        for i in range(0, len(concept_ids), batch_size):
+            concepts = query_concepts(concept_ids[i : i + batch_size], session)
+            new_mappings = find_standard_concepts_batch(concepts, session, memo)
+            rows = [
+                row
+                for c_id, new_map in new_mappings.items()
+                if new_map is not None
+                for row in _to_rows(c_id, new_map)
+            ]
+            if rows:
+                session.execute(RESOLUTION_TABLE.insert(), rows)
+            # Only the release row marks the table as complete
+            session.commit()
+            n_resolved += sum(nm is not None for nm in new_mappings.values())
+            _prune_memo(memo, new_mappings, shared_ids)
+            logger.info(f"Resolved {min(i + batch_size, len(concept_ids))}/{len(concept_ids)}")
+
+        session.execute(RESOLUTION_RELEASE_TABLE.insert(), {"release": release})
+        session.commit()
+    logger.info(f"Stored standard concepts of {n_resolved} concepts in kotobuki_resolution")
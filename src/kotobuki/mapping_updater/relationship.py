@@ -1,8 +1,7 @@
 from dataclasses import dataclass, field
+from datetime import date
 from enum import Enum
 
-from omop_cdm.regular.cdm54 import Concept
-
 
 class Relationship(Enum):
     MAPS_TO = "Maps to"
@@ -22,20 +21,58 @@ class Relationship(Enum):
             Relationship.MAPS_TO_VALUE.value,
         }
 
+    @staticmethod
+    def follow_relationships() -> set[str]:
+        """Relationships that are followed until a 'Maps to' is found."""
+        return {
+            Relationship.REPLACED.value,
+            Relationship.POSS_EQUIVALENT.value,
+            Relationship.SAME_AS.value,
+        }
+
 
 # Reverse lookup: enum string to enum
 VAL_TO_RELATIONSHIP = {e.value: e for e in Relationship}
 
 
+@dataclass(frozen=True, slots=True)
+class ConceptRecord:
+    """
+    Immutable copy of the concept fields used in mappings and Usagi files.
+
+    Unlike Concept ORM objects, records are not attached to a database
+    session, take little memory and can be pickled.
+    """
+
+    concept_id: int
+    concept_name: str
+    domain_id: str
+    vocabulary_id: str
+    concept_class_id: str
+    standard_concept: str | None
+    concept_code: str
+    valid_start_date: date
+    valid_end_date: date
+    invalid_reason: str | None
+
+    @classmethod
+    def from_concept(cls, concept) -> "ConceptRecord":
+        """Copy the fields of a Concept (or any object with the same attributes)."""
+        return cls(*(getattr(concept, f) for f in CONCEPT_FIELDS))
+
+
+CONCEPT_FIELDS = tuple(ConceptRecord.__dataclass_fields__)
+
+
 @dataclass
 class MapLink:
     """Single link in a mapping path.
 
-    :param concept: Concept mapped to.
+    :param concept: ConceptRecord mapped to.
     :param via: Relationship type that led to the concept, if any.
     """
 
-    concept: Concept
+    concept: ConceptRecord
     via: Relationship | None = None
 
     def __str__(self) -> str:
@@ -47,8 +84,8 @@ class MapLink:
 
 @dataclass
 class NewMap:
-    concepts: list[Concept]
-    value_as_concept: list[Concept] = field(default_factory=list)
+    concepts: list[ConceptRecord]
+    value_as_concept: list[ConceptRecord] = field(default_factory=list)
     map_path: list[MapLink] = field(default_factory=list)
 
     def __repr__(self):
@@ -76,5 +113,5 @@ class NewMap:
         return {_concept_to_str(source_concept): map_properties}
 
 
-def _concept_to_str(c: Concept) -> str:
+def _concept_to_str(c: ConceptRecord) -> str:
     return f"{c.concept_id} {c.concept_name} ({c.vocabulary_id} - {c.domain_id})"
@@ -0,0 +1,354 @@
+import json
+import logging
+import sys
+from bisect import bisect_left, bisect_right
+from collections.abc import Callable, Collection, Iterable, Iterator, Sequence
+from itertools import pairwise
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+from omop_cdm.constants import VOCAB_SCHEMA
+from omop_cdm.regular.cdm54 import Concept, ConceptRelationship
+from sqlalchemy import Engine, Select, select
+from sqlalchemy.orm import Session
+
+from .athena import (
+    CATEGORY_COLUMNS,
+    CONCEPT_COLUMNS,
+    DEFAULT_CHUNK_ROWS,
+    RELATIONSHIP_IDS,
+    concepts_from_chunks,
+    from_date_int,
+    read_concepts,
+    read_relationships,
+    read_release,
+    relationships_from_chunks,
+)
+from .db import RelationshipRow, get_vocabulary_release, resolve_new_mappings
+from .relationship import ConceptRecord, NewMap
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_FORMAT_VERSION = 1
+
+_METADATA_FILE = "metadata.json"
+
+
+def _intern_strings(*columns: pd.Series) -> tuple[list[np.ndarray], np.ndarray, np.ndarray]:
+    """
+    Store the distinct strings of all columns once, in a UTF-8 byte pool.
+
+    :return: Per column the index of each value in the pool, the pool
+        itself and the offsets of the strings in the pool.
+    """
+    indexes, uniques = pd.factorize(pd.concat(columns, ignore_index=True))
+    encoded = [s.encode("utf8") for s in uniques]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(b) for b in encoded], out=offsets[1:])
+    pool = np.frombuffer(b"".join(encoded), dtype=np.uint8)
+    bounds = np.cumsum([0, *(len(c) for c in columns)])
+    indexes = indexes.astype(np.int32)
+    return [indexes[start:end] for start, end in pairwise(bounds)], pool, offsets
+
+
+def _relationship_offsets(
+    positions_1: np.ndarray, positions_2: np.ndarray, codes: np.ndarray, n_concepts: int
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Build CSR-style adjacency arrays, one row of offsets per relationship type.
+
+    The targets of concept p via relationship type t are
+    targets[offsets[t, p] : offsets[t, p + 1]].
+    """
+    # Edges are sorted by concept, so a stable sort keeps that order per type
+    order = np.argsort(codes, kind="stable")
+    codes, positions_1, targets = codes[order], positions_1[order], positions_2[order]
+    offsets = np.empty((len(RELATIONSHIP_IDS), n_concepts + 1), dtype=np.int64)
+    all_positions = np.arange(n_concepts + 1)
+    for code in range(len(RELATIONSHIP_IDS)):
+        start, end = np.searchsorted(codes, [code, code + 1])
+        offsets[code] = start + np.searchsorted(positions_1[start:end], all_positions)
+    return offsets, targets
+
+
+def write_snapshot(
+    target: Path,
+    concepts: pd.DataFrame,
+    relationships: tuple[np.ndarray, np.ndarray, np.ndarray],
+    release: str | None,
+) -> None:
+    """
+    Write a vocabulary snapshot directory.
+
+    Every array is stored as a separate .npy file, so it can be memory
+    mapped by VocabularySnapshot without parsing.
+
+    :param target: Directory to write the snapshot to.
+    :param concepts: Concepts sorted by concept_id, see concepts_from_chunks.
+    :param relationships: See relationships_from_chunks.
+    :param release: Identifier of the vocabulary release.
+    """
+    target.mkdir(parents=True, exist_ok=True)
+    concept_ids = concepts["concept_id"].to_numpy(dtype=np.int64)
+    arrays: dict[str, np.ndarray] = {"concept_id": concept_ids}
+    categories: dict[str, list[str]] = {}
+    for col in CATEGORY_COLUMNS:
+        arrays[col] = concepts[col].cat.codes.to_numpy().astype(np.int16)
+        categories[col] = [str(c) for c in concepts[col].cat.categories]
+    for col in ("valid_start_date", "valid_end_date"):
+        arrays[col] = concepts[col].to_numpy(dtype=np.int32)
+
+    names = concepts["concept_name"]
+    (
+        (arrays["concept_name"], arrays["concept_code"]),
+        arrays["strings"],
+        arrays["string_offsets"],
+    ) = _intern_strings(names, concepts["concept_code"])
+    # Concept positions sorted by (lowercase) name; stable, so ties stay
+    # ordered by concept_id
+    arrays["name_order"] = np.argsort(names.to_numpy(dtype=object), kind="stable").astype(np.int32)
+    arrays["lower_name_order"] = np.argsort(
+        names.str.lower().to_numpy(dtype=object), kind="stable"
+    ).astype(np.int32)
+
+    id_1, id_2, codes = relationships
+    known = np.isin(id_1, concept_ids)
+    positions_1 = np.searchsorted(concept_ids, id_1[known]).astype(np.int32)
+    positions_2 = np.searchsorted(concept_ids, id_2[known]).astype(np.int32)
+    arrays["relationship_offsets"], arrays["relationship_targets"] = _relationship_offsets(
+        positions_1, positions_2, codes[known], len(concept_ids)
+    )
+
+    for name, array in arrays.items():
+        np.save(target / f"{name}.npy", array)
+    metadata = {
+        "format_version": SNAPSHOT_FORMAT_VERSION,
+        "release": release,
+        "relationship_ids": RELATIONSHIP_IDS,
+        "categories": categories,
+    }
+    (target / _METADATA_FILE).write_text(json.dumps(metadata, indent=2), encoding="utf8")
+    logger.info(f"Snapshot of {len(concept_ids)} concepts written to {target}")
+
+
+def build_snapshot_from_athena(
+    directory: Path, target: Path, chunk_rows: int = DEFAULT_CHUNK_ROWS
+) -> None:
+    """
+    Convert an (unzipped) Athena download to a vocabulary snapshot.
+
+    :param directory: Directory containing CONCEPT.csv,
+        CONCEPT_RELATIONSHIP.csv and optionally VOCABULARY.csv.
+    :param target: Directory to write the snapshot to.
+    :param chunk_rows: Number of rows parsed at once.
+    :return: None
+    """
+    logging.basicConfig(stream=sys.stdout, format="%(message)s", level=logging.INFO)
+    concepts = read_concepts(directory / "CONCEPT.csv", chunk_rows)
+    relationships = read_relationships(
+        directory / "CONCEPT_RELATIONSHIP.csv",
+        concepts["concept_id"].to_numpy(),
+        chunk_rows,
+    )
+    write_snapshot(target, concepts, relationships, read_release(directory))
+
+
+def _stream_chunks(stmt: Select, session: Session, chunk_rows: int) -> Iterator[pd.DataFrame]:
+    result = session.execute(stmt, execution_options={"stream_results": True})
+    for rows in result.partitions(chunk_rows):
+        yield pd.DataFrame(rows, columns=list(result.keys()))
+
+
+def build_snapshot_from_database(
+    engine: Engine, vocab_schema: str, target: Path, chunk_rows: int = DEFAULT_CHUNK_ROWS
+) -> None:
+    """
+    Convert the vocabulary tables in a database to a vocabulary snapshot.
+
+    :param engine: SQLAlchemy engine to connect with.
+    :param vocab_schema: Schema containing the vocabulary tables.
+    :param target: Directory to write the snapshot to.
+    :param chunk_rows: Number of rows fetched at once.
+    :return: None
+    """
+    logging.basicConfig(stream=sys.stdout, format="%(message)s", level=logging.INFO)
+    engine = engine.execution_options(schema_translate_map={VOCAB_SCHEMA: vocab_schema})
+    with Session(engine) as session:
+        logger.info("Reading concept table")
+        concepts = concepts_from_chunks(
+            _stream_chunks(
+                select(*(getattr(Concept, c) for c in CONCEPT_COLUMNS)), session, chunk_rows
+            )
+        )
+        logger.info("Reading concept_relationship table")
+        stmt = select(
+            ConceptRelationship.concept_id_1,
+            ConceptRelationship.concept_id_2,
+            ConceptRelationship.relationship_id,
+        ).where(ConceptRelationship.relationship_id.in_(RELATIONSHIP_IDS))
+        relationships = relationships_from_chunks(
+            _stream_chunks(stmt, session, chunk_rows), concepts["concept_id"].to_numpy()
+        )
+        release = get_vocabulary_release(session)
+    write_snapshot(target, concepts, relationships, release)
+
+
+class VocabularySnapshot:
+    """
+    Vocabulary lookups from a snapshot written by write_snapshot.
+
+    All arrays are memory mapped read-only, so opening a snapshot is
+    nearly instant, and processes that open the same snapshot share
+    its pages via the OS page cache. Concept records are only created
+    for concepts that are actually looked up.
+
+    The lookup methods mirror those of AthenaVocabulary.
+
+    :param path: Snapshot directory.
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+        metadata = json.loads((path / _METADATA_FILE).read_text(encoding="utf8"))
+        if metadata["format_version"] != SNAPSHOT_FORMAT_VERSION:
+            raise ValueError(
+                f"Snapshot format version {metadata['format_version']} is not supported, "
+                f"please rebuild the snapshot."
+            )
+        self.release: str | None = metadata["release"]
+        self._relationship_ids: list[str] = metadata["relationship_ids"]
+        self._categories: dict[str, list[str]] = metadata["categories"]
+        self._arrays = {p.stem: np.load(p, mmap_mode="r") for p in path.glob("*.npy")}
+        self._concept_ids = self._arrays["concept_id"]
+        self._concept_cache: dict[int, ConceptRecord] = {}
+
+    def _string(self, index: int) -> str:
+        offsets = self._arrays["string_offsets"]
+        return self._arrays["strings"][offsets[index] : offsets[index + 1]].tobytes().decode()
+
+    def _concept(self, position: int) -> ConceptRecord:
+        concept_id = int(self._concept_ids[position])
+        concept = self._concept_cache.get(concept_id)
+        if concept is None:
+            a = self._arrays
+            concept = ConceptRecord(
+                concept_id=concept_id,
+                concept_name=self._string(a["concept_name"][position]),
+                concept_code=self._string(a["concept_code"][position]),
+                **{
+                    col: self._categories[col][a[col][position]] or None
+                    for col in CATEGORY_COLUMNS
+                },
+                valid_start_date=from_date_int(int(a["valid_start_date"][position])),
+                valid_end_date=from_date_int(int(a["valid_end_date"][position])),
+            )
+            self._concept_cache[concept_id] = concept
+        return concept
+
+    def _positions(self, concept_ids: Iterable[int]) -> Iterator[tuple[int, int]]:
+        """Yield (concept_id, position) of the concept_ids that exist, by concept_id."""
+        concept_ids = np.unique(np.fromiter(concept_ids, dtype=np.int64))
+        positions = np.searchsorted(self._concept_ids, concept_ids)
+        for concept_id, position in zip(concept_ids, positions, strict=True):
+            if position < len(self._concept_ids) and self._concept_ids[position] == concept_id:
+                yield int(concept_id), int(position)
+
+    def query_concepts(self, concept_ids: Collection[int]) -> list[ConceptRecord]:
+        """Get the records of all concept_ids that exist, ordered by concept_id."""
+        return [self._concept(p) for _, p in self._positions(concept_ids)]
+
+    def _mappings(self, concept_id: int, position: int) -> list[RelationshipRow]:
+        offsets = self._arrays["relationship_offsets"]
+        targets = self._arrays["relationship_targets"]
+        # Positions follow concept_id, so this is the order of the database
+        # queries: by concept_id_2, then relationship_id
+        edges = sorted(
+            (int(target), self._relationship_ids[code])
+            for code in range(len(self._relationship_ids))
+            for target in targets[offsets[code, position] : offsets[code, position + 1]]
+        )
+        return [
+            RelationshipRow(
+                concept_id_1=concept_id,
+                concept_id_2=int(self._concept_ids[target]),
+                relationship_id=relationship_id,
+                concept_2=self._concept(target),
+            )
+            for target, relationship_id in edges
+        ]
+
+    def relationship_edges(self) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Return all relationships, see relationships_from_chunks."""
+        offsets = self._arrays["relationship_offsets"]
+        targets = self._arrays["relationship_targets"]
+        n_concepts = len(self._concept_ids)
+        sources = [
+            np.repeat(np.arange(n_concepts), np.diff(offsets[code]))
+            for code in range(len(self._relationship_ids))
+        ]
+        codes = [np.full(len(s), code, dtype=np.int8) for code, s in enumerate(sources)]
+        targets = np.concatenate(
+            [targets[offsets[code, 0] : offsets[code, -1]] for code in range(len(sources))]
+        )
+        id_1 = self._concept_ids[np.concatenate(sources)]
+        id_2 = self._concept_ids[targets]
+        codes = np.concatenate(codes)
+        # Relationship codes follow the order of this snapshot
+        codes = np.array([RELATIONSHIP_IDS.index(r) for r in self._relationship_ids])[codes]
+        order = np.lexsort((codes, id_2, id_1))
+        return id_1[order], id_2[order], codes[order].astype(np.int8)
+
+    def get_mappings(self, concept_id: int) -> list[RelationshipRow]:
+        """Get relationship mappings for a given concept_id."""
+        return self.get_mappings_batch([concept_id]).get(concept_id, [])
+
+    def get_mappings_batch(self, concept_ids: Collection[int]) -> dict[int, list[RelationshipRow]]:
+        """Get relationship mappings for all given concept_ids at once."""
+        mappings = {c_id: self._mappings(c_id, p) for c_id, p in self._positions(concept_ids)}
+        return {c_id: rows for c_id, rows in mappings.items() if rows}
+
+    def find_all_homonyms(
+        self, concept: ConceptRecord, case_insensitive: bool
+    ) -> list[ConceptRecord]:
+        """Get the records of all concepts that match the concept_name."""
+        if case_insensitive:
+            order = self._arrays["lower_name_order"]
+            name = concept.concept_name.lower()
+
+            def key(position: int) -> str:
+                return self._string(self._arrays["concept_name"][position]).lower()
+
+        else:
+            order = self._arrays["name_order"]
+            name = concept.concept_name
+
+            def key(position: int) -> str:
+                return self._string(self._arrays["concept_name"][position])
+
+        start = bisect_left(order, name, key=key)
+        end = bisect_right(order, name, lo=start, key=key)
+        homonyms = (self._concept(int(p)) for p in order[start:end])
+        return [h for h in homonyms if h.concept_id != concept.concept_id]
+
+    def find_all_homonyms_batch(
+        self, concepts: Iterable[ConceptRecord], case_insensitive: bool
+    ) -> dict[int, list[ConceptRecord]]:
+        """Get the homonyms of all given concepts."""
+        return {c.concept_id: self.find_all_homonyms(c, case_insensitive) for c in concepts}
+
+    def find_new_mappings(
+        self,
+        concepts: Sequence[ConceptRecord],
+        search_homonyms: bool,
+        ignore_case: bool,
+        find_standard: Callable[[Iterable[ConceptRecord]], dict[int, NewMap | None]] | None = None,
+    ) -> dict[int, NewMap | None]:
+        """Equivalent of db.find_new_mappings, see resolve_new_mappings."""
+        return resolve_new_mappings(
+            concepts,
+            search_homonyms,
+            self.get_mappings_batch,
+            lambda unresolved: self.find_all_homonyms_batch(unresolved, ignore_case),
+            find_standard,
+        )
@@ -1,19 +1,36 @@
 import logging
+import math
 import sys
+from collections.abc import Callable, Collection, Iterable, Sequence
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
+from functools import partial
 from importlib.metadata import version
 from pathlib import Path
+from time import time
 
 from omop_cdm.constants import VOCAB_SCHEMA
 from sqlalchemy import Engine
+from sqlalchemy.exc import DBAPIError
 from sqlalchemy.orm import Session
+from sqlalchemy.pool import QueuePool
 
+from .athena import AthenaVocabulary
+from .cache import DEFAULT_MAX_ENTRIES, ResolutionCache
 from .db import (
+    ConceptRecord,
     NewMap,
-    find_new_mapping,
-    query_concepts,
+    ResolutionMode,
+    find_new_mappings,
+    get_resolution_release,
+    get_vocabulary_release,
+    stream_concepts,
 )
+from .homonyms import HOMONYM_INDEX_KEY, HomonymIndex
 from .io import (
-    get_target_concepts,
+    DEFAULT_SPOOL_MAX_SIZE,
+    IngestedUsagiFile,
+    ingest_usagi_file,
     write_mapping_paths,
     write_usagi_file,
 )
@@ -21,13 +38,16 @@ from .log import (
     log_missing_in_db,
     log_remapped_concepts,
 )
+from .snapshot import VocabularySnapshot
+from .values import CHUNK_SIZE_KEY, TEMP_TABLE_THRESHOLD_KEY
+from .vectorized import VectorizedResolver
 
 logger = logging.getLogger(__name__)
 
 
 def update_usagi_file(
-    engine: Engine,
-    vocab_schema: str,
+    engine: Engine | None,
+    vocab_schema: str | None,
     usagi_file: Path,
     allow_homonyms: bool = False,
     ignore_case: bool = False,
@@ -35,6 +55,15 @@ def update_usagi_file(
     inspect_only: bool = False,
     overwrite: bool = False,
     update_all: bool = False,
+    resolution_mode: ResolutionMode = ResolutionMode.BATCH,
+    cache_file: Path | None = None,
+    cache_max_entries: int = DEFAULT_MAX_ENTRIES,
+    chunk_size: int | None = None,
+    temp_table_threshold: int | None = None,
+    vocabulary: AthenaVocabulary | VocabularySnapshot | None = None,
+    homonym_index: bool = False,
+    homonym_index_file: Path | None = None,
+    workers: int = 1,
 ):
     """
     Parse an Usagi exported file to update non-standard concepts.
@@ -56,53 +85,424 @@ def update_usagi_file(
     :param update_all: Also update fields of concepts that don't get a
         new mapping, but do have outdated properties (e.g. changed
         domain_id).
+    :param resolution_mode: How to traverse the concept relationships.
+        BATCH issues one query per traversal depth, RECURSIVE_CTE lets
+        the database do the whole traversal in a single recursive query,
+        MATERIALIZED looks up the results in the kotobuki_resolution table
+        (see build_resolution_table), VECTORIZED resolves the whole
+        vocabulary at once (only with an Athena vocabulary or snapshot).
+    :param cache_file: SQLite file in which new mappings are cached
+        between runs. Cached mappings are only used for the vocabulary
+        release they were found with.
+    :param cache_max_entries: Maximum number of concepts kept in the
+        cache file; least recently used entries are evicted first.
+    :param chunk_size: Maximum number of values per IN-list in queries
+        (not used for PostgreSQL, where values are bound as an array).
+        Defaults to a safe value for the database in use.
+    :param temp_table_threshold: Number of values above which they are
+        loaded into a temporary table and joined, instead of being sent
+        as a list of values.
+    :param vocabulary: Look up concepts in an Athena download or a
+        vocabulary snapshot instead of the database (engine and
+        vocab_schema are then not used).
+    :param homonym_index: Search homonyms in an in-memory index of all
+        concept names, built once per run, instead of querying the
+        concept table by name (see HomonymIndex). Useful if the
+        concept_name column is not indexed.
+    :param homonym_index_file: File to load the homonym index from (if
+        it matches the vocabulary release) or save it to. Implies
+        homonym_index.
+    :param workers: Number of threads that resolve the non-standard
+        concepts concurrently, each with its own database session (not
+        used with an Athena vocabulary or snapshot). The engine's
+        connection pool size must be at least workers + 1, otherwise a
+        ValueError is raised.
+    :return: None
+    """
+    update_usagi_files(
+        engine,
+        vocab_schema,
+        [usagi_file],
+        allow_homonyms=allow_homonyms,
+        ignore_case=ignore_case,
+        write_map_paths=write_map_paths,
+        inspect_only=inspect_only,
+        overwrite=overwrite,
+        update_all=update_all,
+        resolution_mode=resolution_mode,
+        cache_file=cache_file,
+        cache_max_entries=cache_max_entries,
+        chunk_size=chunk_size,
+        temp_table_threshold=temp_table_threshold,
+        vocabulary=vocabulary,
+        homonym_index=homonym_index,
+        homonym_index_file=homonym_index_file,
+        workers=workers,
+    )
+
+
+def update_usagi_files(
+    engine: Engine | None,
+    vocab_schema: str | None,
+    usagi_files: Sequence[Path],
+    allow_homonyms: bool = False,
+    ignore_case: bool = False,
+    write_map_paths: bool = False,
+    inspect_only: bool = False,
+    overwrite: bool = False,
+    update_all: bool = False,
+    resolution_mode: ResolutionMode = ResolutionMode.BATCH,
+    cache_file: Path | None = None,
+    cache_max_entries: int = DEFAULT_MAX_ENTRIES,
+    chunk_size: int | None = None,
+    temp_table_threshold: int | None = None,
+    vocabulary: AthenaVocabulary | VocabularySnapshot | None = None,
+    homonym_index: bool = False,
+    homonym_index_file: Path | None = None,
+    workers: int = 1,
+):
+    """
+    Parse multiple Usagi exported files to update non-standard concepts.
+
+    The target concepts of all files are looked up and resolved together
+    in a single database session, after which each file is updated with
+    the shared results. See update_usagi_file for the other parameters.
+
+    :param usagi_files: Usagi exported files (save/review/STCM).
     :return: None
     """
+    if vocabulary is None and workers > 1:
+        _check_pool_size(engine, workers + 1)
+
+    with ExitStack() as stack:
+        concept_ids, update_files = _prepare_update(
+            usagi_files,
+            stack,
+            allow_homonyms=allow_homonyms,
+            ignore_case=ignore_case,
+            write_map_paths=write_map_paths,
+            inspect_only=inspect_only,
+            overwrite=overwrite,
+            update_all=update_all,
+            cache_file=cache_file,
+            cache_max_entries=cache_max_entries,
+        )
+        if not concept_ids:
+            return
+
+        if vocabulary is not None:
+            find_standard = None
+            if resolution_mode == ResolutionMode.VECTORIZED:
+                logger.info("Resolving all concept relationships in the vocabulary...")
+                find_standard = VectorizedResolver(vocabulary).resolve
+            update_files(
+                vocabulary.query_concepts(concept_ids),
+                lambda concepts: vocabulary.find_new_mappings(
+                    concepts, allow_homonyms, ignore_case, find_standard
+                ),
+                lambda: vocabulary.release,
+            )
+            return
+        if resolution_mode == ResolutionMode.VECTORIZED:
+            raise ValueError("The vectorized mode requires an Athena vocabulary or snapshot.")
+
+        engine = engine.execution_options(schema_translate_map={VOCAB_SCHEMA: vocab_schema})
+
+        with Session(engine) as session, session.begin():
+            _prepare_session(
+                session,
+                chunk_size=chunk_size,
+                temp_table_threshold=temp_table_threshold,
+                resolution_mode=resolution_mode,
+                allow_homonyms=allow_homonyms,
+                homonym_index=homonym_index,
+                homonym_index_file=homonym_index_file,
+            )
+            find_mappings = partial(
+                find_new_mappings,
+                search_homonyms=allow_homonyms,
+                ignore_case=ignore_case,
+                session=session,
+                mode=resolution_mode,
+            )
+            if workers > 1:
+                find_in_session = partial(
+                    _find_new_mappings_in_session,
+                    engine=engine,
+                    session_info=dict(session.info),
+                    allow_homonyms=allow_homonyms,
+                    ignore_case=ignore_case,
+                    resolution_mode=resolution_mode,
+                )
+                find_mappings = partial(
+                    _find_new_mappings_concurrently, find_mappings=find_in_session, workers=workers
+                )
+            update_files(
+                stream_concepts(concept_ids, session),
+                find_mappings,
+                lambda: get_vocabulary_release(session),
+            )
+
+
+def _prepare_update(
+    usagi_files: Sequence[Path],
+    stack: ExitStack,
+    allow_homonyms: bool,
+    ignore_case: bool,
+    write_map_paths: bool,
+    inspect_only: bool,
+    overwrite: bool,
+    update_all: bool,
+    cache_file: Path | None,
+    cache_max_entries: int,
+) -> tuple[set[int], Callable[..., None]]:
+    """
+    Check the options and ingest the Usagi files, for update_usagi_files and its async variant.
+
+    :return: The target concept_ids of all files, and _update_files bound
+        to the ingested files (which are closed with the stack) and options.
+    """
     logging.basicConfig(stream=sys.stdout, format="%(message)s", level=logging.INFO)
     logger.info(f"Running kotobuki v{version('kotobuki')}")
 
     if inspect_only and overwrite:
         raise ValueError("inspect_only and overwrite cannot both be True.")
 
-    logging.info(f"Parsing Usagi save file {usagi_file.name}")
-    concept_ids = get_target_concepts(usagi_file)
-    logging.info(f"{len(concept_ids)} distinct target concepts found in file")
-    if not concept_ids:
-        return
+    # Each file is read once, and only spooled if it is written afterwards
+    ingested_files = _ingest_usagi_files(usagi_files, not inspect_only, stack)
+    concept_ids = set().union(*(f.concept_ids for f in ingested_files.values()))
+    update_files = partial(
+        _update_files,
+        ingested_files,
+        write_map_paths=write_map_paths,
+        inspect_only=inspect_only,
+        overwrite=overwrite,
+        update_all=update_all,
+        cache_file=cache_file,
+        cache_options=f"allow_homonyms={allow_homonyms},ignore_case={ignore_case}",
+        cache_max_entries=cache_max_entries,
+    )
+    return concept_ids, update_files
 
-    engine = engine.execution_options(schema_translate_map={VOCAB_SCHEMA: vocab_schema})
 
-    with Session(engine) as session, session.begin():
-        concepts = query_concepts(concept_ids, session)
-        log_missing_in_db(found_concepts=concepts, all_concept_ids=concept_ids)
+def _prepare_session(
+    session: Session,
+    chunk_size: int | None,
+    temp_table_threshold: int | None,
+    resolution_mode: ResolutionMode,
+    allow_homonyms: bool,
+    homonym_index: bool,
+    homonym_index_file: Path | None,
+) -> None:
+    """
+    Configure the session the concepts are looked up in, before any query.
 
-        non_standard = {c for c in concepts if c.standard_concept != "S"}
-        if not non_standard:
-            logger.info("All target concepts are already standard 😍")
-            if not update_all:
-                return
-        else:
-            logger.info(f"{len(non_standard)} target concepts are non-standard")
+    The configuration is kept in the session info, which is copied to the
+    sessions of concurrent workers.
+    """
+    session.info[CHUNK_SIZE_KEY] = chunk_size
+    session.info[TEMP_TABLE_THRESHOLD_KEY] = temp_table_threshold
+    if resolution_mode == ResolutionMode.MATERIALIZED:
+        _check_resolution_release(session)
+    if allow_homonyms and (homonym_index or homonym_index_file is not None):
+        session.info[HOMONYM_INDEX_KEY] = _get_homonym_index(session, homonym_index_file)
 
-        new_mappings: dict[int, NewMap | None] = {c.concept_id: None for c in non_standard}
 
-        logger.info("Querying database for standard concepts...")
-        for concept in non_standard:
-            new_map = find_new_mapping(concept, allow_homonyms, ignore_case, session)
-            new_mappings[concept.concept_id] = new_map
-        log_remapped_concepts(new_mappings)
+def _ingest_usagi_files(
+    usagi_files: Sequence[Path], spool: bool, stack: ExitStack
+) -> dict[Path, IngestedUsagiFile]:
+    """
+    Ingest all Usagi files, which are closed with the stack.
+
+    With multiple files, all spools exist at the same time, so they are
+    written to disk instead of being kept in memory.
+    """
+    spool_max_size = DEFAULT_SPOOL_MAX_SIZE if len(usagi_files) == 1 else 0
+    ingested_files: dict[Path, IngestedUsagiFile] = {}
+    for usagi_file in usagi_files:
+        logging.info(f"Parsing Usagi save file {usagi_file.name}")
+        ingested_files[usagi_file] = stack.enter_context(
+            ingest_usagi_file(usagi_file, spool, spool_max_size)
+        )
+        logging.info(
+            f"{len(ingested_files[usagi_file].concept_ids)} distinct target concepts found in file"
+        )
+    if len(usagi_files) > 1:
+        concept_ids = set().union(*(f.concept_ids for f in ingested_files.values()))
+        logging.info(f"{len(concept_ids)} distinct target concepts found in all files")
+    return ingested_files
+
+
+def _find_new_mappings_in_session(
+    concepts: Sequence[ConceptRecord],
+    engine: Engine,
+    session_info: dict,
+    allow_homonyms: bool,
+    ignore_case: bool,
+    resolution_mode: ResolutionMode,
+) -> dict[int, NewMap | None]:
+    with Session(engine, info=session_info) as session, session.begin():
+        return find_new_mappings(concepts, allow_homonyms, ignore_case, session, resolution_mode)
+
+
+def _find_new_mappings_concurrently(
+    concepts: Collection[ConceptRecord],
+    find_mappings: Callable[[Sequence[ConceptRecord]], dict[int, NewMap | None]],
+    workers: int,
+) -> dict[int, NewMap | None]:
+    """
+    Resolve partitions of the concepts in a thread pool.
+
+    Concepts are partitioned by concept_id, and the results are merged
+    in the order of the given concepts, so they do not depend on the
+    number of workers or the order in which the partitions finish.
+    """
+    partitions = _partition_concepts(concepts, math.ceil(len(concepts) / workers))
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="kotobuki") as executor:
+        return _merge_results(concepts, executor.map(find_mappings, partitions))
+
+
+def _partition_concepts(
+    concepts: Collection[ConceptRecord], size: int
+) -> list[list[ConceptRecord]]:
+    """Split the concepts, ordered by concept_id, in partitions of at most size concepts."""
+    ordered = sorted(concepts, key=lambda c: c.concept_id)
+    return [ordered[i : i + size] for i in range(0, len(ordered), max(size, 1))]
+
+
+def _merge_results(
+    concepts: Collection[ConceptRecord], partition_results: Iterable[dict[int, NewMap | None]]
+) -> dict[int, NewMap | None]:
+    """Merge the results of all partitions, in the order of the given concepts."""
+    results = {}
+    for r in partition_results:
+        results.update(r)
+    return {c.concept_id: results[c.concept_id] for c in concepts}
 
-        if write_map_paths:
-            logger.info("Writing mapping paths file")
-            new_maps = [nm for nm in new_mappings.values() if nm is not None]
-            write_mapping_paths(usagi_file, new_maps)
 
-        if inspect_only:
+def _update_files(
+    ingested_files: dict[Path, IngestedUsagiFile],
+    concepts: Iterable[ConceptRecord],
+    find_mappings: Callable[[Collection[ConceptRecord]], dict[int, NewMap | None]],
+    get_release: Callable[[], str | None],
+    write_map_paths: bool,
+    inspect_only: bool,
+    overwrite: bool,
+    update_all: bool,
+    cache_file: Path | None,
+    cache_options: str,
+    cache_max_entries: int,
+) -> None:
+    """
+    Resolve the non-standard concepts, and write the results per Usagi file.
+
+    The concepts are consumed once, and only those needed afterwards are
+    kept: the non-standard concepts, and with update_all the others too.
+    """
+    concept_ids = set().union(*(f.concept_ids for f in ingested_files.values()))
+    found_concept_ids = set()
+    non_standard = []
+    concept_lookup = {} if update_all else None
+    for concept in concepts:
+        found_concept_ids.add(concept.concept_id)
+        if concept.standard_concept != "S":
+            non_standard.append(concept)
+        if concept_lookup is not None:
+            concept_lookup[concept.concept_id] = concept
+    log_missing_in_db(found_concept_ids=found_concept_ids, all_concept_ids=concept_ids)
+
+    if not non_standard:
+        logger.info("All target concepts are already standard 😍")
+        if not update_all:
             return
+    else:
+        logger.info(f"{len(non_standard)} target concepts are non-standard")
+
+    if cache_file is None:
+        logger.info("Querying database for standard concepts...")
+        new_mappings: dict[int, NewMap | None] = find_mappings(non_standard)
+    else:
+        release = get_release()
+        if release is None:
+            raise ValueError("Caching requires the vocabulary release (VOCABULARY.csv).")
+        with ResolutionCache(cache_file, release, cache_options, cache_max_entries) as cache:
+            new_mappings = cache.get_many({c.concept_id for c in non_standard})
+            uncached = [c for c in non_standard if c.concept_id not in new_mappings]
+            logger.info(f"{len(new_mappings)} target concepts found in cache")
+            if uncached:
+                logger.info("Querying database for standard concepts...")
+                found = find_mappings(uncached)
+                cache.put_many(found)
+                new_mappings.update(found)
+    log_remapped_concepts(new_mappings)
+
+    # All files of a run get the same update time
+    timestamp = int(time())
+    for usagi_file, ingested in ingested_files.items():
+        # Each spool is discarded as soon as its file is written
+        with ingested:
+            if not ingested.concept_ids:
+                continue
+            if write_map_paths:
+                logger.info(f"Writing mapping paths file for {usagi_file.name}")
+                new_maps = [
+                    nm
+                    for c_id, nm in new_mappings.items()
+                    if nm is not None and c_id in ingested.concept_ids
+                ]
+                write_mapping_paths(usagi_file, new_maps)
+
+            if inspect_only:
+                continue
+
+            logger.info(f"Writing updated Usagi file for {usagi_file.name}")
+            write_usagi_file(
+                usagi_file, new_mappings, overwrite, concept_lookup, timestamp, ingested
+            )
+
+
+def _get_homonym_index(session: Session, path: Path | None) -> HomonymIndex:
+    """Load the homonym index from path if it is up to date, else build (and save) it."""
+    release = get_vocabulary_release(session)
+    if path is not None and path.exists():
+        index = HomonymIndex.load(path)
+        if index.release == release:
+            logger.info(f"Homonym index loaded from {path.name}")
+            return index
+        logger.info("Homonym index was built for a different vocabulary release")
+    index = HomonymIndex.from_database(session, release)
+    if path is not None:
+        index.save(path)
+    return index
+
+
+def _check_pool_size(engine: Engine, connections: int) -> None:
+    """Make sure the connection pool of the engine keeps the given number of connections."""
+    pool = engine.pool
+    # Overflow connections are closed as soon as they are returned, so only
+    # the pool size counts
+    if isinstance(pool, QueuePool) and pool.size() < connections:
+        raise ValueError(
+            f"The connection pool of the engine keeps {pool.size()} connections, "
+            f"{connections} are needed (one per worker, and one for the main session). "
+            f"Create the engine with e.g. pool_size={connections}."
+        )
+
 
-        logger.info("Writing updated Usagi file")
-        if update_all:
-            concept_lookup = {c.concept_id: c for c in concepts}
-            write_usagi_file(usagi_file, new_mappings, overwrite, concept_lookup)
-        else:
-            write_usagi_file(usagi_file, new_mappings, overwrite)
+def _check_resolution_release(session: Session) -> None:
+    """Make sure the kotobuki_resolution table matches the vocabulary release."""
+    try:
+        with session.begin_nested():
+            release = get_resolution_release(session)
+    except DBAPIError:
+        release = None
+    if release is None:
+        raise ValueError(
+            "The kotobuki_resolution table has not been built yet, "
+            "run 'kotobuki build-resolution-table' first."
+        )
+    if release != get_vocabulary_release(session):
+        raise ValueError(
+            "The kotobuki_resolution table was built for a different vocabulary "
+            "release, run 'kotobuki build-resolution-table' to rebuild it."
+        )
@@ -0,0 +1,197 @@
+import asyncio
+import logging
+import math
+from collections.abc import Collection, Sequence
+from contextlib import ExitStack
+from functools import partial
+from pathlib import Path
+
+from omop_cdm.constants import VOCAB_SCHEMA
+from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession
+
+from .cache import DEFAULT_MAX_ENTRIES
+from .db import (
+    ConceptRecord,
+    NewMap,
+    ResolutionMode,
+    find_new_mappings,
+    get_vocabulary_release,
+    query_concepts,
+)
+from .update_usagi import (
+    _merge_results,
+    _partition_concepts,
+    _prepare_session,
+    _prepare_update,
+)
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MAX_CONCURRENCY = 4
+# Maximum number of concepts resolved per session
+DEFAULT_PARTITION_SIZE = 1000
+
+
+async def update_usagi_file_async(
+    engine: AsyncEngine,
+    vocab_schema: str,
+    usagi_file: Path,
+    allow_homonyms: bool = False,
+    ignore_case: bool = False,
+    write_map_paths: bool = False,
+    inspect_only: bool = False,
+    overwrite: bool = False,
+    update_all: bool = False,
+    resolution_mode: ResolutionMode = ResolutionMode.BATCH,
+    cache_file: Path | None = None,
+    cache_max_entries: int = DEFAULT_MAX_ENTRIES,
+    chunk_size: int | None = None,
+    temp_table_threshold: int | None = None,
+    homonym_index: bool = False,
+    homonym_index_file: Path | None = None,
+    max_concurrency: int = DEFAULT_MAX_CONCURRENCY,
+):
+    """
+    Asynchronous equivalent of update_usagi_file, for an AsyncEngine.
+
+    See update_usagi_file for the parameters. Requires the asyncio extra
+    of SQLAlchemy and an async database driver (e.g. asyncpg, aiosqlite).
+
+    :param max_concurrency: Maximum number of database sessions that
+        resolve concepts at the same time.
+    :return: None
+    """
+    await update_usagi_files_async(
+        engine,
+        vocab_schema,
+        [usagi_file],
+        allow_homonyms=allow_homonyms,
+        ignore_case=ignore_case,
+        write_map_paths=write_map_paths,
+        inspect_only=inspect_only,
+        overwrite=overwrite,
+        update_all=update_all,
+        resolution_mode=resolution_mode,
+        cache_file=cache_file,
+        cache_max_entries=cache_max_entries,
+        chunk_size=chunk_size,
+        temp_table_threshold=temp_table_threshold,
+        homonym_index=homonym_index,
+        homonym_index_file=homonym_index_file,
+        max_concurrency=max_concurrency,
+    )
+
+
+async def update_usagi_files_async(
+    engine: AsyncEngine,
+    vocab_schema: str,
+    usagi_files: Sequence[Path],
+    allow_homonyms: bool = False,
+    ignore_case: bool = False,
+    write_map_paths: bool = False,
+    inspect_only: bool = False,
+    overwrite: bool = False,
+    update_all: bool = False,
+    resolution_mode: ResolutionMode = ResolutionMode.BATCH,
+    cache_file: Path | None = None,
+    cache_max_entries: int = DEFAULT_MAX_ENTRIES,
+    chunk_size: int | None = None,
+    temp_table_threshold: int | None = None,
+    homonym_index: bool = False,
+    homonym_index_file: Path | None = None,
+    max_concurrency: int = DEFAULT_MAX_CONCURRENCY,
+):
+    """
+    Asynchronous equivalent of update_usagi_files, for an AsyncEngine.
+
+    Reading and writing the Usagi files happens in a separate thread,
+    so the event loop is never blocked. The non-standard concepts are
+    split in partitions, which are resolved concurrently in their own
+    session; a semaphore limits the number of sessions in use to
+    max_concurrency. Results and output files are the same as those of
+    update_usagi_files.
+
+    :param usagi_files: Usagi exported files (save/review/STCM).
+    :param max_concurrency: Maximum number of database sessions that
+        resolve concepts at the same time.
+    :return: None
+    """
+    if resolution_mode == ResolutionMode.VECTORIZED:
+        raise ValueError("The vectorized mode requires an Athena vocabulary or snapshot.")
+
+    with ExitStack() as stack:
+        concept_ids, update_files = await asyncio.to_thread(
+            _prepare_update,
+            usagi_files,
+            stack,
+            allow_homonyms=allow_homonyms,
+            ignore_case=ignore_case,
+            write_map_paths=write_map_paths,
+            inspect_only=inspect_only,
+            overwrite=overwrite,
+            update_all=update_all,
+            cache_file=cache_file,
+            cache_max_entries=cache_max_entries,
+        )
+        if not concept_ids:
+            return
+
+        engine = engine.execution_options(schema_translate_map={VOCAB_SCHEMA: vocab_schema})
+        loop = asyncio.get_running_loop()
+
+        async with AsyncSession(engine) as session, session.begin():
+            await session.run_sync(
+                _prepare_session,
+                chunk_size=chunk_size,
+                temp_table_threshold=temp_table_threshold,
+                resolution_mode=resolution_mode,
+                allow_homonyms=allow_homonyms,
+                homonym_index=homonym_index,
+                homonym_index_file=homonym_index_file,
+            )
+            concepts = await session.run_sync(lambda s: query_concepts(concept_ids, s))
+            resolve = partial(
+                _find_new_mappings_async,
+                engine=engine,
+                session_info=dict(session.info),
+                max_concurrency=max_concurrency,
+                allow_homonyms=allow_homonyms,
+                ignore_case=ignore_case,
+                resolution_mode=resolution_mode,
+            )
+
+            # _update_files runs in a thread, from which the lookups are
+            # scheduled back on the event loop
+            def find_mappings(concepts: Collection[ConceptRecord]) -> dict[int, NewMap | None]:
+                return asyncio.run_coroutine_threadsafe(resolve(concepts), loop).result()
+
+            def get_release() -> str:
+                coroutine = session.run_sync(get_vocabulary_release)
+                return asyncio.run_coroutine_threadsafe(coroutine, loop).result()
+
+            await asyncio.to_thread(update_files, concepts, find_mappings, get_release)
+
+
+async def _find_new_mappings_async(
+    concepts: Collection[ConceptRecord],
+    engine: AsyncEngine,
+    session_info: dict,
+    max_concurrency: int,
+    allow_homonyms: bool,
+    ignore_case: bool,
+    resolution_mode: ResolutionMode,
+) -> dict[int, NewMap | None]:
+    """Resolve partitions of the concepts concurrently, see _find_new_mappings_concurrently."""
+    semaphore = asyncio.Semaphore(max_concurrency)
+    size = min(DEFAULT_PARTITION_SIZE, math.ceil(len(concepts) / max_concurrency))
+
+    async def resolve(partition: list[ConceptRecord]) -> dict[int, NewMap | None]:
+        async with semaphore, AsyncSession(engine, info=session_info) as session, session.begin():
+            return await session.run_sync(
+                lambda s: find_new_mappings(
+                    partition, allow_homonyms, ignore_case, s, resolution_mode
+                )
+            )
+
+    partitions = _partition_concepts(concepts, size)
+    return _merge_results(concepts, await asyncio.gather(*map(resolve, partitions)))
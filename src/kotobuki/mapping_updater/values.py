@@ -0,0 +1,106 @@
+import csv
+import io
+from collections.abc import Collection, Iterator
+from contextlib import contextmanager
+from uuid import uuid4
+
+from sqlalchemy import Column, ColumnElement, MetaData, Table, any_, literal, select, text
+from sqlalchemy.dialects.postgresql import ARRAY
+from sqlalchemy.orm import Session
+
+# Session.info key to override the number of values per IN-list
+CHUNK_SIZE_KEY = "kotobuki_chunk_size"
+# Session.info key to override the number of values above which they
+# are loaded into a temporary table
+TEMP_TABLE_THRESHOLD_KEY = "kotobuki_temp_table_threshold"
+
+# Bound parameter limits: SQLite (before 3.32) allows 999 parameters per
+# statement, SQL Server 2100 and Oracle 1000 items per IN-list.
+DEFAULT_CHUNK_SIZES = {
+    "sqlite": 900,
+    "mssql": 2000,
+}
+DEFAULT_CHUNK_SIZE = 1000
+DEFAULT_TEMP_TABLE_THRESHOLD = 50_000
+
+
+@contextmanager
+def filter_values(
+    column: ColumnElement, values: Collection, session: Session
+) -> Iterator[list[ColumnElement[bool]]]:
+    """
+    Yield filter clauses that together select column IN values.
+
+    Large sets of values (see TEMP_TABLE_THRESHOLD_KEY) are bulk loaded
+    into a temporary table, which is semi-joined via a subquery and
+    dropped on exit. This lets the database use hash/merge joins and
+    indexes instead of parsing a literal list.
+
+    Otherwise, on PostgreSQL all values are bound as a single array
+    parameter (column = ANY(:array)), which is not subject to parameter
+    limits and keeps the statement text identical regardless of the
+    number of values. Other databases get one IN-list per chunk of
+    values, the size of which can be set via CHUNK_SIZE_KEY.
+    """
+    values = list(values)
+    if not values:
+        yield []
+        return
+
+    threshold = session.info.get(TEMP_TABLE_THRESHOLD_KEY) or DEFAULT_TEMP_TABLE_THRESHOLD
+    if len(values) > threshold:
+        with _temp_values_table(column, values, session) as table:
+            yield [column.in_(select(table.c.value))]
+        return
+
+    dialect = session.get_bind().dialect.name
+    if dialect == "postgresql":
+        yield [in_values(column, values, dialect)]
+        return
+    size = session.info.get(CHUNK_SIZE_KEY) or DEFAULT_CHUNK_SIZES.get(dialect, DEFAULT_CHUNK_SIZE)
+    yield [in_values(column, values[i : i + size], dialect) for i in range(0, len(values), size)]
+
+
+def in_values(column: ColumnElement, values: list, dialect: str) -> ColumnElement[bool]:
+    """Select column IN values, in the form filter_values uses for the dialect."""
+    if dialect == "postgresql":
+        return column == any_(literal(values, ARRAY(column.type)))
+    return column.in_(values)
+
+
+@contextmanager
+def _temp_values_table(column: ColumnElement, values: list, session: Session) -> Iterator[Table]:
+    """Create a temporary table holding the distinct values, and drop it afterwards."""
+    table = Table(
+        f"kotobuki_values_{uuid4().hex[:12]}",
+        MetaData(),
+        Column("value", column.type, primary_key=True),
+        prefixes=["TEMPORARY"],
+    )
+    connection = session.connection()
+    table.create(connection)
+    try:
+        _bulk_load(table, set(values), session)
+        yield table
+    finally:
+        table.drop(connection)
+
+
+def _bulk_load(table: Table, values: set, session: Session) -> None:
+    """Load values into a single column table, via COPY if available."""
+    connection = session.connection()
+    if connection.dialect.name == "postgresql":
+        driver_connection = connection.connection.driver_connection
+        cursor = driver_connection.cursor()
+        # COPY is only supported via the psycopg2 driver API
+        if hasattr(cursor, "copy_expert"):
+            buffer = io.StringIO()
+            csv.writer(buffer).writerows([v] for v in values)
+            buffer.seek(0)
+            cursor.copy_expert(f"COPY {table.name} (value) FROM STDIN WITH (FORMAT csv)", buffer)
+            cursor.close()
+            # Temporary tables are not analyzed automatically
+            connection.execute(text(f"ANALYZE {table.name}"))
+            return
+        cursor.close()
+    connection.execute(table.insert(), [{"value": v} for v in values])
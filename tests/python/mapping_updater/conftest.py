@@ -6,10 +6,12 @@ from pathlib import Path
 import pytest
 import yaml
 from omop_cdm.constants import VOCAB_SCHEMA
-from sqlalchemy import Connection, Engine, create_engine, text
+from sqlalchemy import Connection, Engine, create_engine, event, text
 from sqlalchemy.sql.ddl import CreateSchema, DropSchema
 from testcontainers.postgres import PostgresContainer
 
+from kotobuki.mapping_updater.importer import import_athena
+
 POSTGRES_IMAGE = "postgres:16-alpine"
 SCHEMA_MAP: dict[str, str] = {VOCAB_SCHEMA: "vocab"}
 
@@ -30,6 +32,13 @@ def pg_db_engine() -> Iterator[Engine]:
         yield engine
 
 
+@pytest.fixture(scope="session")
+def sqlite_db_engine(tmp_path_factory: pytest.TempPathFactory) -> Engine:
+    """SQLite database with the vocabulary test data, created with import_athena."""
+    url, schema = import_athena(VOCAB_DATA_DIR, tmp_path_factory.mktemp("sqlite") / "vocab.sqlite")
+    return create_engine(url).execution_options(schema_translate_map={VOCAB_SCHEMA: schema})
+
+
 def create_schemas(schemas: set[str], conn: Connection) -> None:
     for schema in schemas:
         conn.execute(CreateSchema(schema, if_not_exists=True))
@@ -79,6 +88,21 @@ def load_relationship_test_data(engine: Engine) -> None:
             connection.close()
 
 
+@contextmanager
+def count_queries(engine: Engine) -> Iterator[list[str]]:
+    """Collect all SQL statements executed via the engine."""
+    statements: list[str] = []
+
+    def before_cursor_execute(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    event.listen(engine, "before_cursor_execute", before_cursor_execute)
+    try:
+        yield statements
+    finally:
+        event.remove(engine, "before_cursor_execute", before_cursor_execute)
+
+
 def write_tmp_usagi_file(tmp_path: Path, original_usagi_file: Path) -> Path:
     tmp_usagi_file = tmp_path / original_usagi_file.name
     shutil.copyfile(original_usagi_file, tmp_usagi_file)
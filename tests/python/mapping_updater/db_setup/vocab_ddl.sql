@@ -21,6 +21,14 @@ CREATE TABLE vocab.CONCEPT_RELATIONSHIP (
                                             valid_end_date date NOT NULL,
                                             invalid_reason varchar(1) NULL );
 
+CREATE TABLE vocab.VOCABULARY (
+                                  vocabulary_id varchar(20) NOT NULL,
+                                  vocabulary_name varchar(255) NOT NULL,
+                                  vocabulary_reference varchar(255) NULL,
+                                  vocabulary_version varchar(255) NULL,
+                                  vocabulary_concept_id integer NOT NULL );
+
 ALTER TABLE vocab.CONCEPT ADD CONSTRAINT xpk_CONCEPT PRIMARY KEY (concept_id);
 ALTER TABLE vocab.concept_relationship ADD CONSTRAINT xpk_concept_relationship
     PRIMARY KEY (concept_id_1, concept_id_2, relationship_id);
+ALTER TABLE vocab.VOCABULARY ADD CONSTRAINT xpk_VOCABULARY PRIMARY KEY (vocabulary_id);
@@ -0,0 +1,104 @@
+import re
+from pathlib import Path
+
+import pytest
+from click.testing import CliRunner
+from omop_cdm.regular.cdm54 import Concept
+from sqlalchemy import Engine, select
+from sqlalchemy.orm import Session
+
+from kotobuki import update_usagi_file
+from kotobuki.mapping_updater.athena import AthenaVocabulary
+from kotobuki.mapping_updater.cli import _update_usagi_cli
+from kotobuki.mapping_updater.db import (
+    find_all_homonyms,
+    find_new_mappings,
+    get_mappings,
+    get_vocabulary_release,
+)
+from tests.python.mapping_updater.conftest import (
+    USAGI_STCM_FILE,
+    VOCAB_DATA_DIR,
+    write_tmp_usagi_file,
+)
+
+pytestmark = pytest.mark.usefixtures("create_vocab_tables")
+
+
+@pytest.fixture(scope="module")
+def vocabulary() -> AthenaVocabulary:
+    # Small chunks, to cover combining them
+    return AthenaVocabulary(VOCAB_DATA_DIR, chunk_rows=4)
+
+
+def _values(concept: Concept) -> tuple:
+    return tuple(getattr(concept, col.key) for col in Concept.__table__.columns)
+
+
+def test_lookups_match_database(pg_db_engine: Engine, vocabulary: AthenaVocabulary):
+    with Session(pg_db_engine) as session:
+        concepts = session.scalars(select(Concept).order_by(Concept.concept_id)).all()
+        assert vocabulary.release == get_vocabulary_release(session)
+        found = vocabulary.query_concepts([-1, *(c.concept_id for c in concepts)])
+        assert [_values(c) for c in found] == [_values(c) for c in concepts]
+
+        for concept in concepts:
+            assert [
+                (m.concept_id_2, m.relationship_id, _values(m.concept_2))
+                for m in vocabulary.get_mappings(concept.concept_id)
+            ] == [
+                (m.concept_id_2, m.relationship_id, _values(m.concept_2))
+                for m in get_mappings(concept.concept_id, session)
+            ]
+            for case_insensitive in (False, True):
+                homonyms = vocabulary.find_all_homonyms(concept, case_insensitive)
+                expected = find_all_homonyms(concept, case_insensitive, session)
+                assert [h.concept_id for h in homonyms] == [h.concept_id for h in expected]
+
+
+@pytest.mark.parametrize("search_homonyms", [False, True])
+def test_new_mappings_match_database(
+    pg_db_engine: Engine, vocabulary: AthenaVocabulary, search_homonyms: bool
+):
+    with Session(pg_db_engine) as session:
+        concepts = session.scalars(select(Concept).where(Concept.standard_concept.is_(None)))
+        concepts = list(concepts)
+        expected = find_new_mappings(concepts, search_homonyms, True, session)
+    new_mappings = vocabulary.find_new_mappings(
+        vocabulary.query_concepts([c.concept_id for c in concepts]), search_homonyms, True
+    )
+    assert {c_id: nm and nm.to_map_path_data() for c_id, nm in new_mappings.items()} == {
+        c_id: nm and nm.to_map_path_data() for c_id, nm in expected.items()
+    }
+
+
+def test_update_usagi_file_offline(tmp_path: Path, pg_db_engine: Engine):
+    tmp_usagi_file = write_tmp_usagi_file(tmp_path, USAGI_STCM_FILE)
+    update_usagi_file(pg_db_engine, "vocab", tmp_usagi_file, overwrite=True)
+    expected = tmp_usagi_file.read_text(encoding="utf8")
+
+    # Athena downloads have dates formatted as YYYYMMDD
+    athena_dir = tmp_path / "athena"
+    athena_dir.mkdir()
+    for vocab_file in VOCAB_DATA_DIR.glob("*.csv"):
+        text = vocab_file.read_text(encoding="utf8")
+        text = re.sub(r"(\d{4})-(\d{2})-(\d{2})", r"\1\2\3", text)
+        (athena_dir / vocab_file.name).write_text(text, encoding="utf8")
+
+    tmp_usagi_file = write_tmp_usagi_file(tmp_path, USAGI_STCM_FILE)
+    vocabulary = AthenaVocabulary(athena_dir)
+    update_usagi_file(None, None, tmp_usagi_file, overwrite=True, vocabulary=vocabulary)
+    assert tmp_usagi_file.read_text(encoding="utf8") == expected
+
+
+@pytest.mark.parametrize(
+    "options",
+    [["--resolver", "materialized"], ["--workers", "2"], ["--chunk-size", "10"]],
+)
+def test_database_options_are_rejected(tmp_path: Path, options: list[str]):
+    tmp_usagi_file = write_tmp_usagi_file(tmp_path, USAGI_STCM_FILE)
+    args = ["--athena-dir", str(VOCAB_DATA_DIR), "--usagi-file", str(tmp_usagi_file), *options]
+    result = CliRunner().invoke(_update_usagi_cli, args)
+    assert result.exit_code == 2
+    assert options[0] in result.output
+    assert "can only be used with --url and --schema" in result.output
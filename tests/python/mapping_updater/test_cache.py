@@ -0,0 +1,77 @@
+from pathlib import Path
+
+import pytest
+from sqlalchemy import Engine
+
+from kotobuki.mapping_updater.cache import (
+    ResolutionCache,
+    deserialize_new_map,
+    serialize_new_map,
+)
+from kotobuki.mapping_updater.relationship import MapLink, NewMap, Relationship
+from kotobuki.mapping_updater.update_usagi import update_usagi_file
+from tests.python.mapping_updater.conftest import (
+    USAGI_STCM_FILE,
+    count_queries,
+    write_tmp_usagi_file,
+)
+from tests.python.mapping_updater.test_mapping_paths import (
+    HOMONYM_CONCEPT1,
+    SOURCE_CONCEPT1,
+    TARGET_CONCEPT1,
+    VALUE_CONCEPT1,
+)
+
+NEW_MAP = NewMap(
+    concepts=[TARGET_CONCEPT1],
+    value_as_concept=[VALUE_CONCEPT1],
+    map_path=[
+        MapLink(concept=SOURCE_CONCEPT1),
+        MapLink(concept=HOMONYM_CONCEPT1, via=Relationship.HOMONYM),
+    ],
+)
+
+
+def test_serialization_round_trip():
+    new_map = deserialize_new_map(serialize_new_map(NEW_MAP))
+    assert new_map.to_map_path_data() == NEW_MAP.to_map_path_data()
+    assert deserialize_new_map(serialize_new_map(None)) is None
+
+
+def test_cache_invalidated_by_new_release(tmp_path: Path):
+    cache_file = tmp_path / "cache.sqlite"
+    with ResolutionCache(cache_file, release="v1") as cache:
+        cache.put_many({2: NEW_MAP, 4: None})
+        assert cache.get_many([2, 4, 5]).keys() == {2, 4}
+    with ResolutionCache(cache_file, release="v1", options="homonyms") as cache:
+        assert cache.get_many([2, 4]) == {}
+    with ResolutionCache(cache_file, release="v2") as cache:
+        assert cache.get_many([2, 4]) == {}
+    with ResolutionCache(cache_file, release="v1") as cache:
+        assert cache.get_many([2, 4]) == {}
+
+
+def test_cache_evicts_least_recently_used(tmp_path: Path):
+    with ResolutionCache(tmp_path / "cache.sqlite", release="v1", max_entries=2) as cache:
+        cache.put_many({1: None, 2: None})
+        cache.get_many([1])
+        cache.put_many({3: None})
+        assert cache.get_many([1, 2, 3]).keys() == {1, 3}
+
+
+@pytest.mark.usefixtures("create_vocab_tables")
+def test_warm_run_uses_cache(tmp_path: Path, pg_db_engine: Engine):
+    cache_file = tmp_path / "cache.sqlite"
+    tmp_usagi_file = write_tmp_usagi_file(tmp_path, USAGI_STCM_FILE)
+    update_usagi_file(pg_db_engine, "vocab", tmp_usagi_file, overwrite=True)
+    expected = tmp_usagi_file.read_text(encoding="utf8")
+
+    for _ in range(2):
+        tmp_usagi_file = write_tmp_usagi_file(tmp_path, USAGI_STCM_FILE)
+        with count_queries(pg_db_engine) as statements:
+            update_usagi_file(
+                pg_db_engine, "vocab", tmp_usagi_file, overwrite=True, cache_file=cache_file
+            )
+        assert tmp_usagi_file.read_text(encoding="utf8") == expected
+    # The warm run only looks up the concepts and the vocabulary release
+    assert not [s for s in statements if "concept_relationship" in s]
@@ -1,7 +1,23 @@
+from pathlib import Path
+
 import pytest
 from sqlalchemy import Engine
+from sqlalchemy.orm import Session
 
-from tests.python.mapping_updater.test_usagi_mappings import get_new_map
+from kotobuki import update_usagi_file
+from kotobuki.mapping_updater.db import (
+    find_all_homonyms,
+    find_all_homonyms_batch,
+    find_suitable_homonym,
+    find_suitable_homonyms_batch,
+)
+from kotobuki.mapping_updater.homonyms import HOMONYM_INDEX_KEY, HomonymIndex, normalize_name
+from tests.python.mapping_updater.conftest import (
+    USAGI_STCM_FILE,
+    count_queries,
+    write_tmp_usagi_file,
+)
+from tests.python.mapping_updater.test_usagi_mappings import get_concept_by_id, get_new_map
 
 pytestmark = pytest.mark.usefixtures("create_vocab_tables")
 
@@ -50,3 +66,86 @@ def test_ignore_case_false(pg_db_engine: Engine):
         ignore_case=False,
     )
     assert result is None
+
+
+@pytest.mark.parametrize("ignore_case", [False, True])
+def test_batch_homonym_search_matches_single(pg_db_engine: Engine, ignore_case: bool):
+    """All homonyms are fetched with a single query and resolved together."""
+    concept_ids = [4, 5, 19, 21]
+    with Session(pg_db_engine) as session, session.begin():
+        concepts = [get_concept_by_id(session, c_id) for c_id in concept_ids]
+        with count_queries(pg_db_engine) as statements:
+            results = find_suitable_homonyms_batch(concepts, ignore_case, session)
+        # One homonym query, and one traversal depth per homonym tier
+        assert len(statements) == (3 if ignore_case else 2)
+        for concept in concepts:
+            homonyms = find_all_homonyms(concept, ignore_case, session)
+            single = find_suitable_homonym(homonyms, session, concept)
+            batch = results[concept.concept_id]
+            if single is None:
+                assert batch is None
+                continue
+            assert batch.concepts == single.concepts
+            assert batch.to_map_path_data() == single.to_map_path_data()
+
+
+def test_homonym_search_stops_when_selection_is_known(pg_db_engine: Engine):
+    """
+    Concept 21 has four case-insensitive homonyms (22, 23, 24, 25). Homonym 24 is
+    from the same domain and is evaluated first; after that only 22 and 23 can still
+    take precedence, so 25 is never resolved.
+    """
+    with Session(pg_db_engine) as session, session.begin():
+        concept = get_concept_by_id(session, 21)
+        homonyms = find_all_homonyms(concept, True, session)
+        assert [h.concept_id for h in homonyms] == [22, 23, 24, 25]
+        with count_queries(pg_db_engine) as statements:
+            result = find_suitable_homonym(homonyms, session, concept)
+        assert len(statements) == 3
+        assert result.concepts[0].concept_id == 24
+
+
+@pytest.mark.parametrize("ignore_case", [False, True])
+def test_homonym_index_matches_database(pg_db_engine: Engine, ignore_case: bool):
+    concept_ids = [4, 5, 19, 21]
+    with Session(pg_db_engine) as session, session.begin():
+        concepts = [get_concept_by_id(session, c_id) for c_id in concept_ids]
+        expected = find_all_homonyms_batch(concepts, ignore_case, session)
+        session.info[HOMONYM_INDEX_KEY] = HomonymIndex.from_database(session, release=None)
+        with count_queries(pg_db_engine) as statements:
+            homonyms = find_all_homonyms_batch(concepts, ignore_case, session)
+        # Only a lookup of the homonyms by concept_id
+        assert len(statements) == 1
+        for concept_id in concept_ids:
+            assert [h.concept_id for h in homonyms[concept_id]] == [
+                h.concept_id for h in expected[concept_id]
+            ]
+
+
+@pytest.mark.parametrize("ignore_case", [False, True])
+def test_homonym_index_candidates_are_filtered(pg_db_engine: Engine, ignore_case: bool):
+    with Session(pg_db_engine) as session, session.begin():
+        concept = get_concept_by_id(session, 19)
+        expected = find_all_homonyms_batch([concept], ignore_case, session)
+        # An index that also lists concept 4, whose name is different
+        index = HomonymIndex({normalize_name(concept.concept_name): (4, 19, 20)}, release=None)
+        session.info[HOMONYM_INDEX_KEY] = index
+        homonyms = find_all_homonyms_batch([concept], ignore_case, session)
+        assert [h.concept_id for h in homonyms[19]] == [h.concept_id for h in expected[19]]
+
+
+def test_homonym_index_file_is_reused(tmp_path: Path, pg_db_engine: Engine):
+    index_file = tmp_path / "homonyms.json"
+    expected_file = write_tmp_usagi_file(tmp_path, USAGI_STCM_FILE)
+    update_usagi_file(pg_db_engine, "vocab", expected_file, allow_homonyms=True, overwrite=True)
+
+    (tmp_path / "indexed").mkdir()
+    usagi_file = write_tmp_usagi_file(tmp_path / "indexed", USAGI_STCM_FILE)
+    options = {"allow_homonyms": True, "homonym_index_file": index_file}
+    update_usagi_file(pg_db_engine, "vocab", usagi_file, inspect_only=True, **options)
+    assert index_file.exists()
+    with count_queries(pg_db_engine) as statements:
+        update_usagi_file(pg_db_engine, "vocab", usagi_file, overwrite=True, **options)
+    # The concept table is not streamed again
+    assert not any("concept_name" in s and "WHERE" not in s for s in statements)
+    assert usagi_file.read_text() == expected_file.read_text()
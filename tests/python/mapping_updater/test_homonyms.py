@@ -0,0 +1,10 @@
+from kotobuki.mapping_updater.homonyms import HomonymIndex
+
+
+def test_homonym_index_normalizes_names():
+    index = HomonymIndex.from_names(
+        [(3, "Straße"), (1, "STRASSE"), (2, "Cafe\u0301"), (4, "CAFÉ")], release=None
+    )
+    assert index.lookup("strasse") == (1, 3)
+    assert index.lookup("café") == (2, 4)
+    assert index.lookup("asdf") == ()
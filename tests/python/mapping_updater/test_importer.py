@@ -0,0 +1,87 @@
+import shutil
+from importlib.util import find_spec
+from pathlib import Path
+
+import pytest
+from sqlalchemy import Engine, create_engine
+
+from kotobuki import update_usagi_file
+from kotobuki.mapping_updater.importer import import_athena
+from tests.python.mapping_updater.conftest import (
+    USAGI_STCM_FILE,
+    VOCAB_DATA_DIR,
+    write_tmp_usagi_file,
+)
+
+DATABASE_SUFFIXES = [
+    ".sqlite",
+    pytest.param(
+        ".duckdb",
+        marks=pytest.mark.skipif(
+            find_spec("duckdb_engine") is None, reason="duckdb-engine is not installed"
+        ),
+    ),
+]
+
+
+def test_import_creates_indexes(tmp_path: Path):
+    url, _ = import_athena(VOCAB_DATA_DIR, tmp_path / "vocab.sqlite", chunk_rows=4)
+    with create_engine(url).connect() as connection:
+        indexes = connection.exec_driver_sql(
+            "SELECT tbl_name, sql FROM sqlite_master WHERE name LIKE 'idx_%'"
+        ).all()
+    assert sorted(indexes) == [
+        ("concept", "CREATE INDEX idx_concept_concept_name ON concept (concept_name)"),
+        (
+            "concept",
+            "CREATE INDEX idx_concept_concept_name_lower ON concept (lower(concept_name))",
+        ),
+        (
+            "concept_relationship",
+            "CREATE INDEX idx_concept_relationship_id_1_relationship "
+            "ON concept_relationship (concept_id_1, relationship_id)",
+        ),
+    ]
+    with pytest.raises(FileExistsError):
+        import_athena(VOCAB_DATA_DIR, tmp_path / "vocab.sqlite")
+
+
+@pytest.mark.usefixtures("create_vocab_tables")
+def test_missing_file_creates_no_database(tmp_path: Path):
+    athena_dir = tmp_path / "athena"
+    athena_dir.mkdir()
+    shutil.copy(VOCAB_DATA_DIR / "CONCEPT.csv", athena_dir)
+    with pytest.raises(FileNotFoundError, match=r"CONCEPT_RELATIONSHIP\.csv"):
+        import_athena(athena_dir, tmp_path / "vocab.sqlite")
+    assert not (tmp_path / "vocab.sqlite").exists()
+
+
+@pytest.mark.parametrize("suffix", DATABASE_SUFFIXES)
+def test_failed_import_removes_database(tmp_path: Path, suffix: str):
+    athena_dir = tmp_path / "athena"
+    shutil.copytree(VOCAB_DATA_DIR, athena_dir)
+    relationships = (athena_dir / "CONCEPT_RELATIONSHIP.csv").read_text()
+    (athena_dir / "CONCEPT_RELATIONSHIP.csv").write_text("concept_id_1\n1\n")
+    with pytest.raises(ValueError, match="Usecols do not match columns"):
+        import_athena(athena_dir, tmp_path / f"vocab{suffix}")
+    assert not (tmp_path / f"vocab{suffix}").exists()
+
+    # So the import can be retried
+    (athena_dir / "CONCEPT_RELATIONSHIP.csv").write_text(relationships)
+    import_athena(athena_dir, tmp_path / f"vocab{suffix}")
+
+
+@pytest.mark.parametrize("suffix", DATABASE_SUFFIXES)
+def test_update_usagi_file_with_imported_database(
+    tmp_path: Path, pg_db_engine: Engine, suffix: str
+):
+    tmp_usagi_file = write_tmp_usagi_file(tmp_path, USAGI_STCM_FILE)
+    update_usagi_file(pg_db_engine, "vocab", tmp_usagi_file, overwrite=True, allow_homonyms=True)
+    expected = tmp_usagi_file.read_text(encoding="utf8")
+
+    url, schema = import_athena(VOCAB_DATA_DIR, tmp_path / f"vocab{suffix}", chunk_rows=4)
+    tmp_usagi_file = write_tmp_usagi_file(tmp_path, USAGI_STCM_FILE)
+    update_usagi_file(
+        create_engine(url), schema, tmp_usagi_file, overwrite=True, allow_homonyms=True
+    )
+    assert tmp_usagi_file.read_text(encoding="utf8") == expected
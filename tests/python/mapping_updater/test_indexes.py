@@ -0,0 +1,52 @@
+from pathlib import Path
+
+import pytest
+from omop_cdm.constants import VOCAB_SCHEMA
+from sqlalchemy import Engine, create_engine
+
+from kotobuki.mapping_updater.importer import import_athena
+from kotobuki.mapping_updater.indexes import check_indexes, explain_lookups
+from tests.python.mapping_updater.conftest import VOCAB_DATA_DIR
+
+INDEX_NAMES = [
+    "idx_concept_relationship_id_1_relationship",
+    "idx_concept_concept_name",
+    "idx_concept_concept_name_lower",
+]
+
+
+def test_check_and_create_indexes(tmp_path: Path):
+    url, schema = import_athena(VOCAB_DATA_DIR, tmp_path / "vocab.sqlite")
+    engine = create_engine(url)
+    with engine.begin() as connection:
+        for name in INDEX_NAMES[1:]:
+            connection.exec_driver_sql(f"DROP INDEX {name}")
+
+    assert not check_indexes(engine, schema)
+    vocab_engine = engine.execution_options(schema_translate_map={VOCAB_SCHEMA: schema})
+    with vocab_engine.connect() as connection:
+        plans = explain_lookups(connection)
+    assert "SCAN main.concept" in plans["homonyms"]
+    assert "SCAN main.concept" in plans["homonyms (ignore case)"]
+    assert "SCAN" not in plans["relationships"]
+
+    assert check_indexes(engine, schema, create_missing=True)
+    assert check_indexes(engine, schema)
+    with vocab_engine.connect() as connection:
+        plans = explain_lookups(connection)
+    assert "idx_concept_concept_name " in plans["homonyms"]
+    assert "idx_concept_concept_name_lower" in plans["homonyms (ignore case)"]
+
+
+@pytest.mark.usefixtures("create_vocab_tables")
+def test_check_indexes_on_postgresql(pg_db_engine: Engine):
+    """Lookups that can only filter the rows of another index are reported too."""
+    try:
+        assert check_indexes(pg_db_engine, "vocab", create_missing=True)
+        with pg_db_engine.begin() as connection:
+            connection.exec_driver_sql(f"DROP INDEX vocab.{INDEX_NAMES[1]}")
+        assert not check_indexes(pg_db_engine, "vocab")
+    finally:
+        with pg_db_engine.begin() as connection:
+            for name in INDEX_NAMES[1:]:
+                connection.exec_driver_sql(f"DROP INDEX IF EXISTS vocab.{name}")
@@ -0,0 +1,69 @@
+from pathlib import Path
+
+import pytest
+
+from kotobuki.mapping_updater.cli import _expand_batch
+from kotobuki.mapping_updater.io import (
+    ColumnPlan,
+    ingest_usagi_file,
+    is_updated_usagi_file,
+    write_usagi_file,
+)
+from kotobuki.mapping_updater.relationship import NewMap
+from tests.python.mapping_updater.conftest import USAGI_STCM_FILE, write_tmp_usagi_file
+from tests.python.mapping_updater.test_mapping_paths import TARGET_CONCEPT1, VALUE_CONCEPT1
+
+
+def test_column_plan():
+    plan = ColumnPlan(["source_code", "target_concept_id", "target_vocabulary_id"])
+    assert plan.header[-1] == "mappingType"
+    new_map = NewMap(concepts=[TARGET_CONCEPT1], value_as_concept=[VALUE_CONCEPT1])
+    rows = plan.get_new_rows(["X1", "2", "Old"], {2: new_map})
+    assert rows == [
+        ["X1", str(TARGET_CONCEPT1.concept_id), TARGET_CONCEPT1.vocabulary_id, ""],
+        ["X1", str(VALUE_CONCEPT1.concept_id), VALUE_CONCEPT1.vocabulary_id, "MAPS_TO_VALUE"],
+    ]
+    # Rows without a new mapping are only padded
+    assert plan.get_new_rows(["X2", "3"], {2: new_map}) == [["X2", "3", "", ""]]
+
+
+def test_column_plan_sets_one_timestamp():
+    plan = ColumnPlan(["sourceCode", "conceptId", "statusSetOn", "mappingType"], timestamp=42)
+    new_map = NewMap(concepts=[TARGET_CONCEPT1])
+    rows = [
+        row for code in ["A", "B"] for row in plan.get_new_rows([code, "2", "1", ""], {2: new_map})
+    ]
+    assert rows == [
+        ["A", str(TARGET_CONCEPT1.concept_id), "42", ""],
+        ["B", str(TARGET_CONCEPT1.concept_id), "42", ""],
+    ]
+
+
+@pytest.mark.parametrize("spool_max_size", [0, 1, 1_000_000])
+def test_ingested_file_is_read_once(tmp_path: Path, spool_max_size: int):
+    expected_file = write_tmp_usagi_file(tmp_path, USAGI_STCM_FILE)
+    write_usagi_file(expected_file, {2: NewMap(concepts=[TARGET_CONCEPT1])}, overwrite=True)
+
+    (tmp_path / "ingested").mkdir()
+    tmp_usagi_file = write_tmp_usagi_file(tmp_path / "ingested", USAGI_STCM_FILE)
+    with ingest_usagi_file(tmp_usagi_file, spool_max_size=spool_max_size) as ingested:
+        assert len(ingested.concept_ids) == 16
+        # The updated file is written from the spooled contents
+        tmp_usagi_file.unlink()
+        write_usagi_file(
+            tmp_usagi_file,
+            {2: NewMap(concepts=[TARGET_CONCEPT1])},
+            overwrite=True,
+            ingested=ingested,
+        )
+    assert tmp_usagi_file.read_text(encoding="utf8") == expected_file.read_text(encoding="utf8")
+
+
+def test_batch_skips_updated_files(tmp_path: Path):
+    tmp_usagi_file = write_tmp_usagi_file(tmp_path, USAGI_STCM_FILE)
+    write_usagi_file(tmp_usagi_file, {}, overwrite=False)
+    (updated_file,) = (p for p in tmp_path.glob("*.csv") if p != tmp_usagi_file)
+    assert is_updated_usagi_file(updated_file)
+    assert not is_updated_usagi_file(tmp_usagi_file)
+    assert _expand_batch(str(tmp_path)) == [tmp_usagi_file]
+    assert _expand_batch(str(tmp_path / "*.csv")) == [tmp_usagi_file]
@@ -0,0 +1,102 @@
+from pathlib import Path
+
+import pytest
+from omop_cdm.regular.cdm54 import Concept, Vocabulary
+from sqlalchemy import Engine, select, update
+from sqlalchemy.orm import Session
+
+from kotobuki import update_usagi_file
+from kotobuki.mapping_updater import materialize
+from kotobuki.mapping_updater.db import (
+    RESOLUTION_TABLE,
+    ResolutionKind,
+    ResolutionMemo,
+    ResolutionMode,
+    find_new_mappings,
+)
+from kotobuki.mapping_updater.materialize import build_resolution_table
+from tests.python.mapping_updater.conftest import (
+    USAGI_STCM_FILE,
+    count_queries,
+    write_tmp_usagi_file,
+)
+
+pytestmark = pytest.mark.usefixtures("create_vocab_tables")
+
+
+@pytest.fixture(scope="module")
+def resolution_table(pg_db_engine: Engine) -> None:
+    build_resolution_table(pg_db_engine, "vocab", batch_size=5)
+
+
+@pytest.mark.usefixtures("resolution_table")
+@pytest.mark.parametrize("search_homonyms", [False, True])
+def test_materialized_parity(pg_db_engine: Engine, search_homonyms: bool):
+    with Session(pg_db_engine) as session:
+        concepts = session.scalars(select(Concept).where(Concept.standard_concept.is_(None)))
+        concepts = list(concepts)
+        expected = find_new_mappings(concepts, search_homonyms, False, session)
+        with count_queries(pg_db_engine) as statements:
+            new_mappings = find_new_mappings(
+                concepts, search_homonyms, False, session, ResolutionMode.MATERIALIZED
+            )
+    assert {c_id: nm and nm.to_map_path_data() for c_id, nm in new_mappings.items()} == {
+        c_id: nm and nm.to_map_path_data() for c_id, nm in expected.items()
+    }
+    if not search_homonyms:
+        # A single join, no traversal of concept relationships
+        assert len(statements) == 1
+
+
+@pytest.mark.usefixtures("resolution_table")
+def test_materialized_e2e(tmp_path: Path, pg_db_engine: Engine):
+    tmp_usagi_file = write_tmp_usagi_file(tmp_path, USAGI_STCM_FILE)
+    update_usagi_file(pg_db_engine, "vocab", tmp_usagi_file, overwrite=True)
+    expected = tmp_usagi_file.read_text(encoding="utf8")
+
+    tmp_usagi_file = write_tmp_usagi_file(tmp_path, USAGI_STCM_FILE)
+    update_usagi_file(
+        pg_db_engine,
+        "vocab",
+        tmp_usagi_file,
+        overwrite=True,
+        resolution_mode=ResolutionMode.MATERIALIZED,
+    )
+    assert tmp_usagi_file.read_text(encoding="utf8") == expected
+
+
+@pytest.mark.usefixtures("resolution_table")
+def test_outdated_table_is_rejected(tmp_path: Path, pg_db_engine: Engine):
+    tmp_usagi_file = write_tmp_usagi_file(tmp_path, USAGI_STCM_FILE)
+    set_version = update(Vocabulary).where(Vocabulary.vocabulary_id == "0")
+    with Session(pg_db_engine) as session, session.begin():
+        session.execute(set_version.values(vocabulary_version="v2099-01-01"))
+    try:
+        with pytest.raises(ValueError, match="different vocabulary release"):
+            update_usagi_file(
+                pg_db_engine,
+                "vocab",
+                tmp_usagi_file,
+                resolution_mode=ResolutionMode.MATERIALIZED,
+            )
+    finally:
+        with Session(pg_db_engine) as session, session.begin():
+            session.execute(set_version.values(vocabulary_version="v2024-01-01"))
+
+
+def test_only_shared_chains_are_kept(pg_db_engine: Engine, monkeypatch: pytest.MonkeyPatch):
+    memos = []
+
+    def create_memo() -> ResolutionMemo:
+        memos.append(ResolutionMemo())
+        return memos[-1]
+
+    monkeypatch.setattr(materialize, "ResolutionMemo", create_memo)
+    build_resolution_table(pg_db_engine, "vocab", batch_size=2)
+    table = RESOLUTION_TABLE
+    path_ids = select(table.c.target_concept_id).where(table.c.kind == ResolutionKind.PATH.value)
+    with Session(pg_db_engine) as session:
+        shared_ids = set(session.scalars(path_ids))
+    assert shared_ids
+    assert set(memos[0].resolved) <= shared_ids
+    assert not memos[0].mappings
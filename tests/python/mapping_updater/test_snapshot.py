@@ -0,0 +1,102 @@
+import shutil
+from pathlib import Path
+
+import numpy as np
+import pytest
+from omop_cdm.regular.cdm54 import Concept
+from sqlalchemy import Engine, create_engine
+
+from kotobuki import update_usagi_file
+from kotobuki.mapping_updater.athena import AthenaVocabulary
+from kotobuki.mapping_updater.importer import import_athena
+from kotobuki.mapping_updater.snapshot import (
+    VocabularySnapshot,
+    build_snapshot_from_athena,
+    build_snapshot_from_database,
+)
+from tests.python.mapping_updater.conftest import (
+    USAGI_STCM_FILE,
+    VOCAB_DATA_DIR,
+    write_tmp_usagi_file,
+)
+
+pytestmark = pytest.mark.usefixtures("create_vocab_tables")
+
+
+@pytest.fixture(scope="module")
+def snapshot_dir(tmp_path_factory: pytest.TempPathFactory) -> Path:
+    path = tmp_path_factory.mktemp("snapshot")
+    build_snapshot_from_athena(VOCAB_DATA_DIR, path, chunk_rows=4)
+    return path
+
+
+def _values(concept: Concept) -> tuple:
+    return tuple(getattr(concept, col.key) for col in Concept.__table__.columns)
+
+
+def test_database_and_athena_snapshots_are_equal(
+    tmp_path: Path, pg_db_engine: Engine, snapshot_dir: Path
+):
+    build_snapshot_from_database(pg_db_engine, "vocab", tmp_path)
+    for path in snapshot_dir.glob("*.npy"):
+        np.testing.assert_array_equal(np.load(path), np.load(tmp_path / path.name))
+    assert VocabularySnapshot(tmp_path).release == VocabularySnapshot(snapshot_dir).release
+
+
+def test_snapshot_of_empty_concept_table(tmp_path: Path):
+    athena_dir = tmp_path / "athena"
+    shutil.copytree(VOCAB_DATA_DIR, athena_dir)
+    concept_file = athena_dir / "CONCEPT.csv"
+    concept_file.write_text(concept_file.read_text(encoding="utf8").splitlines()[0] + "\n")
+    url, schema = import_athena(athena_dir, tmp_path / "vocab.sqlite")
+    build_snapshot_from_database(create_engine(url), schema, tmp_path / "from_database")
+    build_snapshot_from_athena(athena_dir, tmp_path / "from_athena")
+    for path in (tmp_path / "from_athena").glob("*.npy"):
+        np.testing.assert_array_equal(
+            np.load(path), np.load(tmp_path / "from_database" / path.name)
+        )
+    assert VocabularySnapshot(tmp_path / "from_database").query_concepts([1, 2]) == []
+
+
+def test_lookups_match_athena(snapshot_dir: Path):
+    snapshot = VocabularySnapshot(snapshot_dir)
+    vocabulary = AthenaVocabulary(VOCAB_DATA_DIR)
+    concept_ids = [*range(-1, 40), 123456789]
+    concepts = vocabulary.query_concepts(concept_ids)
+    assert [_values(c) for c in snapshot.query_concepts(concept_ids)] == [
+        _values(c) for c in concepts
+    ]
+    assert snapshot.release == vocabulary.release
+    for concept in concepts:
+        assert [
+            (m.concept_id_2, m.relationship_id) for m in snapshot.get_mappings(concept.concept_id)
+        ] == [
+            (m.concept_id_2, m.relationship_id)
+            for m in vocabulary.get_mappings(concept.concept_id)
+        ]
+        for case_insensitive in (False, True):
+            homonyms = snapshot.find_all_homonyms(concept, case_insensitive)
+            expected = vocabulary.find_all_homonyms(concept, case_insensitive)
+            assert [h.concept_id for h in homonyms] == [h.concept_id for h in expected]
+
+
+@pytest.mark.parametrize("allow_homonyms", [False, True])
+def test_update_usagi_file_from_snapshot(
+    tmp_path: Path, pg_db_engine: Engine, snapshot_dir: Path, allow_homonyms: bool
+):
+    tmp_usagi_file = write_tmp_usagi_file(tmp_path, USAGI_STCM_FILE)
+    update_usagi_file(
+        pg_db_engine, "vocab", tmp_usagi_file, overwrite=True, allow_homonyms=allow_homonyms
+    )
+    expected = tmp_usagi_file.read_text(encoding="utf8")
+
+    tmp_usagi_file = write_tmp_usagi_file(tmp_path, USAGI_STCM_FILE)
+    update_usagi_file(
+        None,
+        None,
+        tmp_usagi_file,
+        overwrite=True,
+        allow_homonyms=allow_homonyms,
+        vocabulary=VocabularySnapshot(snapshot_dir),
+    )
+    assert tmp_usagi_file.read_text(encoding="utf8") == expected
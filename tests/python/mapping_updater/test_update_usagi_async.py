@@ -0,0 +1,42 @@
+import asyncio
+from pathlib import Path
+
+import pytest
+from sqlalchemy import create_engine
+
+from kotobuki import update_usagi_file
+from kotobuki.mapping_updater.importer import import_athena
+from tests.python.mapping_updater.conftest import (
+    USAGI_STCM_FILE,
+    VOCAB_DATA_DIR,
+    write_tmp_usagi_file,
+)
+
+pytest.importorskip("greenlet")
+pytest.importorskip("aiosqlite")
+
+from sqlalchemy.ext.asyncio import create_async_engine
+
+from kotobuki.mapping_updater.update_usagi_async import update_usagi_file_async
+
+
+@pytest.mark.parametrize("max_concurrency", [1, 3])
+def test_async_update_matches_sync(tmp_path: Path, max_concurrency: int):
+    url, schema = import_athena(VOCAB_DATA_DIR, tmp_path / "vocab.sqlite")
+    options = {"overwrite": True, "allow_homonyms": True, "update_all": True}
+    tmp_usagi_file = write_tmp_usagi_file(tmp_path, USAGI_STCM_FILE)
+    update_usagi_file(create_engine(url), schema, tmp_usagi_file, **options)
+    expected = tmp_usagi_file.read_text(encoding="utf8")
+
+    async def update() -> None:
+        engine = create_async_engine(url.replace("sqlite://", "sqlite+aiosqlite://"))
+        try:
+            await update_usagi_file_async(
+                engine, schema, tmp_usagi_file, max_concurrency=max_concurrency, **options
+            )
+        finally:
+            await engine.dispose()
+
+    tmp_usagi_file = write_tmp_usagi_file(tmp_path, USAGI_STCM_FILE)
+    asyncio.run(update())
+    assert tmp_usagi_file.read_text(encoding="utf8") == expected
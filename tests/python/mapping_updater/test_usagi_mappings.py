@@ -1,10 +1,24 @@
+import pickle
+
 import pytest
 from omop_cdm.regular.cdm54 import Concept
 from sqlalchemy import Engine, select
 from sqlalchemy.orm import Session
 
-from kotobuki.mapping_updater.db import find_new_mapping
-from kotobuki.mapping_updater.relationship import NewMap
+from kotobuki.mapping_updater.db import (
+    ResolutionMemo,
+    find_all_homonyms_batch,
+    find_new_mapping,
+    find_standard_concepts,
+    find_standard_concepts_batch,
+    find_standard_concepts_cte,
+    get_mappings_batch,
+    query_concepts,
+    stream_concepts,
+)
+from kotobuki.mapping_updater.relationship import ConceptRecord, MapLink, NewMap
+from kotobuki.mapping_updater.values import CHUNK_SIZE_KEY, TEMP_TABLE_THRESHOLD_KEY
+from tests.python.mapping_updater.conftest import count_queries
 
 pytestmark = pytest.mark.usefixtures("create_vocab_tables")
 
@@ -81,3 +95,149 @@ def test_multiple_maps_to_value(pg_db_engine: Engine):
     assert len(result.concepts) == 1
     assert result.concepts[0].concept_id == 14
     assert {c.concept_id for c in result.value_as_concept} == {15, 16}
+
+
+@pytest.mark.parametrize("find_batch", [find_standard_concepts_batch, find_standard_concepts_cte])
+def test_batch_matches_single_concept_search(pg_db_engine: Engine, find_batch):
+    """Batched searches give the same results as the recursive search."""
+    with Session(pg_db_engine) as session, session.begin():
+        concepts = session.scalars(select(Concept)).all()
+        batch_results = find_batch(concepts, session)
+        assert batch_results.keys() == {c.concept_id for c in concepts}
+        for concept in concepts:
+            single = find_new_mapping(concept, False, False, session)
+            batch = batch_results[concept.concept_id]
+            if single is None:
+                assert batch is None
+                continue
+            assert batch.concepts == single.concepts
+            assert batch.value_as_concept == single.value_as_concept
+            assert batch.to_map_path_data() == single.to_map_path_data()
+
+
+def test_one_query_per_relationship_hop(pg_db_engine: Engine):
+    """Target concepts are fetched together with the relationships (no lazy loads)."""
+    with Session(pg_db_engine) as session, session.begin():
+        concept = get_concept_by_id(session, concept_id=1)
+        with count_queries(pg_db_engine) as statements:
+            result = find_standard_concepts(1, session, [MapLink(concept)])
+            # Access all concepts, to make sure nothing is loaded lazily
+            _ = result.to_map_path_data()
+        # Concept 1 is replaced by 2, which maps to 3
+        assert len(statements) == 2
+
+        concept = get_concept_by_id(session, concept_id=13)
+        with count_queries(pg_db_engine) as statements:
+            result = find_standard_concepts(13, session, [MapLink(concept)])
+            _ = result.to_map_path_data()
+        assert len(statements) == 1
+
+
+def test_relationship_cycle(pg_db_engine: Engine):
+    """Concepts 26 and 27 are each other's same_as, without ever reaching a standard concept."""
+    assert get_new_map(concept_id=26, engine=pg_db_engine) is None
+    with Session(pg_db_engine) as session, session.begin():
+        concepts = [get_concept_by_id(session, 26), get_concept_by_id(session, 27)]
+        assert find_standard_concepts_batch(concepts, session) == {26: None, 27: None}
+        assert find_standard_concepts_cte(concepts, session) == {26: None, 27: None}
+
+
+def test_shared_chain_is_fetched_once(pg_db_engine: Engine):
+    """Concept 1 is replaced by 2; the relationships of 2 are only fetched once."""
+    with Session(pg_db_engine) as session, session.begin():
+        concepts = [get_concept_by_id(session, 1), get_concept_by_id(session, 2)]
+        memo = ResolutionMemo()
+        with count_queries(pg_db_engine) as statements:
+            results = find_standard_concepts_batch(concepts, session, memo)
+        assert len(statements) == 1
+        assert [c.concept_id for c in results[1].concepts] == [3]
+        assert [str(link) for link in results[1].map_path[1:]] == [
+            "(Concept replaced by) 2 x deprecated2"
+        ]
+        # Resolved chains are memoized for subsequent searches
+        concept = get_concept_by_id(session, 1)
+        with count_queries(pg_db_engine) as statements:
+            result = find_standard_concepts(1, session, [MapLink(concept)], memo)
+        assert not statements
+        assert result.to_map_path_data() == results[1].to_map_path_data()
+
+
+@pytest.mark.parametrize("engine_fixture", ["pg_db_engine", "sqlite_db_engine"])
+def test_chunked_in_lists(engine_fixture: str, request: pytest.FixtureRequest):
+    """Large sets of concept_ids are split over multiple IN-lists (except for PostgreSQL)."""
+    engine: Engine = request.getfixturevalue(engine_fixture)
+    concept_ids = [1, 2, 7, 10, 13]
+    with Session(engine, info={CHUNK_SIZE_KEY: 2}) as session, session.begin():
+        n_chunks = 1 if session.get_bind().dialect.name == "postgresql" else 3
+        with count_queries(engine) as statements:
+            concepts = query_concepts(set(concept_ids), session)
+        assert len(statements) == n_chunks
+        assert sorted(c.concept_id for c in concepts) == concept_ids
+
+        with count_queries(engine) as statements:
+            mappings = get_mappings_batch(concept_ids, session)
+        assert len(statements) == n_chunks
+        assert {c_id: [m.concept_id_2 for m in ms] for c_id, ms in mappings.items()} == {
+            1: [2, 2],
+            2: [3],
+            7: [8, 9],
+            10: [11, 12],
+            13: [14, 15, 16],
+        }
+        # Ties between relationships to the same concept are ordered by relationship_id
+        assert [m.relationship_id for m in mappings[1]] == [
+            "Concept replaced by",
+            "Concept same_as to",
+        ]
+        results = find_standard_concepts_cte(concepts, session)
+        assert [c.concept_id for c in results[1].concepts] == [3]
+
+
+def test_stream_concepts(pg_db_engine: Engine):
+    """Streamed concepts have the same values as ORM objects, but are not tracked."""
+    concept_ids = {1, 2, 7, 10, 13}
+    with Session(pg_db_engine) as session, session.begin():
+        rows = list(stream_concepts(concept_ids, session, yield_per=2))
+        assert not session.identity_map
+        concepts = query_concepts(concept_ids, session)
+        columns = [col.key for col in Concept.__table__.columns]
+        assert sorted(tuple(getattr(r, col) for col in columns) for r in rows) == sorted(
+            tuple(getattr(c, col) for col in columns) for c in concepts
+        )
+
+
+def test_results_are_detached_records(pg_db_engine: Engine):
+    """Results hold plain concept records, usable after the session ends and picklable."""
+    with Session(pg_db_engine) as session, session.begin():
+        results = find_standard_concepts_batch(query_concepts({1, 7}, session), session)
+    for concept_id in (1, 7):
+        new_map = pickle.loads(pickle.dumps(results[concept_id]))
+        links = [link.concept for link in new_map.map_path]
+        assert all(isinstance(c, ConceptRecord) for c in [*new_map.concepts, *links])
+        assert new_map.concepts == results[concept_id].concepts
+        assert new_map.to_map_path_data() == results[concept_id].to_map_path_data()
+
+
+@pytest.mark.parametrize("engine_fixture", ["pg_db_engine", "sqlite_db_engine"])
+def test_temp_table_for_many_values(engine_fixture: str, request: pytest.FixtureRequest):
+    """Above the threshold, values are loaded in a temporary table and joined."""
+    engine: Engine = request.getfixturevalue(engine_fixture)
+    concept_ids = [1, 2, 7, 10, 13]
+    with Session(engine, info={TEMP_TABLE_THRESHOLD_KEY: 2}) as session, session.begin():
+        with count_queries(engine) as statements:
+            concepts = query_concepts(set(concept_ids), session)
+        assert any("kotobuki_values_" in s for s in statements)
+        assert sorted(c.concept_id for c in concepts) == concept_ids
+
+        mappings = get_mappings_batch(concept_ids, session)
+        assert [m.concept_id_2 for m in mappings[13]] == [14, 15, 16]
+        results = find_standard_concepts_cte(concepts, session)
+        assert [c.concept_id for c in results[1].concepts] == [3]
+        homonyms = find_all_homonyms_batch(
+            [get_concept_by_id(session, c_id) for c_id in [5, 19, 21]], True, session
+        )
+        assert {c_id: [h.concept_id for h in hs] for c_id, hs in homonyms.items()} == {
+            5: [6],
+            19: [20],
+            21: [22, 23, 24, 25],
+        }
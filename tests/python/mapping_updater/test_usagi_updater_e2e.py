@@ -3,12 +3,18 @@ import filecmp
 from pathlib import Path
 
 import pytest
-from sqlalchemy import Engine
+from sqlalchemy import Engine, create_engine
 
-from kotobuki import update_usagi_file
+from kotobuki import update_usagi_file, update_usagi_files
+from kotobuki.mapping_updater import update_usagi
+from kotobuki.mapping_updater.db import ResolutionMode
+from kotobuki.mapping_updater.io import (
+    IngestedUsagiFile,
+)
 from tests.python.mapping_updater.conftest import (
     MAP_TO_0_USAGI_FILE,
     USAGI_STCM_FILE,
+    count_queries,
     write_tmp_usagi_file,
 )
 
@@ -53,6 +59,51 @@ def test_overwrite(tmp_path: Path, pg_db_engine: Engine):
     ]
 
 
+def test_recursive_cte_mode(tmp_path: Path, pg_db_engine: Engine):
+    tmp_usagi_file = write_tmp_usagi_file(tmp_path, USAGI_STCM_FILE)
+    update_usagi_file(pg_db_engine, "vocab", tmp_usagi_file, overwrite=True)
+    expected = tmp_usagi_file.read_text(encoding="utf8")
+
+    tmp_usagi_file = write_tmp_usagi_file(tmp_path, USAGI_STCM_FILE)
+    update_usagi_file(
+        pg_db_engine,
+        "vocab",
+        tmp_usagi_file,
+        overwrite=True,
+        resolution_mode=ResolutionMode.RECURSIVE_CTE,
+    )
+    assert tmp_usagi_file.read_text(encoding="utf8") == expected
+
+
+def test_workers_match_serial_run(
+    tmp_path: Path, pg_db_engine: Engine, caplog: pytest.LogCaptureFixture
+):
+    options = {"overwrite": True, "allow_homonyms": True, "ignore_case": True}
+    tmp_usagi_file = write_tmp_usagi_file(tmp_path, USAGI_STCM_FILE)
+    with caplog.at_level("INFO", logger="kotobuki"):
+        update_usagi_file(pg_db_engine, "vocab", tmp_usagi_file, **options)
+    expected = tmp_usagi_file.read_text(encoding="utf8")
+    expected_log = caplog.messages.copy()
+    assert any("could be remapped" in m for m in expected_log)
+    caplog.clear()
+
+    tmp_usagi_file = write_tmp_usagi_file(tmp_path, USAGI_STCM_FILE)
+    with caplog.at_level("INFO", logger="kotobuki"):
+        update_usagi_file(pg_db_engine, "vocab", tmp_usagi_file, workers=3, **options)
+    assert tmp_usagi_file.read_text(encoding="utf8") == expected
+    # Apart from the output file name
+    assert caplog.messages[:-1] == expected_log[:-1]
+
+
+def test_workers_need_large_enough_pool(tmp_path: Path, pg_db_engine: Engine):
+    tmp_usagi_file = write_tmp_usagi_file(tmp_path, USAGI_STCM_FILE)
+    # Overflow connections are not kept, so they do not count
+    engine = create_engine(pg_db_engine.url, pool_size=2, max_overflow=10)
+    with pytest.raises(ValueError, match="keeps 2 connections, 4 are needed"):
+        update_usagi_file(engine, "vocab", tmp_usagi_file, workers=3)
+    engine.dispose()
+
+
 def test_homonyms(tmp_path: Path, pg_db_engine: Engine):
     tmp_usagi_file = write_tmp_usagi_file(tmp_path, USAGI_STCM_FILE)
     update_usagi_file(pg_db_engine, "vocab", tmp_usagi_file, overwrite=True, allow_homonyms=True)
@@ -114,3 +165,52 @@ def test_domain_id_only_updated_when_mapped_to_non_zero(tmp_path: Path, pg_db_en
         ("Condition", "17"),
         ("Condition", "18"),
     ]
+
+
+def test_multiple_files_share_one_resolution(tmp_path: Path, pg_db_engine: Engine):
+    expected = {}
+    for usagi_file in [USAGI_STCM_FILE, MAP_TO_0_USAGI_FILE]:
+        tmp_usagi_file = write_tmp_usagi_file(tmp_path, usagi_file)
+        update_usagi_file(pg_db_engine, "vocab", tmp_usagi_file, overwrite=True, update_all=True)
+        expected[usagi_file.name] = tmp_usagi_file.read_text(encoding="utf8")
+
+    tmp_usagi_files = [
+        write_tmp_usagi_file(tmp_path, usagi_file)
+        for usagi_file in [USAGI_STCM_FILE, MAP_TO_0_USAGI_FILE]
+    ]
+    with count_queries(pg_db_engine) as statements:
+        update_usagi_files(pg_db_engine, "vocab", tmp_usagi_files, overwrite=True, update_all=True)
+    # The target concepts of both files are looked up with a single query
+    assert len([s for s in statements if "concept_relationship" not in s]) == 1
+    for tmp_usagi_file in tmp_usagi_files:
+        assert tmp_usagi_file.read_text(encoding="utf8") == expected[tmp_usagi_file.name]
+
+
+def test_spools_are_closed_per_file(
+    tmp_path: Path, pg_db_engine: Engine, monkeypatch: pytest.MonkeyPatch
+):
+    events = []
+    write = update_usagi.write_usagi_file
+
+    def write_usagi_file(usagi_file: Path, *args) -> None:
+        events.append(("write", usagi_file.name))
+        write(usagi_file, *args)
+
+    def close(self: IngestedUsagiFile) -> None:
+        events.append(("close", self.path.name))
+
+    monkeypatch.setattr(update_usagi, "write_usagi_file", write_usagi_file)
+    monkeypatch.setattr(IngestedUsagiFile, "close", close)
+    tmp_usagi_files = [
+        write_tmp_usagi_file(tmp_path, usagi_file)
+        for usagi_file in [USAGI_STCM_FILE, MAP_TO_0_USAGI_FILE]
+    ]
+    update_usagi_files(pg_db_engine, "vocab", tmp_usagi_files, update_all=True)
+    names = [f.name for f in tmp_usagi_files]
+    # The stack closes them once more at the end of the run
+    assert events[:4] == [
+        ("write", names[0]),
+        ("close", names[0]),
+        ("write", names[1]),
+        ("close", names[1]),
+    ]
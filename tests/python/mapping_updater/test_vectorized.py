@@ -0,0 +1,76 @@
+from pathlib import Path
+
+import numpy as np
+import pytest
+from sqlalchemy import Engine
+
+from kotobuki import update_usagi_file
+from kotobuki.mapping_updater.athena import AthenaVocabulary
+from kotobuki.mapping_updater.db import ResolutionMode
+from kotobuki.mapping_updater.snapshot import VocabularySnapshot, build_snapshot_from_athena
+from kotobuki.mapping_updater.vectorized import VectorizedResolver
+from tests.python.mapping_updater.conftest import (
+    USAGI_STCM_FILE,
+    VOCAB_DATA_DIR,
+    write_tmp_usagi_file,
+)
+
+
+@pytest.fixture(scope="module")
+def vocabulary() -> AthenaVocabulary:
+    return AthenaVocabulary(VOCAB_DATA_DIR)
+
+
+def _path_data(new_mappings: dict) -> dict:
+    return {c_id: nm and nm.to_map_path_data() for c_id, nm in new_mappings.items()}
+
+
+def test_pointer_jumping():
+    # 0 -> 1 -> ... -> 9 (end), 10 -> 11 -> 10 (cycle), 12 -> 10 (leads to cycle)
+    successor = np.array([*range(1, 10), 9, 11, 10, 10])
+    end, steps = VectorizedResolver._jump(successor)
+    assert end[:10].tolist() == [9] * 10
+    assert steps[:10].tolist() == list(range(9, -1, -1))
+    assert all(successor[end[10:]] != end[10:])
+
+
+def test_matches_traversal(tmp_path: Path, vocabulary: AthenaVocabulary):
+    build_snapshot_from_athena(VOCAB_DATA_DIR, tmp_path)
+    concepts = vocabulary.query_concepts(range(40))
+    expected = _path_data(vocabulary.find_new_mappings(concepts, False, False))
+    for source in (vocabulary, VocabularySnapshot(tmp_path)):
+        resolver = VectorizedResolver(source)
+        assert _path_data(resolver.resolve(concepts)) == expected
+        resolved_all = _path_data(resolver.resolve_all())
+        assert resolved_all == {c_id: expected[c_id] for c_id in resolved_all}
+        # Including the cycle, which has relationships but no result
+        assert {26, 27} < resolved_all.keys()
+        assert {
+            c.concept_id
+            for c in concepts
+            if c.standard_concept != "S" and expected[c.concept_id] is not None
+        } < resolved_all.keys()
+
+
+@pytest.mark.usefixtures("create_vocab_tables")
+@pytest.mark.parametrize("allow_homonyms", [False, True])
+def test_update_usagi_file_vectorized(
+    tmp_path: Path, pg_db_engine: Engine, vocabulary: AthenaVocabulary, allow_homonyms: bool
+):
+    tmp_usagi_file = write_tmp_usagi_file(tmp_path, USAGI_STCM_FILE)
+    update_usagi_file(
+        pg_db_engine, "vocab", tmp_usagi_file, overwrite=True, allow_homonyms=allow_homonyms
+    )
+    expected = tmp_usagi_file.read_text(encoding="utf8")
+
+    tmp_usagi_file = write_tmp_usagi_file(tmp_path, USAGI_STCM_FILE)
+    update_usagi_file(
+        None,
+        None,
+        tmp_usagi_file,
+        overwrite=True,
+        allow_homonyms=allow_homonyms,
+        resolution_mode=ResolutionMode.VECTORIZED,
+        vocabulary=vocabulary,
+    )
+    assert tmp_usagi_file.read_text(encoding="utf8") == expected